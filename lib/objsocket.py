@@ -3,9 +3,12 @@
 
 import os
 import fcntl
+import collections
 import socket
 import pickle
 import struct
+import zlib
+import ssl
 from OpenSSL import SSL
 from gi.repository import GLib
 from sn_util import SnUtil
@@ -18,14 +21,17 @@ class objsocket:
     SOCKTYPE_PIPE = 2                    # bidirectional pipe
     SOCKTYPE_PIPE_PAIR = 3               # a pair of unidirectonal pipe, mySock should be (inPipe, outPipe)
     SOCKTYPE_MULTIPROCESSING_PIPE = 4    # the return value of multiprocessing.Pipe()
+    SOCKTYPE_SSL_OBJECT = 5              # ssl.SSLObject over memory BIO, mySock should be SnSslObjectSocket
 
     _GC_STATE_NONE = 0
     _GC_STATE_PENDING = 1
     _GC_STATE_COMPLETE = 2
 
-    def __init__(self, mySockType, mySock, recvFunc, errorFunc, gcCompleteFunc):
+    def __init__(self, mySockType, mySock, recvFunc, errorFunc, gcCompleteFunc, raw=False):
+        """In raw mode, objects are pickled bytes, they are not pickled or unpickled by objsocket"""
+
         if mySockType == self.SOCKTYPE_SOCKET:
-            assert False
+            self.adapterObj = _AdapterObjSocket()
         elif mySockType == self.SOCKTYPE_SSL_SOCKET:
             self.adapterObj = _AdapterObjSslSocket()
         elif mySockType == self.SOCKTYPE_PIPE:
@@ -34,33 +40,66 @@ class objsocket:
             self.adapterObj = _AdapterObjPipePair()
         elif mySockType == self.SOCKTYPE_MULTIPROCESSING_PIPE:
             assert False
+        elif mySockType == self.SOCKTYPE_SSL_OBJECT:
+            self.adapterObj = _AdapterObjSslObject()
         else:
             assert False
         assert self.adapterObj.checkSock(mySock)
 
         self.mySock = mySock
+        self.raw = raw
         self.gcState = self._GC_STATE_NONE
         self.recvFunc = recvFunc
         self.errorFunc = errorFunc
         self.gcCompleteFunc = gcCompleteFunc
 
+        self.compress = False
         self.sendBuffer = b''
+        self.sendQueue = collections.deque()      # [conflateKey, packet], not moved into sendBuffer yet
+        self.sendKeyDict = dict()                  # conflateKey -> item in sendQueue
         self.recvBuffer = b''
         self.recvSourceId = self.adapterObj.addRecvWatch(self.mySock, self._onRecv)
         self.sendSourceId = None
 
-    def send(self, dataObj):
-        """Never raise exception, errorFunc is called if the socket is broken"""
+        # data received before we watch the socket, no event is fired for it
+        if self.adapterObj.hasPendingRecv(self.mySock):
+            SnUtil.idleInvoke(self._onRecvPending)
+
+    def send(self, dataObj, conflateKey=None):
+        """Never raise exception, errorFunc is called if the socket is broken.
+           If conflateKey is not None, dataObj replaces the not yet sent object with
+           the same conflateKey, so only the newest one is sent"""
 
         assert self.mySock is not None
         assert self.gcState == self._GC_STATE_NONE
 
-        data = pickle.dumps(dataObj)
+        if self.raw:
+            data = dataObj
+        else:
+            data = pickle.dumps(dataObj)
         header = struct.pack("!I", len(data))
+        if self.compress and len(data) >= _compressMinSize:
+            zdata = zlib.compress(data, _compressLevel)
+            if len(zdata) < len(data):
+                data = zdata
+                header = struct.pack("!I", len(data) | _compressFlag)
         packet = header + data
-        self.sendBuffer += packet
+
+        if conflateKey is not None and conflateKey in self.sendKeyDict:
+            self.sendKeyDict[conflateKey][1] = packet
+            return
+
+        item = [conflateKey, packet]
+        self.sendQueue.append(item)
+        if conflateKey is not None:
+            self.sendKeyDict[conflateKey] = item
         self.sendSourceId = self.adapterObj.addSendWatch(self.mySock, self._onSend)
 
+    def enable_compress(self):
+        """Large objects are sent compressed, the other end must be able to receive compressed
+           packets. Compressed packets are always accepted in receiving"""
+        self.compress = True
+
     def graceful_close(self):
         """This function does not close the socket, the socket must be closed
            by graceful close complete callback funtion"""
@@ -76,12 +115,15 @@ class objsocket:
 
         # set state
         self.gcState = self._GC_STATE_PENDING
-        if len(self.sendBuffer) == 0:
+        if not self._hasDataToSend():
             SnUtil.idleInvoke(self._gcComplete)
         else:
             # assure socket is sending data
             assert self.sendSourceId is not None
 
+    def is_graceful_closing(self):
+        return self.gcState != self._GC_STATE_NONE
+
     def close(self):
         assert self.mySock is not None
 
@@ -104,15 +146,14 @@ class objsocket:
         # it is all because there's some mess in the glib io_add_watch registration and unregistration
         if self.mySock is None:
             return False
-        if len(self.sendBuffer) == 0:
+        if not self._hasDataToSend():
             return False
 
-        assert len(self.sendBuffer) > 0
-
-        # send data as much as possible
+        # send data as much as possible, queued objects are serialized into sendBuffer as late as possible
         try:
             if cb_condition & _flagError:
                 raise _ObjSocketException(CbConditionException(cb_condition))
+            self._fillSendBuffer()
             sendLen = self.adapterObj.send(self.mySock, self.sendBuffer)
             self.sendBuffer = self.sendBuffer[sendLen:]
         except _ObjSocketException as e:
@@ -121,14 +162,16 @@ class objsocket:
                 assert self.mySock is None        # errorFunc should close the socket
                 return False
             elif self.gcState == self._GC_STATE_PENDING:
-                self.sendBuffer = ""
+                self.sendBuffer = b''
+                self.sendQueue.clear()
+                self.sendKeyDict.clear()
                 self._gcComplete()
                 return False
             else:
                 assert False
 
         # still has data to send
-        if len(self.sendBuffer) > 0:
+        if self._hasDataToSend():
             return True
 
         # no data to send
@@ -141,37 +184,68 @@ class objsocket:
         else:
             assert False
 
+    def _onRecvPending(self):
+        if self.mySock is None or self.gcState != self._GC_STATE_NONE:
+            return
+        self._onRecv(self.mySock, GLib.IO_IN)
+
     def _onRecv(self, source, cb_condition):
         assert self.gcState == self._GC_STATE_NONE
 
+        # packets received before the error are still delivered
+        excObj = None
         try:
+            if cb_condition & GLib.IO_IN:
+                self.recvBuffer += self.adapterObj.recv(self.mySock)
             if cb_condition & _flagError:
                 raise _ObjSocketException(CbConditionException(cb_condition))
-            self.recvBuffer += self.adapterObj.recv(self.mySock)
         except _ObjSocketException as e:
-            self.errorFunc(self, e.excObj)
-            assert self.mySock is None            # errorFunc should close the socket
-            return False
+            self.recvBuffer += e.recvData
+            excObj = e.excObj
 
         while True:
             # get packet header
             headerLen = struct.calcsize("!I")
             if len(self.recvBuffer) < headerLen:
-                return True
+                break
 
             # get packet data
             dataLen = struct.unpack("!I", self.recvBuffer[:headerLen])[0]
+            compressed = (dataLen & _compressFlag) != 0
+            dataLen &= ~_compressFlag
             totalLen = headerLen + dataLen
             if len(self.recvBuffer) < totalLen:
-                return True
+                break
 
             # invoke callback function
-            dataObj = pickle.loads(self.recvBuffer[headerLen:totalLen])
+            data = self.recvBuffer[headerLen:totalLen]
+            if compressed:
+                data = zlib.decompress(data)
+            if self.raw:
+                dataObj = data
+            else:
+                dataObj = pickle.loads(data)
             self.recvBuffer = self.recvBuffer[totalLen:]
             self.recvFunc(self, dataObj)
             if self.mySock is None or self.gcState != self._GC_STATE_NONE:
                 return False
 
+        if excObj is not None:
+            self.errorFunc(self, excObj)
+            assert self.mySock is None            # errorFunc should close the socket
+            return False
+        return True
+
+    def _hasDataToSend(self):
+        return len(self.sendBuffer) > 0 or len(self.sendQueue) > 0 or self.adapterObj.hasPendingSend(self.mySock)
+
+    def _fillSendBuffer(self):
+        while len(self.sendQueue) > 0 and len(self.sendBuffer) < _sendBufferLowWater:
+            conflateKey, packet = self.sendQueue.popleft()
+            if conflateKey is not None:
+                del self.sendKeyDict[conflateKey]
+            self.sendBuffer += packet
+
     def _gcComplete(self):
         self.gcState = self._GC_STATE_COMPLETE
         self.gcCompleteFunc(self)
@@ -187,9 +261,50 @@ class CbConditionException(Exception):
 
 class _ObjSocketException(Exception):
 
-    def __init__(self, excObj):
+    def __init__(self, excObj, recvData=b''):
         super(_ObjSocketException, self).__init__(str(excObj))
         self.excObj = excObj
+        self.recvData = recvData            # data received before the error occured
+
+
+class _AdapterObjSocket:
+
+    def checkSock(self, mySock):
+        return mySock.gettimeout() == 0.0
+
+    def send(self, mySock, sendBuffer):
+        try:
+            return mySock.send(sendBuffer)
+        except (BlockingIOError, InterruptedError):
+            return 0
+        except socket.error as e:
+            raise _ObjSocketException(e)
+
+    def hasPendingSend(self, mySock):
+        return False
+
+    def hasPendingRecv(self, mySock):
+        return False
+
+    def recv(self, mySock):
+        try:
+            recvBuf = mySock.recv(_sockRecvSize)
+            if len(recvBuf) == 0:
+                raise EOFError()
+            return recvBuf
+        except (BlockingIOError, InterruptedError):
+            return b''
+        except (socket.error, EOFError) as e:
+            raise _ObjSocketException(e)
+
+    def close(self, mySock):
+        mySock.close()
+
+    def addSendWatch(self, mySock, mySendFunc):
+        return GLib.io_add_watch(mySock, GLib.IO_OUT | _flagError, mySendFunc)
+
+    def addRecvWatch(self, mySock, myRecvFunc):
+        return GLib.io_add_watch(mySock, GLib.IO_IN | _flagError, myRecvFunc)
 
 
 class _AdapterObjSslSocket:
@@ -210,6 +325,12 @@ class _AdapterObjSslSocket:
         except (socket.error, SSL.Error) as e:
             raise _ObjSocketException(e)
 
+    def hasPendingSend(self, mySock):
+        return False
+
+    def hasPendingRecv(self, mySock):
+        return mySock.pending() > 0
+
     def recv(self, mySock):
         try:
             recvBuf = mySock.recv(4096)
@@ -217,7 +338,7 @@ class _AdapterObjSslSocket:
                 raise EOFError()
             return recvBuf
         except (SSL.WantReadError, SSL.WantWriteError):
-            return ""
+            return b''
         except (socket.error, SSL.Error, EOFError) as e:
             raise _ObjSocketException(e)
 
@@ -231,6 +352,67 @@ class _AdapterObjSslSocket:
         return GLib.io_add_watch(mySock, GLib.IO_IN | _flagError, myRecvFunc)
 
 
+class _AdapterObjSslObject:
+
+    """Encrypted data that the socket can't accept at once is kept by mySock, so
+       objsocket must keep sending until hasPendingSend() returns False"""
+
+    def checkSock(self, mySock):
+        return True
+
+    def send(self, mySock, sendBuffer):
+        try:
+            if not mySock.pumpOut():
+                return 0
+            if len(sendBuffer) == 0:
+                return 0
+            sendLen = mySock.sslObj.write(sendBuffer[:_sslRecordSize])
+            mySock.pumpOut()
+            return sendLen
+        except (socket.error, ssl.SSLError) as e:
+            raise _ObjSocketException(e)
+
+    def hasPendingSend(self, mySock):
+        return mySock.hasPendingOut()
+
+    def hasPendingRecv(self, mySock):
+        return mySock.hasPendingIn()
+
+    def recv(self, mySock):
+        """Data decrypted before the connection is closed by peer is returned with the EOFError"""
+
+        recvBuf = b''
+        try:
+            eof = not mySock.pumpIn()
+            while True:
+                try:
+                    buf = mySock.sslObj.read(_sslRecordSize)
+                except ssl.SSLWantReadError:
+                    break
+                except ssl.SSLZeroReturnError:
+                    eof = True
+                    break
+                if len(buf) == 0:
+                    eof = True
+                    break
+                recvBuf += buf
+            mySock.pumpOut()                   # ssl.SSLObject.read() may generate protocol data
+        except (socket.error, ssl.SSLError) as e:
+            raise _ObjSocketException(e, recvBuf)
+        if eof:
+            raise _ObjSocketException(EOFError(), recvBuf)
+        return recvBuf
+
+    def close(self, mySock):
+        mySock.close()
+
+    def addSendWatch(self, mySock, mySendFunc):
+        return GLib.io_add_watch(mySock, GLib.IO_OUT, mySendFunc)
+
+    def addRecvWatch(self, mySock, myRecvFunc):
+        return GLib.io_add_watch(mySock, GLib.IO_IN | _flagError, myRecvFunc)
+
+
 class _AdapterObjPipePair:
 
     def checkSock(self, mySock):
@@ -243,6 +425,12 @@ class _AdapterObjPipePair:
         mySock[1].flush()
         return len(sendBuffer)
 
+    def hasPendingSend(self, mySock):
+        return False
+
+    def hasPendingRecv(self, mySock):
+        return False
+
     def recv(self, mySock):
         try:
             return mySock[0].read()
@@ -260,3 +448,13 @@ class _AdapterObjPipePair:
         return GLib.io_add_watch(mySock[0], GLib.IO_IN | _flagError, myRecvFunc)
 
 _flagError = GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL
+
+_sslRecordSize = 16384
+
+_sockRecvSize = 65536
+
+_sendBufferLowWater = 65536
+
+_compressFlag = 0x80000000          # the highest bit of packet length
+_compressMinSize = 512
+_compressLevel = 1
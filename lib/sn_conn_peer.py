@@ -1,20 +1,27 @@
 #!/usr/bin/python3
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
+import ssl
+import json
+import pickle
+import struct
 import socket
 import errno
 import logging
+import subprocess
 import libasyncns
+import concurrent.futures
 from OpenSSL import SSL
 from gi.repository import GLib
+from objsocket import objsocket
 from sn_util import SnUtil
 
 
 class SnPeerServer:
 
-    def __init__(self, certFile, privkeyFile, caCertFile, connectFunc):
+    def __init__(self, certFile, privkeyFile, caCertFile, connectFunc, handshakeThreadNum=0, sslBackend="pyopenssl"):
         self.connectFunc = connectFunc
-        self.handshaker = _HandShaker(certFile, privkeyFile, caCertFile, self._onHandShakeComplete, self._onHandShakeError)
+        self.handshaker = _HandShaker(certFile, privkeyFile, caCertFile, handshakeThreadNum, sslBackend, self._onHandShakeComplete, self._onHandShakeError)
         self.serverSock = None
         self.serverSourceId = None
 
@@ -23,10 +30,15 @@ class SnPeerServer:
             self.stop()
         self.handshaker.dispose()
 
-    def start(self, port):
+    def start(self, port, reusePort=False):
+        """Several processes can listen on the same port if reusePort is True, the kernel
+           distributes the incoming connections among them"""
+
         assert self.serverSock is None
 
         self.serverSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reusePort:
+            self.serverSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.serverSock.bind(('0.0.0.0', port))
         self.serverSock.listen(5)
         self.serverSock.setblocking(0)
@@ -68,23 +80,38 @@ class SnPeerServer:
 
 class SnPeerClient:
 
-    def __init__(self, certFile, privkeyFile, caCertFile, connectFunc):
+    def __init__(self, certFile, privkeyFile, caCertFile, connectFunc, handshakeThreadNum=0, sslBackend="pyopenssl"):
         self.connectFunc = connectFunc
-        self.handshaker = _HandShaker(certFile, privkeyFile, caCertFile, self._onHandShakeComplete, self._onHandShakeError)
+        self.handshaker = _HandShaker(certFile, privkeyFile, caCertFile, handshakeThreadNum, sslBackend, self._onHandShakeComplete, self._onHandShakeError)
         self.asyncns = libasyncns.Asyncns()
         self.sockSet = set()
+        self.hintSockSet = set()            # sockets of the connects with address hint
         self.isDispose = False
 
     def dispose(self):
         self.isDispose = True
         self.handshaker.dispose()
 
-    def connect(self, hostname, port):
+    def connect(self, hostname, port, hostaddr=None, hint=False):
+        """hostname is resolved if hostaddr is None. If hint is True, hostaddr is got from an
+           untrusted source, the connect doesn't stop the other connects to the same host"""
+
+        # address hint, peer name is verified by certificate anyway
+        if hint:
+            assert hostaddr is not None
+            self._doConnect(hostname, port, hostaddr, True)
+            return
+
         # don't do repeat connect
         if (hostname, port) in self.sockSet:
             return
         self.sockSet.add((hostname, port))
 
+        # address is known, no resolve
+        if hostaddr is not None:
+            self._doConnect(hostname, port, hostaddr)
+            return
+
         # do operation
         #logging.debug("SnPeerClient.connect: Start, %s, %d", hostname, port)
         self.asyncns.getaddrinfo(hostname, None)
@@ -109,28 +136,33 @@ class SnPeerClient:
             #logging.debug("SnPeerClient.connect: Resolve failed, %s, %d, %s, %s", hostname, port, e.__class__, e)
             return False
 
-        # do connect
+        self._doConnect(hostname, port, hostaddr)
+        return False
+
+    def _doConnect(self, hostname, port, hostaddr, hint=False):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setblocking(0)
+        if hint:
+            self.hintSockSet.add(sock)
         try:
             sock.connect((hostaddr, port))
         except socket.error as e:
             if e.errno == errno.EAGAIN or e.errno == errno.EINPROGRESS:
                 pass
             else:
-                self.sockSet.remove((hostname, port))
-                #logging.debug("SnPeerClient.connect: Resolve failed, %s, %d, %s, %s", hostname, port, e.__class__, e)
+                self._connectDone(sock, hostname, port)
+                #logging.debug("SnPeerClient.connect: Connect failed, %s, %d, %s, %s", hostname, port, e.__class__, e)
                 sock.close()
-                return False
+                return
 
         GLib.io_add_watch(sock, GLib.IO_IN | GLib.IO_OUT | _flagError, self._onConnect, hostname, port)
-        return False
 
     def _onConnect(self, source, cb_condition, hostname, port):
         if self.isDispose:
             return False
 
         if cb_condition & _flagError:
+            self._connectDone(source, hostname, port)
             source.close()
             return False
 
@@ -141,34 +173,396 @@ class SnPeerClient:
 
     def _onHandShakeComplete(self, source, sslSock, hostname, port):
         logging.debug("SnPeerClient._onHandShakeComplete: %s, %s", hostname, port)
-        self.sockSet.remove((hostname, port))
+        self._connectDone(source, hostname, port)
         self.connectFunc(sslSock)
 
     def _onHandShakeError(self, source, hostname, port):
         logging.debug("SnPeerClient._onHandShakeError: %s, %s", hostname, port)
-        self.sockSet.remove((hostname, port))
+        self._connectDone(source, hostname, port)
         source.close()
 
+    def _connectDone(self, sock, hostname, port):
+        if sock in self.hintSockSet:
+            self.hintSockSet.remove(sock)
+        else:
+            self.sockSet.remove((hostname, port))
+
+
+class SnSslObjectSocket:
+
+    """Socket of the "ssl" backend. A standard library ssl.SSLObject works on a
+       pair of memory BIO, encrypted data is pumped between the BIOs and the
+       plain socket by pumpIn() and pumpOut()"""
+
+    def __init__(self, sock, sslCtx, serverSide):
+        self.sock = sock
+        self.inBio = ssl.MemoryBIO()
+        self.outBio = ssl.MemoryBIO()
+        self.sslObj = sslCtx.wrap_bio(self.inBio, self.outBio, server_side=serverSide)
+        self.outBuffer = b''
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def getsockopt(self, *args):
+        return self.sock.getsockopt(*args)
+
+    def setsockopt(self, *args):
+        return self.sock.setsockopt(*args)
+
+    def getpeername(self):
+        return self.sock.getpeername()
+
+    def getpeercert(self):
+        return self.sslObj.getpeercert()
+
+    def close(self):
+        self.sock.close()
+
+    def pumpIn(self):
+        """Returns False if the connection is closed by peer"""
+
+        while True:
+            try:
+                buf = self.sock.recv(_sslRecordSize)
+            except (BlockingIOError, InterruptedError):
+                return True
+            if len(buf) == 0:
+                return False
+            self.inBio.write(buf)
+
+    def pumpOut(self):
+        """Returns True if all the encrypted data is sent"""
+
+        self.outBuffer += self.outBio.read()
+        while len(self.outBuffer) > 0:
+            try:
+                sendLen = self.sock.send(self.outBuffer)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.outBuffer = self.outBuffer[sendLen:]
+        return True
+
+    def hasPendingOut(self):
+        return len(self.outBuffer) > 0 or self.outBio.pending > 0
+
+    def hasPendingIn(self):
+        """Returns True if there's received data not read, application data may come with the last handshake message"""
+        return self.inBio.pending > 0 or self.sslObj.pending() > 0
+
+
+class SnPeerIoWorkerPool:
+
+    """Peer sockets are spread across I/O worker processes. Every worker listens
+       on the peer port with SO_REUSEPORT, does SSL handshake, SSL I/O, framing
+       and compression for its sockets, and exchanges SnPeerIoWorkerMessage
+       frames with us over a non-blocking socket pair. Outgoing connections are
+       assigned to the workers by peer name hash. Incoming connections are
+       assigned by the kernel, peer name is not known before the SSL handshake
+       and SSL state can't be moved to another process.
+
+       connectFunc, recvFunc, errorFunc and gcCompleteFunc are called with
+       SnPeerWorkerSocket object in the same way as the objsocket callbacks.
+       A dead worker process is restarted, its sockets get errorFunc called."""
+
+    def __init__(self, workerFile, workerParam, workerNum, connectFunc, recvFunc, errorFunc, gcCompleteFunc):
+        self.workerFile = workerFile
+        self.workerParam = workerParam
+        self.connectFunc = connectFunc
+        self.recvFunc = recvFunc
+        self.errorFunc = errorFunc
+        self.gcCompleteFunc = gcCompleteFunc
+        self.disposeCompleteFunc = None
+        self.disposeTimer = None
+        self.workerList = [None] * workerNum
+        for i in range(0, workerNum):
+            self._startWorker(i)
+
+    def dispose(self, disposeCompleteFunc):
+        """The queued messages are sent before the pipe is closed, the worker process closes its
+           sockets and exits when the pipe is closed, disposeCompleteFunc is called after all the
+           worker processes exit, the ones that don't exit in time are terminated"""
+
+        self.disposeCompleteFunc = disposeCompleteFunc
+        for i in range(0, len(self.workerList)):
+            worker = self.workerList[i]
+            for sock in worker.sockDict.values():
+                sock.worker = None
+            worker.sockDict.clear()
+            worker.pipe.graceful_close()
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, worker.proc.pid, self._onWorkerExit, (i, worker.proc))
+        self.disposeTimer = GLib.timeout_add_seconds(_workerExitTimeout, self._onDisposeTimeout)
+
+    def connect(self, hostname, port, hostaddr=None, hint=False):
+        """hostname is resolved by the worker if hostaddr is None, hint is same as SnPeerClient.connect()"""
+        worker = self.workerList[SnUtil.getShardIndex(hostname, len(self.workerList))]
+        worker.pipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.CONNECT, 0, pickle.dumps((hostname, port, hostaddr, hint))))
+
+    def _startWorker(self, index):
+        mySock, workerSock = socket.socketpair()
+
+        workerParam = dict(self.workerParam)
+        workerParam["index"] = index
+        workerParam["pipeFd"] = workerSock.fileno()
+
+        worker = _PeerIoWorker()
+        try:
+            worker.proc = subprocess.Popen([self.workerFile, json.dumps(workerParam)], pass_fds=[workerSock.fileno()])
+        finally:
+            workerSock.close()
+        mySock.setblocking(False)
+        worker.pipe = objsocket(objsocket.SOCKTYPE_SOCKET, mySock, self._onPipeRecv, self._onPipeError, self._pipeGcComplete, raw=True)
+        worker.sockDict = dict()
+        self.workerList[index] = worker
+        logging.debug("SnPeerIoWorkerPool._startWorker: I/O worker %d started, pid %d", index, worker.proc.pid)
+
+    def _stopWorker(self, index):
+        worker = self.workerList[index]
+        self.workerList[index] = None
+
+        # the worker process is reaped when it exits, we don't wait for it
+        worker.pipe.close()
+        worker.proc.terminate()
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, worker.proc.pid, self._onWorkerExit, (index, worker.proc))
+
+        # sockets are closed with the worker
+        for sock in worker.sockDict.values():
+            sock.worker = None
+        worker.sockDict.clear()
+
+    def _onWorkerExit(self, pid, status, data):
+        index, proc = data
+        proc.returncode = status                # reaped by glib, subprocess must not wait for it again
+        logging.debug("SnPeerIoWorkerPool._onWorkerExit: I/O worker %d exited, pid %d, status %d", index, pid, status)
+
+        # we are disposing
+        if self.disposeCompleteFunc is not None:
+            if all(x.proc.returncode is not None for x in self.workerList):
+                if self.disposeTimer is not None:
+                    GLib.source_remove(self.disposeTimer)
+                    self.disposeTimer = None
+                self.disposeCompleteFunc()
+
+    def _onDisposeTimeout(self):
+        self.disposeTimer = None
+        for i in range(0, len(self.workerList)):
+            if self.workerList[i].proc.returncode is None:
+                logging.warning("SnPeerIoWorkerPool._onDisposeTimeout: I/O worker %d doesn't exit, terminate it", i)
+                self.workerList[i].proc.terminate()
+        return False
+
+    def _onPipeRecv(self, pipe, frame):
+        worker = self._getWorkerByPipe(pipe)
+        msgType, connId, payload = SnPeerIoWorkerMessage.unpack(frame)
+
+        if msgType == SnPeerIoWorkerMessage.CONNECTED:
+            peerName, peerAddr, isClient = pickle.loads(payload)
+            sock = SnPeerWorkerSocket(worker, connId, peerName, peerAddr, isClient)
+            worker.sockDict[connId] = sock
+            self.connectFunc(sock)
+            return
+
+        # socket is closed by us, the worker doesn't know it yet
+        sock = worker.sockDict.get(connId)
+        if sock is None:
+            return
+
+        if msgType == SnPeerIoWorkerMessage.RECV:
+            self.recvFunc(sock, pickle.loads(payload))
+        elif msgType == SnPeerIoWorkerMessage.ERROR:
+            del worker.sockDict[connId]
+            sock.worker = None
+            self.errorFunc(sock, Exception(payload.decode("utf-8")))
+        elif msgType == SnPeerIoWorkerMessage.GC_COMPLETE:
+            del worker.sockDict[connId]
+            sock.worker = None
+            self.gcCompleteFunc(sock)
+        else:
+            assert False
+
+    def _onPipeError(self, pipe, excObj):
+        index = self.workerList.index(self._getWorkerByPipe(pipe))
+        logging.error("SnPeerIoWorkerPool._onPipeError: I/O worker %d exited, %s", index, str(excObj))
+
+        sockList = list(self.workerList[index].sockDict.values())
+        self._stopWorker(index)
+        for sock in sockList:
+            self.errorFunc(sock, excObj)
+        self._startWorker(index)
+
+    def _pipeGcComplete(self, pipe):
+        """Graceful close on pipe is only done in disposing"""
+        pipe.close()
+
+    def _getWorkerByPipe(self, pipe):
+        for worker in self.workerList:
+            if worker is not None and worker.pipe == pipe:
+                return worker
+        assert False
+
+
+class SnPeerWorkerSocket:
+
+    """Peer socket in I/O worker process, it has the same interface as objsocket"""
+
+    def __init__(self, worker, connId, peerName, peerAddr, isClient):
+        self.worker = worker                # None after the socket is closed in the worker
+        self.connId = connId
+        self.peerName = peerName
+        self.peerAddr = peerAddr
+        self.isClient = isClient            # connection is initiated by us
+        self.gracefulClosing = False
+
+    def send(self, dataObj, conflateKey=None):
+        assert not self.gracefulClosing
+        if self.worker is not None:
+            if conflateKey is None:
+                frame = SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.SEND, self.connId, pickle.dumps(dataObj))
+            else:
+                frame = SnPeerIoWorkerMessage.packConflate(self.connId, conflateKey, pickle.dumps(dataObj))
+            self.worker.pipe.send(frame)
+
+    def enable_compress(self):
+        if self.worker is not None:
+            self.worker.pipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.COMPRESS, self.connId))
+
+    def graceful_close(self):
+        assert not self.gracefulClosing
+        self.gracefulClosing = True
+        if self.worker is not None:
+            self.worker.pipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.GRACEFUL_CLOSE, self.connId))
+
+    def is_graceful_closing(self):
+        return self.gracefulClosing
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.pipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.CLOSE, self.connId))
+            del self.worker.sockDict[self.connId]
+            self.worker = None
+
+
+class SnPeerIoWorkerMessage:
+
+    """Frame exchanged between main process and I/O worker process over a raw
+       objsocket, it is a fixed header (message type, connection id) followed by
+       the payload. DATA is the pickled object sent over the peer connection, it
+       is pickled and unpickled only in the main process.
+
+       Payload of the messages:
+           CONNECT        : main -> worker, pickled (hostname, port, hostaddr, hint)
+           SEND           : main -> worker, DATA
+           SEND_CONFLATE  : main -> worker, "!H" key length, pickled conflate key, DATA
+           COMPRESS       : main -> worker, empty
+           GRACEFUL_CLOSE : main -> worker, empty
+           CLOSE          : main -> worker, empty
+           CONNECTED      : worker -> main, pickled (peerName, peerAddr, isClient)
+           RECV           : worker -> main, DATA
+           ERROR          : worker -> main, error message in utf-8
+           GC_COMPLETE    : worker -> main, empty
+
+       Connection id is allocated by the worker process, messages of a closed
+       connection id are ignored."""
+
+    CONNECT = 1
+    SEND = 2
+    SEND_CONFLATE = 3
+    COMPRESS = 4
+    GRACEFUL_CLOSE = 5
+    CLOSE = 6
+    CONNECTED = 7
+    RECV = 8
+    ERROR = 9
+    GC_COMPLETE = 10
+
+    _headerFmt = "!BI"
+    _keyLenFmt = "!H"
+
+    @staticmethod
+    def pack(msgType, connId, payload=b''):
+        return struct.pack(SnPeerIoWorkerMessage._headerFmt, msgType, connId) + payload
+
+    @staticmethod
+    def packConflate(connId, conflateKey, data):
+        key = pickle.dumps(conflateKey)
+        return SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.SEND_CONFLATE, connId,
+                                          struct.pack(SnPeerIoWorkerMessage._keyLenFmt, len(key)) + key + data)
+
+    @staticmethod
+    def unpack(frame):
+        """Returns (msgType, connId, payload)"""
+        headerLen = struct.calcsize(SnPeerIoWorkerMessage._headerFmt)
+        msgType, connId = struct.unpack(SnPeerIoWorkerMessage._headerFmt, frame[:headerLen])
+        return (msgType, connId, frame[headerLen:])
+
+    @staticmethod
+    def unpackConflate(payload):
+        """Returns (key, data), key is the pickled conflate key, it is only used for comparing"""
+        keyLenLen = struct.calcsize(SnPeerIoWorkerMessage._keyLenFmt)
+        keyLen = struct.unpack(SnPeerIoWorkerMessage._keyLenFmt, payload[:keyLenLen])[0]
+        return (payload[keyLenLen:keyLenLen + keyLen], payload[keyLenLen + keyLen:])
+
 
 class _HandShaker:
 
+    """SSL handshake is done in the main loop if threadNum is 0. Otherwise the
+       expensive do_handshake() call is done in a thread pool, the main loop only
+       waits for socket events, and gets the SSL.Connection object back when the
+       handshake completes.
+
+       sslBackend "pyopenssl" gives SSL.Connection object, sslBackend "ssl" gives
+       SnSslObjectSocket object."""
+
     HANDSHAKE_NONE = 0
     HANDSHAKE_WANT_READ = 1
     HANDSHAKE_WANT_WRITE = 2
     HANDSHAKE_COMPLETE = 3
+    HANDSHAKE_IN_THREAD = 4
+
+    def __init__(self, certFile, privkeyFile, caCertFile, threadNum, sslBackend, handShakeCompleteFunc, handShakeErrorFunc):
+        assert sslBackend in ["pyopenssl", "ssl"]
 
-    def __init__(self, certFile, privkeyFile, caCertFile, handShakeCompleteFunc, handShakeErrorFunc):
         self.certFile = certFile
         self.privkeyFile = privkeyFile
         self.caCertFile = caCertFile
+        self.sslBackend = sslBackend
         self.handShakeCompleteFunc = handShakeCompleteFunc
         self.handShakeErrorFunc = handShakeErrorFunc
         self.sockDict = dict()
+        self.disposed = False
+
+        # ssl.SSLContext can be shared by all the connections
+        self.serverSslCtx = None
+        self.clientSslCtx = None
+        if self.sslBackend == "ssl":
+            self.serverSslCtx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.clientSslCtx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            self.clientSslCtx.check_hostname = False            # peer name is checked by ourself
+            for ctx in [self.serverSslCtx, self.clientSslCtx]:
+                ctx.verify_mode = ssl.CERT_REQUIRED
+                ctx.load_cert_chain(self.certFile, self.privkeyFile)
+                ctx.load_verify_locations(self.caCertFile)
+
+        self.threadPool = None
+        if threadNum > 0:
+            self.threadPool = concurrent.futures.ThreadPoolExecutor(threadNum)
 
     def dispose(self):
-        for sock in self.sockDict:
-            sock.close()
+        # don't wait for the threads, the socket in a thread is shut down so that the handshake
+        # fails fast, no thread should touch a closed socket, so it is closed when the thread returns
+        for sock, info in self.sockDict.items():
+            if info.state == _HandShaker.HANDSHAKE_IN_THREAD:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            else:
+                sock.close()
         self.sockDict.clear()
+        if self.threadPool is not None:
+            self.threadPool.shutdown(False)
+            self.threadPool = None
+        self.disposed = True
 
     def addSocket(self, sock, serverSide, hostname=None, port=None):
         info = _HandShakerConnInfo()
@@ -191,7 +585,16 @@ class _HandShaker:
             if cb_condition & _flagError:
                 raise _ConnException("Socket error, %s" % (SnUtil.cbConditionToStr(cb_condition)))
 
-            # HANDSHAKE_NONE
+            # HANDSHAKE_NONE, ssl backend
+            if info.state == _HandShaker.HANDSHAKE_NONE and self.sslBackend == "ssl":
+                info.spname = str(source.getpeername())
+                if info.serverSide:
+                    info.sslSock = SnSslObjectSocket(source, self.serverSslCtx, True)
+                else:
+                    info.sslSock = SnSslObjectSocket(source, self.clientSslCtx, False)
+                info.state = _HandShaker.HANDSHAKE_WANT_WRITE
+
+            # HANDSHAKE_NONE, pyopenssl backend
             if info.state == _HandShaker.HANDSHAKE_NONE:
                 ctx = SSL.Context(SSL.SSLv3_METHOD)
                 if info.serverSide:
@@ -214,18 +617,41 @@ class _HandShaker:
             # HANDSHAKE_WANT_READ & HANDSHAKE_WANT_WRITE
             if ((info.state == _HandShaker.HANDSHAKE_WANT_READ and cb_condition & GLib.IO_IN) or
                     (info.state == _HandShaker.HANDSHAKE_WANT_WRITE and cb_condition & GLib.IO_OUT)):
-                try:
-                    info.sslSock.do_handshake()
-                    info.state = _HandShaker.HANDSHAKE_COMPLETE
-                except SSL.WantReadError:
-                    info.state = _HandShaker.HANDSHAKE_WANT_READ
-                except SSL.WantWriteError:
-                    info.state = _HandShaker.HANDSHAKE_WANT_WRITE
-                except SSL.Error as e:
-                    raise _ConnException("Handshake failed, %s" % (_handshake_info_to_str(info)), e)
-
-            # HANDSHAKE_COMPLETE
-            if info.state == _HandShaker.HANDSHAKE_COMPLETE:
+                if self.threadPool is not None:
+                    # socket is not watched until the thread returns
+                    info.state = _HandShaker.HANDSHAKE_IN_THREAD
+                    future = self.threadPool.submit(_do_handshake, info)
+                    future.add_done_callback(lambda f: GLib.idle_add(self._onThreadReturn, source, f))
+                    return False
+                info.state = _do_handshake(info)
+        except _ConnException as e:
+            self._handshakeError(source, info, e)
+            return False
+
+        return self._handshakeNext(source, info)
+
+    def _onThreadReturn(self, source, future):
+        # we are disposed
+        if self.disposed:
+            source.close()
+            return False
+
+        info = self.sockDict[source]
+        assert info.state == _HandShaker.HANDSHAKE_IN_THREAD
+
+        try:
+            info.state = future.result()
+        except _ConnException as e:
+            self._handshakeError(source, info, e)
+            return False
+
+        self._handshakeNext(source, info)
+        return False
+
+    def _handshakeNext(self, source, info):
+        # HANDSHAKE_COMPLETE
+        if info.state == _HandShaker.HANDSHAKE_COMPLETE:
+            try:
                 # check peer name
                 peerName = SnUtil.getSslSocketPeerName(info.sslSock)
                 if info.serverSide:
@@ -234,17 +660,12 @@ class _HandShaker:
                 else:
                     if peerName is None or peerName != info.hostname:
                         raise _ConnException("Hostname incorrect, %s, %s" % (_handshake_info_to_str(info), peerName))
-
-                # give socket to handShakeCompleteFunc
-                self.handShakeCompleteFunc(source, self.sockDict[source].sslSock, self.sockDict[source].hostname, self.sockDict[source].port)
-                del self.sockDict[source]
+            except _ConnException as e:
+                self._handshakeError(source, info, e)
                 return False
-        except _ConnException as e:
-            if not e.hasExcObj:
-                logging.debug("_HandShaker._onEvent: %s, %s", e.message, _handshake_info_to_str(info))
-            else:
-                logging.debug("_HandShaker._onEvent: %s, %s, %s, %s", e.message, _handshake_info_to_str(info), e.excName, e.excMessage)
-            self.handShakeErrorFunc(source, self.sockDict[source].hostname, self.sockDict[source].port)
+
+            # give socket to handShakeCompleteFunc
+            self.handShakeCompleteFunc(source, info.sslSock, info.hostname, info.port)
             del self.sockDict[source]
             return False
 
@@ -258,6 +679,55 @@ class _HandShaker:
 
         return False
 
+    def _handshakeError(self, source, info, e):
+        if not e.hasExcObj:
+            logging.debug("_HandShaker._onEvent: %s, %s", e.message, _handshake_info_to_str(info))
+        else:
+            logging.debug("_HandShaker._onEvent: %s, %s, %s, %s", e.message, _handshake_info_to_str(info), e.excName, e.excMessage)
+        self.handShakeErrorFunc(source, info.hostname, info.port)
+        del self.sockDict[source]
+
+
+def _do_handshake(info):
+    """Returns the new handshake state, may be called in a worker thread"""
+
+    if isinstance(info.sslSock, SnSslObjectSocket):
+        return _do_handshake_ssl_object(info)
+
+    try:
+        info.sslSock.do_handshake()
+        return _HandShaker.HANDSHAKE_COMPLETE
+    except SSL.WantReadError:
+        return _HandShaker.HANDSHAKE_WANT_READ
+    except SSL.WantWriteError:
+        return _HandShaker.HANDSHAKE_WANT_WRITE
+    except SSL.Error as e:
+        raise _ConnException("Handshake failed, %s" % (_handshake_info_to_str(info)), e)
+
+
+def _do_handshake_ssl_object(info):
+    sslSock = info.sslSock
+    complete = False
+    try:
+        if not sslSock.pumpIn():
+            raise _ConnException("Handshake failed, connection closed by peer, %s" % (_handshake_info_to_str(info)))
+        try:
+            sslSock.sslObj.do_handshake()
+            complete = True
+        except ssl.SSLWantReadError:
+            pass
+        if not sslSock.pumpOut():
+            return _HandShaker.HANDSHAKE_WANT_WRITE
+    except (socket.error, ssl.SSLError) as e:
+        raise _ConnException("Handshake failed, %s" % (_handshake_info_to_str(info)), e)
+
+    # application data received with the last handshake message is left in sslSock,
+    # objsocket reads it when it is created, see SnSslObjectSocket.hasPendingIn()
+    if complete:
+        return _HandShaker.HANDSHAKE_COMPLETE
+    else:
+        return _HandShaker.HANDSHAKE_WANT_READ
+
 
 def _sslVerifyDummy(conn, cert, errnum, depth, ok):
     return ok
@@ -268,11 +738,18 @@ class _ConnException(Exception):
     def __init__(self, message, excObj=None):
         super(_ConnException, self).__init__(message)
 
+        self.message = message
         self.hasExcObj = False
         if excObj is not None:
             self.hasExcObj = True
             self.excName = excObj.__class__
-            self.excMessage = excObj.message
+            self.excMessage = str(excObj)
+
+
+class _PeerIoWorker:
+    proc = None                    # obj, subprocess.Popen
+    pipe = None                    # obj, objsocket over socket pair, raw mode
+    sockDict = None                # dict<int, SnPeerWorkerSocket>
 
 
 class _HandShakerConnInfo:
@@ -293,6 +770,8 @@ def _handshake_state_to_str(handshake_state):
         return "WANT_WRITE"
     elif handshake_state == _HandShaker.HANDSHAKE_COMPLETE:
         return "COMPLETE"
+    elif handshake_state == _HandShaker.HANDSHAKE_IN_THREAD:
+        return "IN_THREAD"
     else:
         assert False
 
@@ -304,3 +783,7 @@ def _handshake_info_to_str(info):
         return "%s, %d" % (info.hostname, info.port)
 
 _flagError = GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL
+
+_sslRecordSize = 16384
+
+_workerExitTimeout = 10
@@ -3,6 +3,7 @@
 
 import dbus
 import dbus.service
+from gi.repository import GLib
 from sn_manager_local import SnLocalManager
 from sn_manager_peer import SnPeerManager
 
@@ -19,6 +20,8 @@ from sn_manager_peer import SnPeerManager
 # str                 GetWorkState()
 # array<peerId:int>   GetPeerList()
 # peerId:int          GetPeer(peerName:str)
+# dict<peerName:str,errorMessage:str>  DoPowerOperationMulti(opName:str, peerNameList:array<str>)
+#                     peer operations are done in parallel, errorMessage is "" for success
 #
 # Signals:
 # WorkStateChanged(newWorkState:str)
@@ -36,6 +39,12 @@ from sn_manager_peer import SnPeerManager
 # Signals:
 # PowerStateChanged(newPowerState:str)
 #
+# Signals are emitted when the state is settled, the timer is restarted
+# on every change, so state changes less than COALESCE_TIMEOUT apart are
+# merged into one signal, no signal if the state changes back.
+#
+
+COALESCE_TIMEOUT = 500                  # ms
 
 
 class DbusMainObject(dbus.service.Object):
@@ -45,6 +54,10 @@ class DbusMainObject(dbus.service.Object):
         self.peerList = []
         self.moduleList = []
 
+        # coalesce work state change
+        self.lastWorkState = self._getWorkStateStr()
+        self.workStateTimer = None
+
         # initialize peer list
         i = 0
         for pn in self.param.peerManager.getPeerNameList():
@@ -57,17 +70,26 @@ class DbusMainObject(dbus.service.Object):
         dbus.service.Object.__init__(self, bus_name, '/org/fpemud/SelfNet')
 
     def release(self):
+        if self.workStateTimer is not None:
+            GLib.source_remove(self.workStateTimer)
+            self.workStateTimer = None
+        for po in self.peerList:
+            po.release()
         self.remove_from_connection()
 
+    def onWorkStateChange(self):
+        if self.workStateTimer is not None:
+            GLib.source_remove(self.workStateTimer)
+        self.workStateTimer = GLib.timeout_add(COALESCE_TIMEOUT, self._onWorkStateTimeout)
+
+    def onPeerPowerStateChange(self, peerName):
+        for po in self.peerList:
+            if peerName == po.peerName:
+                po.onPowerStateChange()
+
     @dbus.service.method('org.fpemud.SelfNet', in_signature='', out_signature='s')
     def GetWorkState(self):
-        ws = self.param.localManager.getWorkState()
-        if ws == SnLocalManager.WORK_STATE_IDLE:
-            return "idle"
-        elif ws == SnLocalManager.WORK_STATE_WORKING:
-            return "working"
-        else:
-            assert False
+        return self._getWorkStateStr()
 
     @dbus.service.method('org.fpemud.SelfNet', in_signature='', out_signature='ai')
     def GetPeerList(self):
@@ -83,6 +105,17 @@ class DbusMainObject(dbus.service.Object):
                 return po.peerId
         return -1
 
+    @dbus.service.method('org.fpemud.SelfNet', sender_keyword='sender', in_signature='sas', out_signature='a{ss}', async_callbacks=('reply_handler', 'error_handler'))
+    def DoPowerOperationMulti(self, opName, peerNameList, reply_handler, error_handler, sender=None):
+        if opName not in ["poweron", "poweroff", "reboot", "wakeup", "suspend", "hibernate", "hybrid-sleep"]:
+            error_handler(Exception("invalid power operation name \"%s\"" % (opName)))
+            return
+
+        def _complete(resultDict):
+            reply_handler(dict((k, v if v is not None else "") for k, v in resultDict.items()))
+
+        self.param.peerManager.doPeerPowerOperationMultiAsync([str(x) for x in peerNameList], str(opName), _complete)
+
     @dbus.service.signal('org.fpemud.SelfNet', signature='s')
     def WorkStateChanged(self, newWorkState):
         pass
@@ -91,6 +124,23 @@ class DbusMainObject(dbus.service.Object):
     def DebugGetModuleInfo(self):
         return self.param.localManager.debugGetModuleInfo()
 
+    def _onWorkStateTimeout(self):
+        self.workStateTimer = None
+        ws = self._getWorkStateStr()
+        if ws != self.lastWorkState:
+            self.lastWorkState = ws
+            self.WorkStateChanged(ws)
+        return False
+
+    def _getWorkStateStr(self):
+        ws = self.param.localManager.getWorkState()
+        if ws == SnLocalManager.WORK_STATE_IDLE:
+            return "idle"
+        elif ws == SnLocalManager.WORK_STATE_WORKING:
+            return "working"
+        else:
+            assert False
+
 
 class DbusPeerObject(dbus.service.Object):
 
@@ -99,30 +149,32 @@ class DbusPeerObject(dbus.service.Object):
         self.peerId = peerId
         self.peerName = peerName
 
+        # coalesce power state change
+        self.lastPowerState = self._getPowerStateStr()
+        self.powerStateTimer = None
+
         # register dbus object path
         bus_name = dbus.service.BusName('org.fpemud.SelfNet', bus=dbus.SystemBus())
         dbus.service.Object.__init__(self, bus_name, '/org/fpemud/SelfNet/Peers/%d' % (self.peerId))
 
     def release(self):
+        if self.powerStateTimer is not None:
+            GLib.source_remove(self.powerStateTimer)
+            self.powerStateTimer = None
         self.remove_from_connection()
 
+    def onPowerStateChange(self):
+        if self.powerStateTimer is not None:
+            GLib.source_remove(self.powerStateTimer)
+        self.powerStateTimer = GLib.timeout_add(COALESCE_TIMEOUT, self._onPowerStateTimeout)
+
     @dbus.service.method('org.fpemud.SelfNet.Peer', sender_keyword='sender', in_signature='', out_signature='s')
     def GetName(self, sender=None):
         return self.peerName
 
     @dbus.service.method('org.fpemud.SelfNet.Peer', sender_keyword='sender', in_signature='', out_signature='s')
     def GetPowerState(self, sender=None):
-        powerStateDict = {
-            SnPeerManager.POWER_STATE_UNKNOWN: "unknown",
-            SnPeerManager.POWER_STATE_POWEROFF: "poweroff",
-            SnPeerManager.POWER_STATE_REBOOTING: "rebooting",
-            SnPeerManager.POWER_STATE_SUSPEND: "suspend",
-            SnPeerManager.POWER_STATE_HIBERNATE: "hibernate",
-            SnPeerManager.POWER_STATE_HYBRID_SLEEP: "hybrid-sleep",
-            SnPeerManager.POWER_STATE_RUNNING: "running",
-        }
-        powerState = self.param.peerManager.getPeerPowerState(self.peerName)
-        return powerStateDict[powerState]
+        return self._getPowerStateStr()
 
     @dbus.service.method('org.fpemud.SelfNet.Peer', sender_keyword='sender', in_signature='s', out_signature='', async_callbacks=('reply_handler', 'error_handler'))
     def DoPowerOperation(self, opName, reply_handler, error_handler, sender=None):
@@ -134,3 +186,24 @@ class DbusPeerObject(dbus.service.Object):
     @dbus.service.signal('org.fpemud.SelfNet.Peer', signature='s')
     def PowerStateChanged(self, newPowerState):
         pass
+
+    def _onPowerStateTimeout(self):
+        self.powerStateTimer = None
+        ps = self._getPowerStateStr()
+        if ps != self.lastPowerState:
+            self.lastPowerState = ps
+            self.PowerStateChanged(ps)
+        return False
+
+    def _getPowerStateStr(self):
+        powerStateDict = {
+            SnPeerManager.POWER_STATE_UNKNOWN: "unknown",
+            SnPeerManager.POWER_STATE_POWEROFF: "poweroff",
+            SnPeerManager.POWER_STATE_REBOOTING: "rebooting",
+            SnPeerManager.POWER_STATE_SUSPEND: "suspend",
+            SnPeerManager.POWER_STATE_HIBERNATE: "hibernate",
+            SnPeerManager.POWER_STATE_HYBRID_SLEEP: "hybrid-sleep",
+            SnPeerManager.POWER_STATE_RUNNING: "running",
+        }
+        powerState = self.param.peerManager.getPeerPowerState(self.peerName)
+        return powerStateDict[powerState]
@@ -3,6 +3,8 @@
 
 import os
 import re
+import json
+import hashlib
 import logging
 import xml.sax.handler
 import socket
@@ -12,6 +14,7 @@ from sn_util import SnUtil
 
 class SnVersion:
     version = None                  # str
+    helloSupported = False          # bool, sender accepts SnSysPacketHello, not set by legacy daemon
 
     def __eq__(self, other):
         return isinstance(other, self.__class__) and self.version == other.version
@@ -24,16 +27,17 @@ class SnVersion:
 
 
 class SnCfgSerializationObject:
-    strHostsXml = None              # str
+    digest = None                   # str, sha256 of the parsed host configuration
+    strHostsXml = None              # str, full hosts file content, only used for mismatch diagnosing, can be None
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.strHostsXml == other.strHostsXml
+        return isinstance(other, self.__class__) and self.digest == other.digest
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.strHostsXml)
+        return hash(self.digest)
 
 
 class SnCfgHostInfo:
@@ -41,6 +45,8 @@ class SnCfgHostInfo:
     isNexus = None                  # bool
     supportPoweron = None           # bool
     supportWakeup = None            # bool
+    macAddr = None                  # str, needed by wake-on-lan, can be None
+    broadcastAddr = None            # str, wake-on-lan packets are sent to this address, default is "255.255.255.255"
 
 
 class SnCfgModuleInfo:
@@ -68,11 +74,13 @@ class SnConfigManager:
         self.param = param
         self.cfgGlobal = None
         self.hostDict = None
+        self.hostsDigest = None
+        self.strHostsXml = None
         self.moduleDict = None
 
         self._checkCertFiles()
         self._parseConfFile()       # fill self.cfgGlobal
-        self._parseHostsFile()      # fill self.hostDict
+        self._parseHostsFile()      # fill self.hostDict, self.hostsDigest, self.strHostsXml
         self._parseModulesFile()    # fill self.moduleDict
 
         logging.debug("SnConfigManager.__init__: End")
@@ -83,19 +91,73 @@ class SnConfigManager:
         logging.debug("SnConfigManager.dispose: End")
         return
 
+    def reloadModuleInfo(self):
+        """Re-read modules file, the old module info is kept if the file is invalid"""
+
+        logging.debug("SnConfigManager.reloadModuleInfo: Start")
+
+        oldModuleDict = self.moduleDict
+        try:
+            self._parseModulesFile()
+        except:
+            self.moduleDict = oldModuleDict
+            raise
+
+        logging.debug("SnConfigManager.reloadModuleInfo: End")
+
     def getVersion(self):
         ret = SnVersion()
         ret.version = "1.0.0"
+        ret.helloSupported = True
         return ret
 
-    def getCfgSerializationObject(self):
+    def getCfgSerializationObject(self, withDocument=False):
         ret = SnCfgSerializationObject()
-        ret.strHostsXml = SnUtil.readFile(self.param.hostsFile)
+        ret.digest = self.hostsDigest
+        if withDocument:
+            ret.strHostsXml = self.strHostsXml
         return ret
 
     def getPeerProbeInterval(self):
         return self.cfgGlobal.peerProbeInterval
 
+    def getPeerKeepaliveInterval(self):
+        return self.cfgGlobal.peerKeepaliveInterval
+
+    def getPeerKeepaliveMiss(self):
+        return self.cfgGlobal.peerKeepaliveMiss
+
+    def getHandshakeThreadNum(self):
+        return self.cfgGlobal.handshakeThreadNum
+
+    def getPeerSslBackend(self):
+        return self.cfgGlobal.peerSslBackend
+
+    def getTopology(self):
+        return self.cfgGlobal.topology
+
+    def getDirectLinkThreshold(self):
+        return self.cfgGlobal.directLinkThreshold
+
+    def getNexusHostName(self):
+        """Returns None if there's no nexus machine"""
+        for hostName, hostInfo in self.hostDict.items():
+            if hostInfo.isNexus:
+                return hostName
+        return None
+
+    def getPeerConnectMode(self):
+        return self.cfgGlobal.peerConnectMode
+
+    def getPeerIdleTimeout(self):
+        return self.cfgGlobal.peerIdleTimeout
+
+    def getPeerReconnectGrace(self):
+        return self.cfgGlobal.peerReconnectGrace
+
+    def getPeerIoWorkerNum(self):
+        return self.cfgGlobal.peerIoWorkerNum
+
     def getUserBlackList(self):
         return self.cfgGlobal.userBlackList
 
@@ -114,6 +176,14 @@ class SnConfigManager:
     def getModuleInfo(self, moduleName):
         return self.moduleDict[moduleName]
 
+    @staticmethod
+    def readHostNameList(hostsFile):
+        """Get host name list from hosts file without any validation, for command line tools"""
+
+        hostDict = dict()
+        xml.sax.parse(hostsFile, _HostFileXmlHandler(hostDict))
+        return sorted(hostDict.keys())
+
     def _checkCertFiles(self):
         # check CA certificate
         with open(self.param.caCertFile, 'r') as f:
@@ -152,14 +222,37 @@ class SnConfigManager:
             raise Exception("Invalid cfgGlobal.peerProbeInterval")
         if self.cfgGlobal.peerKeepaliveInterval < 1:
             raise Exception("Invalid cfgGlobal.peerKeepaliveInterval")
+        if self.cfgGlobal.peerKeepaliveMiss < 1:
+            raise Exception("Invalid cfgGlobal.peerKeepaliveMiss")
+        if self.cfgGlobal.handshakeThreadNum < 0:
+            raise Exception("Invalid cfgGlobal.handshakeThreadNum")
+        if self.cfgGlobal.peerSslBackend not in ["pyopenssl", "ssl"]:
+            raise Exception("Invalid cfgGlobal.peerSslBackend")
+        if self.cfgGlobal.topology not in ["mesh", "star"]:
+            raise Exception("Invalid cfgGlobal.topology")
+        if self.cfgGlobal.directLinkThreshold < 0:
+            raise Exception("Invalid cfgGlobal.directLinkThreshold")
+        if self.cfgGlobal.peerConnectMode not in ["always", "on-demand"]:
+            raise Exception("Invalid cfgGlobal.peerConnectMode")
+        if self.cfgGlobal.peerIdleTimeout <= 0:
+            raise Exception("Invalid cfgGlobal.peerIdleTimeout")
+        if self.cfgGlobal.peerReconnectGrace < 0:
+            raise Exception("Invalid cfgGlobal.peerReconnectGrace")
+        if self.cfgGlobal.peerIoWorkerNum < 0:
+            raise Exception("Invalid cfgGlobal.peerIoWorkerNum")
 
     def _parseHostsFile(self):
         # set default value
         self.hostDict = dict()
 
         # parse file
+        self.strHostsXml = SnUtil.readFile(self.param.hostsFile)
         h = _HostFileXmlHandler(self.hostDict)
-        xml.sax.parse(self.param.hostsFile, h)
+        xml.sax.parseString(self.strHostsXml.encode("utf-8"), h)
+
+        # canonical digest, independent of formatting, comments and element order
+        canonical = [[k, vars(self.hostDict[k])] for k in sorted(self.hostDict.keys())]
+        self.hostsDigest = hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
 
         # check parse result
         if "localhost" in self.hostDict:
@@ -168,9 +261,18 @@ class SnConfigManager:
         if socket.gethostname() not in self.hostDict:
             raise Exception("No name for localhost in hosts file")
 
-        if list(self.hostDict.values()).count(lambda x: x.isNexus) > 1:
+        if len([x for x in self.hostDict.values() if x.isNexus]) > 1:
             raise Exception("There should be only zero or one nexus machine")
 
+        if self.cfgGlobal.topology == "star" and self.getNexusHostName() is None:
+            raise Exception("There should be a nexus machine for star topology")
+
+        for hostName, hostInfo in self.hostDict.items():
+            if (hostInfo.supportPoweron or hostInfo.supportWakeup) and hostInfo.macAddr is None:
+                raise Exception("MAC address is needed for host \"%s\" to support poweron or wakeup" % (hostName))
+            if hostInfo.macAddr is not None:
+                SnUtil.getWolMagicPacket(hostInfo.macAddr)
+
         if self.hostDict[socket.gethostname()].isNexus:
             if not os.path.exists(self.param.caPrivkeyFile):
                 raise Exception("CA private key file \"%s\" should exist on nexus machine" % (self.param.caPrivkeyFile))
@@ -237,6 +339,15 @@ class SnConfigManager:
 class _SnCfgGlobal:
     peerProbeInterval = None        # int, default is "1s"
     peerKeepaliveInterval = None    # int, default is "1s"
+    peerKeepaliveMiss = None        # int, default is 5, peer is considered dead after so many keepalive intervals without any packet
+    handshakeThreadNum = None       # int, default is 0, do handshake in main loop
+    peerSslBackend = None           # str, "pyopenssl" "ssl", default is "pyopenssl"
+    topology = None                 # str, "mesh" "star", default is "mesh"
+    directLinkThreshold = None      # int, default is 1000, relayed data packets per minute to set up a direct link in star topology, 0 means never
+    peerConnectMode = None          # str, "always" "on-demand", default is "always"
+    peerIdleTimeout = None          # int, default is 300, idle connection is closed after so many seconds in on-demand mode
+    peerReconnectGrace = None       # int, default is 10, module objects of a lost peer are kept for so many seconds, 0 means disabled
+    peerIoWorkerNum = None          # int, default is 0, peer sockets are in main process
     userBlackList = None            # list<str>
 
 
@@ -247,6 +358,15 @@ class _ConfFileXmlHandler(xml.sax.handler.ContentHandler):
     IN_PEER_KEEPALIVE_INTERVAL = 3
     IN_USER_BLACKLIST = 4
     IN_USER_BLACKLIST_USER = 5
+    IN_HANDSHAKE_THREAD_NUM = 6
+    IN_PEER_KEEPALIVE_MISS = 7
+    IN_PEER_SSL_BACKEND = 8
+    IN_TOPOLOGY = 9
+    IN_DIRECT_LINK_THRESHOLD = 10
+    IN_PEER_CONNECT_MODE = 11
+    IN_PEER_IDLE_TIMEOUT = 12
+    IN_PEER_RECONNECT_GRACE = 13
+    IN_PEER_IO_WORKER_NUM = 14
 
     def __init__(self, cfgGlobal):
         xml.sax.handler.ContentHandler.__init__(self)
@@ -260,6 +380,24 @@ class _ConfFileXmlHandler(xml.sax.handler.ContentHandler):
             self.state = self.IN_PEER_PROBE_INTERVAL
         elif name == "peer-keepalive-interval" and self.state == self.IN_ROOT:
             self.state = self.IN_PEER_KEEPALIVE_INTERVAL
+        elif name == "peer-keepalive-miss" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_KEEPALIVE_MISS
+        elif name == "handshake-thread-num" and self.state == self.IN_ROOT:
+            self.state = self.IN_HANDSHAKE_THREAD_NUM
+        elif name == "peer-ssl-backend" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_SSL_BACKEND
+        elif name == "topology" and self.state == self.IN_ROOT:
+            self.state = self.IN_TOPOLOGY
+        elif name == "direct-link-threshold" and self.state == self.IN_ROOT:
+            self.state = self.IN_DIRECT_LINK_THRESHOLD
+        elif name == "peer-connect-mode" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_CONNECT_MODE
+        elif name == "peer-idle-timeout" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_IDLE_TIMEOUT
+        elif name == "peer-reconnect-grace" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_RECONNECT_GRACE
+        elif name == "peer-io-worker-num" and self.state == self.IN_ROOT:
+            self.state = self.IN_PEER_IO_WORKER_NUM
         elif name == "user-black-list" and self.state == self.IN_ROOT:
             self.state = self.IN_USER_BLACKLIST
         elif name == "user" and self.state == self.IN_USER_BLACKLIST:
@@ -274,6 +412,24 @@ class _ConfFileXmlHandler(xml.sax.handler.ContentHandler):
             self.state = self.IN_ROOT
         elif name == "peer-keepalive-interval" and self.state == self.IN_PEER_KEEPALIVE_INTERVAL:
             self.state = self.IN_ROOT
+        elif name == "peer-keepalive-miss" and self.state == self.IN_PEER_KEEPALIVE_MISS:
+            self.state = self.IN_ROOT
+        elif name == "handshake-thread-num" and self.state == self.IN_HANDSHAKE_THREAD_NUM:
+            self.state = self.IN_ROOT
+        elif name == "peer-ssl-backend" and self.state == self.IN_PEER_SSL_BACKEND:
+            self.state = self.IN_ROOT
+        elif name == "topology" and self.state == self.IN_TOPOLOGY:
+            self.state = self.IN_ROOT
+        elif name == "direct-link-threshold" and self.state == self.IN_DIRECT_LINK_THRESHOLD:
+            self.state = self.IN_ROOT
+        elif name == "peer-connect-mode" and self.state == self.IN_PEER_CONNECT_MODE:
+            self.state = self.IN_ROOT
+        elif name == "peer-idle-timeout" and self.state == self.IN_PEER_IDLE_TIMEOUT:
+            self.state = self.IN_ROOT
+        elif name == "peer-reconnect-grace" and self.state == self.IN_PEER_RECONNECT_GRACE:
+            self.state = self.IN_ROOT
+        elif name == "peer-io-worker-num" and self.state == self.IN_PEER_IO_WORKER_NUM:
+            self.state = self.IN_ROOT
         elif name == "user-blacklist" and self.state == self.IN_USER_BLACKLIST:
             self.state = self.IN_ROOT
         elif name == "user" and self.state == self.IN_USER_BLACKLIST_USER:
@@ -286,6 +442,24 @@ class _ConfFileXmlHandler(xml.sax.handler.ContentHandler):
             self.cfgGlobal.peerProbeInterval = int(content)
         elif self.state == self.IN_PEER_KEEPALIVE_INTERVAL:
             self.cfgGlobal.peerKeepaliveInterval = int(content)
+        elif self.state == self.IN_PEER_KEEPALIVE_MISS:
+            self.cfgGlobal.peerKeepaliveMiss = int(content)
+        elif self.state == self.IN_HANDSHAKE_THREAD_NUM:
+            self.cfgGlobal.handshakeThreadNum = int(content)
+        elif self.state == self.IN_PEER_SSL_BACKEND:
+            self.cfgGlobal.peerSslBackend = content
+        elif self.state == self.IN_TOPOLOGY:
+            self.cfgGlobal.topology = content
+        elif self.state == self.IN_DIRECT_LINK_THRESHOLD:
+            self.cfgGlobal.directLinkThreshold = int(content)
+        elif self.state == self.IN_PEER_CONNECT_MODE:
+            self.cfgGlobal.peerConnectMode = content
+        elif self.state == self.IN_PEER_IDLE_TIMEOUT:
+            self.cfgGlobal.peerIdleTimeout = int(content)
+        elif self.state == self.IN_PEER_RECONNECT_GRACE:
+            self.cfgGlobal.peerReconnectGrace = int(content)
+        elif self.state == self.IN_PEER_IO_WORKER_NUM:
+            self.cfgGlobal.peerIoWorkerNum = int(content)
         elif self.state == self.IN_USER_BLACKLIST_USER:
             self.cfgGlobal.userBlackList.append(content)
         else:
@@ -300,6 +474,8 @@ class _HostFileXmlHandler(xml.sax.handler.ContentHandler):
     IN_HOST_NEXUS = 4
     IN_HOST_SUPPORT_POWERON = 5
     IN_HOST_SUPPORT_WAKEUP = 6
+    IN_HOST_MAC_ADDRESS = 7
+    IN_HOST_BROADCAST_ADDRESS = 8
 
     def __init__(self, hostDict):
         xml.sax.handler.ContentHandler.__init__(self)
@@ -326,6 +502,10 @@ class _HostFileXmlHandler(xml.sax.handler.ContentHandler):
         elif name == "support-wakeup" and self.state == self.IN_HOST:
             self.state = self.IN_HOST_SUPPORT_WAKEUP
             self.curHostInfo.supportWakeup = True
+        elif name == "mac-address" and self.state == self.IN_HOST:
+            self.state = self.IN_HOST_MAC_ADDRESS
+        elif name == "broadcast-address" and self.state == self.IN_HOST:
+            self.state = self.IN_HOST_BROADCAST_ADDRESS
         else:
             raise Exception("Failed to parse hosts file")
 
@@ -345,12 +525,20 @@ class _HostFileXmlHandler(xml.sax.handler.ContentHandler):
             self.state = self.IN_HOST
         elif name == "support-wakeup" and self.state == self.IN_HOST_SUPPORT_WAKEUP:
             self.state = self.IN_HOST
+        elif name == "mac-address" and self.state == self.IN_HOST_MAC_ADDRESS:
+            self.state = self.IN_HOST
+        elif name == "broadcast-address" and self.state == self.IN_HOST_BROADCAST_ADDRESS:
+            self.state = self.IN_HOST
         else:
             raise Exception("Failed to parse hosts file")
 
     def characters(self, content):
         if self.state == self.IN_HOST_PORT:
             self.curHostInfo.port = int(content)
+        elif self.state == self.IN_HOST_MAC_ADDRESS:
+            self.curHostInfo.macAddr = content
+        elif self.state == self.IN_HOST_BROADCAST_ADDRESS:
+            self.curHostInfo.broadcastAddr = content
         else:
             pass
 
@@ -398,6 +586,15 @@ def _newSnCfgGlobal():
     cfgGlobal = _SnCfgGlobal()
     cfgGlobal.peerProbeInterval = 1
     cfgGlobal.peerKeepaliveInterval = 1
+    cfgGlobal.peerKeepaliveMiss = 5
+    cfgGlobal.handshakeThreadNum = 0
+    cfgGlobal.peerSslBackend = "pyopenssl"
+    cfgGlobal.topology = "mesh"
+    cfgGlobal.directLinkThreshold = 1000
+    cfgGlobal.peerConnectMode = "always"
+    cfgGlobal.peerIdleTimeout = 300
+    cfgGlobal.peerReconnectGrace = 10
+    cfgGlobal.peerIoWorkerNum = 0
     cfgGlobal.userBlackList = []
     return cfgGlobal
 
@@ -408,8 +605,10 @@ def _newSnCfgHostInfo():
     curHostInfo = SnCfgHostInfo()
     curHostInfo.port = 2107
     curHostInfo.isNexus = False
-    curHostInfo.supportWakeOnLan = False
-    curHostInfo.supportWakeOnWlan = False
+    curHostInfo.supportPoweron = False
+    curHostInfo.supportWakeup = False
+    curHostInfo.macAddr = None
+    curHostInfo.broadcastAddr = "255.255.255.255"
     return curHostInfo
 
 
@@ -104,40 +104,137 @@ from sn_module import SnRejectException
 
 class SnSysInfo:
 
-    def __init__(self):
-        self.userList = None                # list<SnSysInfoUser>
-        self.moduleList = None              # list<SnSysInfoModule>
-
-
-class SnSysInfoUser:
+    """Module availability is encoded as module list + user list + bitmap, the
+       size does not grow with users * modules"""
 
     def __init__(self):
-        self.userName = None                # str
+        self.version = None                 # int, increased when user list or module list changes
+        self.userList = None                # list<str>
+        self.moduleList = None              # list<str>
+        self.moduleUserBitmap = None        # list<int>, one for each module in moduleList, bit N is set if the
+                                            # module is available for userList[N], always 0 for sys module
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.userName == other.userName
+        """version is not compared"""
+        return (isinstance(other, self.__class__) and self.userList == other.userList and
+                self.moduleList == other.moduleList and self.moduleUserBitmap == other.moduleUserBitmap)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(self.userName)
+        return hash(tuple(self.moduleList))
+
+    def hasModule(self, userName, moduleName):
+        try:
+            i = self.moduleList.index(moduleName)
+        except ValueError:
+            return False
+
+        if userName is None:
+            return moduleName.startswith("sys-")
+        try:
+            return bool(self.moduleUserBitmap[i] & (1 << self.userList.index(userName)))
+        except ValueError:
+            return False
+
+    def getModuleTupleList(self):
+        """Returns list<(moduleName, userName)>, userName is None for sys module"""
+
+        ret = []
+        for i in range(0, len(self.moduleList)):
+            if self.moduleList[i].startswith("sys-"):
+                ret.append((self.moduleList[i], None))
+            else:
+                for j in range(0, len(self.userList)):
+                    if self.moduleUserBitmap[i] & (1 << j):
+                        ret.append((self.moduleList[i], self.userList[j]))
+        return ret
+
+    @staticmethod
+    def fromModuleTupleList(version, userList, moduleTupleList):
+        ret = SnSysInfo()
+        ret.version = version
+        ret.userList = list(userList)
+        ret.moduleList = []
+        ret.moduleUserBitmap = []
+        for moduleName, userName in moduleTupleList:
+            if moduleName not in ret.moduleList:
+                ret.moduleList.append(moduleName)
+                ret.moduleUserBitmap.append(0)
+            if userName is not None:
+                ret.moduleUserBitmap[ret.moduleList.index(moduleName)] |= 1 << ret.userList.index(userName)
+        return ret
+
+    def isLegacy(self):
+        """SnSysInfo sent by legacy daemon has SnSysInfoUser and SnSysInfoModule lists, and no bitmap"""
+        return getattr(self, "moduleUserBitmap", None) is None
+
+    def toLegacy(self):
+        """Returns SnSysInfo object in the format of legacy daemon"""
+
+        ret = SnSysInfo()
+        ret.userList = []
+        for uname in self.userList:
+            n = SnSysInfoUser()
+            n.userName = uname
+            ret.userList.append(n)
+        ret.moduleList = []
+        for mname, uname in self.getModuleTupleList():
+            n = SnSysInfoModule()
+            n.moduleName = mname
+            n.userName = uname
+            ret.moduleList.append(n)
+        return ret
+
+    @staticmethod
+    def fromLegacy(sysInfo):
+        """Returns SnSysInfo object converted from the format of legacy daemon, version is 0"""
+
+        userList = [n.userName for n in sysInfo.userList]
+        moduleTupleList = [(n.moduleName, n.userName) for n in sysInfo.moduleList]
+        return SnSysInfo.fromModuleTupleList(0, userList, moduleTupleList)
+
+
+class SnSysInfoUser:
+
+    """Only used to communicate with legacy daemon"""
+
+    def __init__(self):
+        self.userName = None                # str
 
 
 class SnSysInfoModule:
 
+    """Only used to communicate with legacy daemon"""
+
     def __init__(self):
         self.moduleName = None              # str
-        self.userName = None                # str
+        self.userName = None                # str, None for sys module
 
-    def __eq__(self, other):
-        return isinstance(other, self.__class__) and self.moduleName == other.moduleName and self.userName == other.userName
 
-    def __ne__(self, other):
-        return not self.__eq__(other)
+class SnSysInfoDelta:
 
-    def __hash__(self):
-        return hash(self.moduleName) ^ hash(self.userName)
+    """Changes from SnSysInfo of baseVersion to SnSysInfo of version"""
+
+    def __init__(self):
+        self.baseVersion = None             # int
+        self.version = None                 # int
+        self.userAddList = None             # list<str>
+        self.userRemoveList = None          # list<str>
+        self.moduleAddList = None           # list<(moduleName, userName)>
+        self.moduleRemoveList = None        # list<(moduleName, userName)>
+
+    def apply(self, sysInfo):
+        """Returns new SnSysInfo object, sysInfo is not modified
+           Raises ValueError if the delta can't be applied to sysInfo"""
+
+        if sysInfo.version != self.baseVersion:
+            raise ValueError("version not match")
+
+        userList = [x for x in sysInfo.userList if x not in self.userRemoveList] + self.userAddList
+        moduleTupleList = [x for x in sysInfo.getModuleTupleList() if x not in self.moduleRemoveList] + self.moduleAddList
+        return SnSysInfo.fromModuleTupleList(self.version, userList, moduleTupleList)
 
 
 class SnDataPacket:
@@ -170,6 +267,7 @@ class SnLocalManager:
         self.param = param
         self.disposeCompleteFunc = None
         self.localInfo = self._getLocalInfo()
+        self.localInfo.version = 1
         self.moiList = []
         self.moiGcList = []
         self.sleepNotifier = SnSleepNotifier(self.onBeforeSleep, self.onAfterResume)
@@ -183,6 +281,9 @@ class SnLocalManager:
     def dispose(self, disposeCompleteFunc):
         logging.debug("SnLocalManager.dispose: Start")
 
+        self.sleepNotifier.dispose()
+        self.sleepNotifier = None
+
         self.localInfo = None
         self.onPeerChange(socket.gethostname(), None)
 
@@ -195,6 +296,40 @@ class SnLocalManager:
     def getLocalInfo(self):
         return self.localInfo
 
+    def refreshLocalInfo(self):
+        """Re-read local user and module list, notify peers only the difference"""
+
+        logging.debug("SnLocalManager.refreshLocalInfo: Start")
+
+        newInfo = self._getLocalInfo()
+
+        delta = SnSysInfoDelta()
+        delta.baseVersion = self.localInfo.version
+        delta.version = self.localInfo.version + 1
+        newModuleTupleList = newInfo.getModuleTupleList()
+        oldModuleTupleList = self.localInfo.getModuleTupleList()
+        delta.userAddList = [x for x in newInfo.userList if x not in self.localInfo.userList]
+        delta.userRemoveList = [x for x in self.localInfo.userList if x not in newInfo.userList]
+        delta.moduleAddList = [x for x in newModuleTupleList if x not in oldModuleTupleList]
+        delta.moduleRemoveList = [x for x in oldModuleTupleList if x not in newModuleTupleList]
+        if len(delta.userAddList + delta.userRemoveList + delta.moduleAddList + delta.moduleRemoveList) == 0:
+            logging.debug("SnLocalManager.refreshLocalInfo: End, no change")
+            return
+
+        self.localInfo = delta.apply(self.localInfo)
+        self.onPeerChange(socket.gethostname(), self.localInfo)
+        for peerName in self.param.peerManager.getPeerNameList():
+            peerInfo = self.param.peerManager.getPeerInfo(peerName)
+            if peerInfo is not None:
+                self.onPeerChange(peerName, peerInfo)         # local user change affects module objects of all peers
+        self.param.peerManager.sendLocalInfoDelta(delta)
+
+        logging.debug("SnLocalManager.refreshLocalInfo: End")
+
+    def hasPeerModule(self, peerInfo, userName, moduleName):
+        """Returns True if the peer with peerInfo has the module object that receives data from moduleName"""
+        return self._pmiMatchTuple(None, peerInfo, userName, moduleName)
+
     def getWorkState(self):
         for moi in self.moiList:
             if moi.workState == SnModuleInstance.WORK_STATE_WORKING:
@@ -225,13 +360,18 @@ class SnLocalManager:
         logging.debug("SnLocalManager.onPeerChange: Start, %s", peerName)
 
         if peerInfo is None:
-            peerInfo = SnSysInfo()
-            peerInfo.moduleList = []
+            peerInfo = SnSysInfo.fromModuleTupleList(None, [], [])
 
-        # module remove
+        # module remove, also for local user and local module that does not exist any more
+        localUserNameList = []
+        if self.localInfo is not None:
+            localUserNameList = self.localInfo.userList
+        localModuleNameList = self.param.configManager.getModuleNameList()
         newMoiList = []
         for moi in self.moiList:
-            if moi.peerName == peerName and not self._pmiMatch(peerName, peerInfo, moi):
+            if moi.peerName == peerName and (not self._pmiMatch(peerName, peerInfo, moi) or
+                                             (moi.userName is not None and moi.userName not in localUserNameList) or
+                                             moi.moduleName not in localModuleNameList):
                 if moi.state != _MoiObj.STATE_PENDING:
                     self.moiGcList.append(moi)
                     moi.gcFlag = _MoiObj.GC_START
@@ -240,6 +380,7 @@ class SnLocalManager:
             else:
                 newMoiList.append(moi)
         self.moiList = newMoiList
+        self._notifyWorkStateChange()
 
         # module add
         newMoiList = []
@@ -250,15 +391,19 @@ class SnLocalManager:
             if minfo.moduleScope == "sys":
                 if not self._pmiMatchTuple(peerName, peerInfo, None, moduleName):
                     continue
+                if self._moiFind(peerName, None, moduleName) is not None:
+                    continue
                 self._moiCreate(peerName, None, moduleName, minfo)
                 newMoiList.append(self.moiList[-1])
             elif minfo.moduleScope == "usr":
-                for userName in SnUtil.getNormalUserList():
+                for userName in localUserNameList:
                     if userName in self.param.configManager.getUserBlackList():
                         continue
                     if not self._pmiMatchTuple(peerName, peerInfo, userName, moduleName):
                         continue
-                    moi = self._moiCreate(peerName, userName, moduleName, minfo)
+                    if self._moiFind(peerName, userName, moduleName) is not None:
+                        continue
+                    self._moiCreate(peerName, userName, moduleName, minfo)
                     newMoiList.append(self.moiList[-1])
         for moi in newMoiList:
             if self._moiGcFind(moi.peerName, moi.userName, moi.moduleName) is None:
@@ -343,33 +488,22 @@ class SnLocalManager:
     ##### implementation ####
 
     def _getLocalInfo(self):
-        userList = SnUtil.getNormalUserList()
-        ret = SnSysInfo()
-
-        ret.userList = []
-        for uname in userList:
-            if uname in self.param.configManager.getUserBlackList():
-                continue
-            n = SnSysInfoUser()
-            n.userName = uname
-            ret.userList.append(n)
+        userList = [x for x in SnUtil.getNormalUserList() if x not in self.param.configManager.getUserBlackList()]
+        allUserBitmap = (1 << len(userList)) - 1
 
+        ret = SnSysInfo()
+        ret.userList = userList
         ret.moduleList = []
+        ret.moduleUserBitmap = []
         for mname in self.param.configManager.getModuleNameList():
             mInfo = self.param.configManager.getModuleInfo(mname)
             if mInfo.moduleScope == "sys":
-                n = SnSysInfoModule()
-                n.moduleName = mname
-                n.userName = None
-                ret.moduleList.append(n)
+                ret.moduleList.append(mname)
+                ret.moduleUserBitmap.append(0)
             elif mInfo.moduleScope == "usr":
-                for uname in userList:
-                    if uname in self.param.configManager.getUserBlackList():
-                        continue
-                    n = SnSysInfoModule()
-                    n.moduleName = mname
-                    n.userName = uname
-                    ret.moduleList.append(n)
+                if len(userList) > 0:
+                    ret.moduleList.append(mname)
+                    ret.moduleUserBitmap.append(allUserBitmap)
             else:
                 assert False
 
@@ -415,7 +549,7 @@ class SnLocalManager:
         else:
             self.param.peerManager.sendDataObject(peerName, userName, moduleName, messageObj)
 
-    def _sendObject(self, peerName, userName, moduleName, obj):
+    def _sendObject(self, peerName, userName, moduleName, obj, persist=False, conflateKey=None, bulk=False):
         if self._moiGcFind(peerName, userName, moduleName) is not None:
             return
 
@@ -425,7 +559,7 @@ class SnLocalManager:
         if peerName == socket.gethostname():
             SnUtil.idleInvoke(self.onPeerSockRecv, peerName, userName, moduleName, obj)
         else:
-            self.param.peerManager.sendDataObject(peerName, userName, moduleName, obj)
+            self.param.peerManager.sendDataObject(peerName, userName, moduleName, obj, persist, conflateKey, bulk)
 
     def _setWorkState(self, peerName, userName, moduleName, workState):
         if self._moiGcFind(peerName, userName, moduleName) is not None:
@@ -435,6 +569,12 @@ class SnLocalManager:
 
         assert moi.state in [_MoiObj.STATE_ACTIVE, _MoiObj.STATE_FULL]
         moi.workState = workState
+        self._notifyWorkStateChange()
+
+    def _notifyWorkStateChange(self):
+        """D-Bus signal is emitted later if the work state is really changed"""
+        if self.param.dbusMainObject is not None:
+            self.param.dbusMainObject.onWorkStateChange()
 
     def _moduleLog(self, peerName, userName, moduleName, logLevel, msg, args):
         moi = self._moiGet(peerName, userName, moduleName)
@@ -563,6 +703,7 @@ class SnLocalManager:
         if newState in [_MoiObj.STATE_INACTIVE, _MoiObj.STATE_REJECT, _MoiObj.STATE_PEER_REJECT, _MoiObj.STATE_EXCEPT, _MoiObj.STATE_PEER_EXCEPT]:
             moi.workState = SnModuleInstance.WORK_STATE_IDLE
             moi.peerPacketQueue.clear()
+            self._notifyWorkStateChange()
 
         # change failMessage
         if newState in [_MoiObj.STATE_REJECT, _MoiObj.STATE_PEER_REJECT, _MoiObj.STATE_EXCEPT]:
@@ -791,10 +932,7 @@ class SnLocalManager:
         return self._pmiMatchTuple(peerName, peerInfo, moi.userName, moi.moduleName)
 
     def _pmiMatchTuple(self, peerName, peerInfo, userName, moduleName):
-        for pmi in peerInfo.moduleList:
-            if userName == pmi.userName and moduleName == _map_module_name(pmi.moduleName):
-                return True
-        return False
+        return peerInfo.hasModule(userName, _map_module_name(moduleName))
 
 
 class _MoiObj:
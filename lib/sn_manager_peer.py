@@ -1,20 +1,34 @@
 #!/usr/bin/python3
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
+import os
 import re
+import time
+import pickle
+import collections
+import uuid
+import difflib
 import socket
 import logging
 import dbus
+from objdb import objdb
 from objsocket import objsocket
 from gi.repository import GLib
 from gi.repository import GObject
 
 from sn_util import SnUtil
+from sn_util import SnNetlinkWatcher
+from sn_util import SnSleepNotifier
+from sn_util import SnWakeOnLan
+from sn_util import MulticastObjSocket
 from sn_conn_peer import SnPeerServer
 from sn_conn_peer import SnPeerClient
+from sn_conn_peer import SnSslObjectSocket
+from sn_conn_peer import SnPeerIoWorkerPool
 from sn_manager_config import SnVersion
 from sn_manager_config import SnCfgSerializationObject
 from sn_manager_local import SnSysInfo
+from sn_manager_local import SnSysInfoDelta
 from sn_manager_local import SnDataPacket
 
 """
@@ -54,6 +68,7 @@ Peer FSM trigger table:
   STATE_INIT      -> STATE_VER_MATCH : object SnVersion recevied
   STATE_VER_MATCH -> STATE_CFG_MATCH : object SnCfgSerializationObject recevied
   STATE_CFG_MATCH -> STATE_FULL      : object SnSysInfo recevied
+  STATE_INIT      -> STATE_FULL      : object SnSysPacketHello recevied
 
   STATE_INIT      -> STATE_REJECT    : reject sent, reject received
   STATE_VER_MATCH -> STATE_REJECT    : reject sent, reject received
@@ -92,74 +107,237 @@ POWER_STATE_UNKNOWN when it is in reject.
   Peer should send SnSysPacketPowerStateWhenInactive before it goes offline so we
 can give it a proper power state when it's inactive. If it fails to do so, it's
 power state should be POWER_STATE_UNKNOWN.
+  A power operation is acknowledged by SnSysPacketPowerOpAck after the peer has
+sent SnSysPacketPowerStateWhenInactive to all its connected peers, the peer does
+the operation _POWER_OP_DELAY seconds later so that the packets are sent out
+before it goes offline. A pending power operation fails if no acknowledgement
+is received in _POWER_OP_TIMEOUT seconds or if the connection is lost.
+  Poweron and wakeup are done by Wake-on-LAN. Magic packets are re-sent until
+the peer enters STATE_FULL, which completes the operation, or until
+_WOL_TIMEOUT seconds elapse.
+  Every host keeps a power state table for all the hosts. An entry is versioned
+by (timestamp, observer host name), a host updates the entry when it observes a
+peer entering or leaving STATE_FULL. New entries are sent to the peers in
+STATE_FULL with SnSysPacketPowerTable in each keepalive interval, the receiver
+keeps the entry with the higher version. A host that finds a wrong entry for
+itself or for a peer it is connected to overrides it with a newer version. The
+table is used for the peers that are not connected.
 """
 
+"""
+Peer outbox notes:
+  Data objects sent with persist flag are saved in the outbox file of the peer
+when the peer is not in STATE_FULL, or when the outbox has objects not sent yet,
+to keep the order. The outbox is sent when the peer enters STATE_FULL. The sent
+objects are removed when the echo of the keepalive sent after them is received,
+they are sent again if the connection is lost before, so the peer may receive
+an object twice. The outbox file is an append-only log. Objects older than
+_OUTBOX_MAX_AGE, objects exceeding _OUTBOX_MAX for one (user, module), and
+objects whose target module object doesn't exist in the peer are dropped.
+"""
 
-class SnPeerManager:
+"""
+Peer cache notes:
+  The last working address of every peer and the power state table are saved in
+the peer cache file, and are loaded at startup. Saving is delayed until nothing
+changes for _PEER_CACHE_SAVE_DELAY seconds, at most _PEER_CACHE_SAVE_MAX_DELAY
+seconds. The cached address is tried once before resolving the host name. SSL
+sessions are not cached, they can't be serialized. Capabilities are not cached,
+they are negotiated in every connection.
+"""
 
-    def __init__(self, param):
-        logging.debug("SnPeerManager.__init__: Start")
+"""
+Peer keepalive notes:
+  SnSysPacketKeepalive is sent to every connected peer in each keepalive interval,
+and is echoed back by the peer. Any packet received from the peer resets its miss
+counter, the peer is shut down when the counter reaches the configured threshold.
+The echoed keepalive packets are used to calculate a smoothed round trip time.
+"""
 
-        self.param = param
-        self.discoverySock = None
-        self.commSock = None
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        MulticastObjSocket(self.param.discoveryIp, self.param.discoveryPort, self._onDiscoveryRecv)
+"""
+Peer handshake notes:
+  SnVersion is always the first frame, legacy daemon can unpickle it. Its
+helloSupported field tells that the sender accepts SnSysPacketHello, so a peer
+that sets it is answered with SnSysPacketHello, which carries version,
+capabilities, configuration digest and SnSysInfo in one frame, it is validated
+in one step and moves the peer from STATE_INIT to STATE_FULL directly. A legacy
+peer is answered with the rest of the legacy sequence (SnCfgSerializationObject,
+SnSysInfo in separate frames).
+  Peers are compatible if their major versions are the same.
+"""
 
-        # communication socket
-        self.commSock = ReliableUdpObjSocket("0.0.0.0", self.param.communicationPort, self._onRecv)
+"""
+Peer capability notes:
+  Each side sends its capability set in SnSysPacketHello, the intersection of
+the two sets is the capability set of the connection. A peer using the legacy
+handshake sequence has an empty capability set. The optional packets and
+behaviors are only used on the connections that have the capability:
+    heartbeat     : SnSysPacketKeepalive, otherwise only tcp keep-alive is used
+    sysinfo-delta : SnSysInfoDelta, otherwise SnSysInfo changes are not sent
+    power-table   : SnSysPacketPowerTable
+    idle-close    : SnSysPacketIdleClose in on-demand mode
+    resumption    : dormant peer resuming in reconnect grace period
+    relay         : SnSysPacketRelayInfo and SnSysPacketRelayData in star topology
+    compression   : zlib compressed frames in objsocket
+    channels      : bulk data channels
+"""
 
+"""
+Peer bulk data channel notes:
+  A module object sends bulk data by sendObject(bulk=True), which uses a
+dedicated connection to the peer for the (user, module), so that the bulk
+stream doesn't block the control connection. The channel is negotiated on the
+control connection: the initiator sends SnSysPacketChannelOpen, the acceptor
+answers SnSysPacketChannelOpenAck with a one-time token. The initiator then
+connects to the peer with the same certificate, a new connection from a peer
+in STATE_FULL is a channel connection. The initiator sends
+SnSysPacketChannelHello with the token as the first packet, the acceptor echoes
+it back, then the channel is established and carries only SnDataPacket of that
+(user, module).
+  Bulk data is held in the channel until the channel is established. If the
+channel is refused, or not established in _CHANNEL_OPEN_TIMEOUT seconds, or
+too much data is held, the held data and all the later bulk data of the (user,
+module) go to the control connection until the peer leaves STATE_FULL, so that
+the stream never switches between connections. Channels not used for
+_CHANNEL_IDLE_TIMEOUT seconds are closed. All the channels are closed when the
+peer leaves STATE_FULL.
+"""
 
+"""
+Star topology notes:
+  In star topology, ordinary hosts only connect to the nexus host. The nexus
+sends SnSysPacketRelayInfo to tell the ordinary hosts about the SnSysInfo of
+the other peers, and forwards SnSysPacketRelayData between them. An ordinary
+host sets up a direct link to a peer when the relayed data packets to it
+exceed the direct link threshold in one minute. Data packets relayed before
+the direct link comes up may arrive after the ones sent on the direct link.
+"""
 
-        logging.debug("SnPeerManager.__init__: End")
-        return
+"""
+On-demand connect mode notes:
+  Peers are not probed. A peer is connected when it announces itself for the
+first time, or when something has to be sent to it. A connection without data
+packet for the idle timeout is closed by SnSysPacketIdleClose, both sides keep
+the peer SnSysInfo as dormant info, so the module objects stay. Data packets
+sent to a dormant peer are queued and the peer is connected, the queue is sent
+after the handshake if the peer SnSysInfo is not changed. All hosts should use
+the same connect mode.
+  The same dormant state is used for the reconnect grace period. When a peer in
+STATE_FULL is lost unexpectedly, its module objects are kept and data packets
+are queued for the grace period. If the peer comes back with the same daemon
+instance and an identical SnSysInfo, it is resumed without notify. Otherwise
+the module objects are removed and created again.
+"""
 
 
+class SnSysPacket:
 
+    def __init__(self):
+        self.data = None                    # object
 
 
+class SnSysPacketReject:
 
+    def __init__(self):
+        self.message = None                 # str
 
 
+class SnSysPacketPowerOp:
 
+    def __init__(self):
+        self.name = None                    # str
 
 
+class SnSysPacketPowerOpAck:
 
+    def __init__(self):
+        self.error_message = None           # str, None means success
 
 
+class SnSysPacketPowerStateWhenInactive:
 
+    def __init__(self):
+        self.name = None                    # str
 
 
+class SnSysPacketHello:
 
+    def __init__(self):
+        self.version = None                 # obj, SnVersion
+        self.capSet = None                  # set<str>
+        self.cfg = None                     # obj, SnCfgSerializationObject
+        self.sysInfo = None                 # obj, SnSysInfo
+        self.instanceId = None              # str, changes every time the daemon starts
 
 
+class SnSysPacketRelayInfo:
 
+    def __init__(self):
+        self.peerName = None                # str
+        self.sysInfo = None                 # obj, SnSysInfo, None means the peer is not reachable through nexus
 
-    POWER_STATE_UNKNOWN = 0
-    POWER_STATE_POWEROFF = 1
-    POWER_STATE_REBOOTING = 2
-    POWER_STATE_SUSPEND = 3
-    POWER_STATE_HIBERNATE = 4
-    POWER_STATE_HYBRID_SLEEP = 5
-    POWER_STATE_RUNNING = 6
 
+class SnSysPacketRelayData:
 
+    def __init__(self):
+        self.srcPeerName = None             # str, filled by nexus
+        self.dstPeerName = None             # str
+        self.data = None                    # obj, SnDataPacket
 
 
+class SnSysPacketIdleClose:
+    pass
 
 
+class SnSysPacketChannelOpen:
 
+    def __init__(self):
+        self.userName = None                # str, can be None
+        self.moduleName = None              # str
 
 
+class SnSysPacketChannelOpenAck:
+
+    def __init__(self):
+        self.userName = None                # str, can be None
+        self.moduleName = None              # str
+        self.token = None                   # str, None means refused
+
+
+class SnSysPacketChannelHello:
+
+    def __init__(self):
+        self.token = None                   # str
+
+
+class SnSysPacketPowerTable:
+
+    def __init__(self):
+        self.entryList = None               # list<(hostName, powerState, timestamp, observerName)>
+
+
+class SnSysPacketKeepalive:
+
+    def __init__(self):
+        self.isReply = None                 # bool
+        self.timestamp = None               # float, time.monotonic() of the sender, echoed back in reply
+
+
+class SnPeerManager:
+
+    POWER_STATE_UNKNOWN = 0
+    POWER_STATE_POWEROFF = 1
+    POWER_STATE_REBOOTING = 2
+    POWER_STATE_SUSPEND = 3
+    POWER_STATE_HIBERNATE = 4
+    POWER_STATE_HYBRID_SLEEP = 5
+    POWER_STATE_RUNNING = 6
+
+    def __init__(self, param):
+        logging.debug("SnPeerManager.__init__: Start")
+
+        self.param = param
+        self.instanceId = uuid.uuid4().hex
 
         # create internal peer info dict
         self.peerInfoDict = dict()
@@ -170,16 +348,108 @@ class SnPeerManager:
             self.peerInfoDict[hn].fsmState = _PeerInfoInternal.STATE_NONE
             self.peerInfoDict[hn].powerStateWhenInactive = self.POWER_STATE_UNKNOWN
 
-        # create server endpoint
-        self.serverEndPoint = SnPeerServer(self.param.certFile, self.param.privkeyFile, self.param.caCertFile, self.onSocketConnected)
-        self.serverEndPoint.start(self.param.configManager.getHostInfo("localhost").port)
-
-        # create client endpoint
-        self.clientEndPoint = SnPeerClient(self.param.certFile, self.param.privkeyFile, self.param.caCertFile, self.onSocketConnected)
+        # objsocket -> peer name, for peers that have a socket
+        self.sockPeerDict = dict()
+
+        # star topology
+        self.isStar = (self.param.configManager.getTopology() == "star")
+        self.nexusName = self.param.configManager.getNexusHostName()
+        self.isNexus = (self.nexusName == socket.gethostname())
+        for pinfo in self.peerInfoDict.values():
+            pinfo.relayCount = 0
+            pinfo.wantDirect = False
+
+        # on-demand connect mode
+        self.onDemand = (self.param.configManager.getPeerConnectMode() == "on-demand")
+        for pinfo in self.peerInfoDict.values():
+            pinfo.wantConnect = False
+            pinfo.idleClosing = False
+            pinfo.pendingSendList = []
+        self.relayCountTimer = None
+        if self.isStar and not self.isNexus:
+            self.relayCountTimer = GObject.timeout_add_seconds(60, self.onRelayCountReset)
+
+        # reconnect grace period
+        for pinfo in self.peerInfoDict.values():
+            pinfo.graceTimer = None
+
+        # bulk data channels, objsocket -> _PeerChannel, for channels that have a socket
+        self.channelDict = dict()
+        for pinfo in self.peerInfoDict.values():
+            pinfo.channelDict = dict()
+            pinfo.channelTokenDict = dict()
+
+        # gossip power state table, host name -> (powerState, timestamp, observerName, seq)
+        self.powerTable = dict()
+        self.powerTableSeq = 0
+        for pinfo in self.peerInfoDict.values():
+            pinfo.powerTableSentSeq = 0
+
+        # load peer cache
+        for pinfo in self.peerInfoDict.values():
+            pinfo.lastAddr = None
+            pinfo.lastAddrTried = False
+            pinfo.lastHintConnect = None
+            pinfo.capSet = None
+        self.peerCacheSaveTimer = None
+        self.peerCacheSaveFirstTime = None
+        self._loadPeerCache()
+        self._observePowerState(socket.gethostname(), self.POWER_STATE_RUNNING)
+
+        # wake-on-lan sender
+        self.wol = SnWakeOnLan()
+
+        # durable outbox, loaded if there is something left
+        for peerName, pinfo in self.peerInfoDict.items():
+            pinfo.outbox = None
+            pinfo.outboxAckTimestamp = None
+            self._loadOutbox(peerName)
+
+        self.serverEndPoint = None
+        self.clientEndPoint = None
+        self.ioWorkerPool = None
+        if self.param.configManager.getPeerIoWorkerNum() == 0:
+            # create server endpoint
+            self.serverEndPoint = SnPeerServer(self.param.certFile, self.param.privkeyFile, self.param.caCertFile, self.onSocketConnected,
+                                               self.param.configManager.getHandshakeThreadNum(),
+                                               self.param.configManager.getPeerSslBackend())
+            self.serverEndPoint.start(self.param.configManager.getHostInfo("localhost").port)
+
+            # create client endpoint
+            self.clientEndPoint = SnPeerClient(self.param.certFile, self.param.privkeyFile, self.param.caCertFile, self.onClientSocketConnected,
+                                               self.param.configManager.getHandshakeThreadNum(),
+                                               self.param.configManager.getPeerSslBackend())
+        else:
+            # peer sockets are in I/O worker processes
+            workerParam = {
+                "port": self.param.configManager.getHostInfo("localhost").port,
+                "certFile": self.param.certFile,
+                "privkeyFile": self.param.privkeyFile,
+                "caCertFile": self.param.caCertFile,
+                "handshakeThreadNum": self.param.configManager.getHandshakeThreadNum(),
+                "sslBackend": self.param.configManager.getPeerSslBackend(),
+                "keepaliveInterval": self.param.configManager.getPeerKeepaliveInterval(),
+                "keepaliveMiss": self.param.configManager.getPeerKeepaliveMiss(),
+                "logDir": self.param.logDir,
+                "logLevel": self.param.logLevel,
+            }
+            self.ioWorkerPool = SnPeerIoWorkerPool(self.param.peerIoWorkerFile, workerParam,
+                                                   self.param.configManager.getPeerIoWorkerNum(),
+                                                   self.onWorkerSocketConnected, self.onSocketRecv,
+                                                   self.onSocketError, self._gcComplete)
 
         # create timers
         self.peerProbeTimer = None
         self._startOrStopPeerProbeTimer()
+        self.peerKeepaliveTimer = GObject.timeout_add_seconds(self.param.configManager.getPeerKeepaliveInterval(), self.onPeerKeepalive)
+
+        # re-probe and re-check peers as soon as network changes
+        self.netlinkWatcher = SnNetlinkWatcher(self.onNetworkChange)
+
+        # announce ourself in the discovery multicast group, at startup and after resume
+        self.discoverySock = MulticastObjSocket(self.param.discoveryIp, self.param.discoveryPort, self.onDiscoveryRecv)
+        self.sleepNotifier = SnSleepNotifier(self.onBeforeSleep, self.onAfterResume)
+        self._sendAnnounce()
 
         logging.debug("SnPeerManager.__init__: End")
         return
@@ -191,8 +461,31 @@ class SnPeerManager:
             ret = GLib.source_remove(self.peerProbeTimer)
             assert ret
 
-        self.clientEndPoint.dispose()
-        self.serverEndPoint.dispose()
+        ret = GLib.source_remove(self.peerKeepaliveTimer)
+        assert ret
+
+        if self.relayCountTimer is not None:
+            ret = GLib.source_remove(self.relayCountTimer)
+            assert ret
+
+        if self.peerCacheSaveTimer is not None:
+            ret = GLib.source_remove(self.peerCacheSaveTimer)
+            assert ret
+            self.peerCacheSaveTimer = None
+
+        for pinfo in self.peerInfoDict.values():
+            if pinfo.graceTimer is not None:
+                ret = GLib.source_remove(pinfo.graceTimer)
+                assert ret
+
+        self.netlinkWatcher.dispose()
+        self.sleepNotifier.dispose()
+        self.wol.dispose()
+        self.discoverySock.close()
+
+        if self.ioWorkerPool is None:
+            self.clientEndPoint.dispose()
+            self.serverEndPoint.dispose()
 
         for peerName, peerInfo in list(self.peerInfoDict.items()):
             if (peerInfo.fsmState == _PeerInfoInternal.STATE_INIT
@@ -201,17 +494,42 @@ class SnPeerManager:
                     or peerInfo.fsmState == _PeerInfoInternal.STATE_FULL):
                 self._peerToShutdown(peerName)
 
+        for pinfo in self.peerInfoDict.values():
+            if pinfo.outbox is not None:
+                pinfo.outbox.dispose()
+                pinfo.outbox = None
+
+        self._savePeerCache()
+
+        # I/O worker processes get the close messages of the sockets before they exit
         self.disposeCompleteFunc = disposeCompleteFunc
-        SnUtil.idleInvoke(self._disposeComplete)
+        if self.ioWorkerPool is not None:
+            self.ioWorkerPool.dispose(self._disposeComplete)
+        else:
+            SnUtil.idleInvoke(self._disposeComplete)
 
     def getPeerNameList(self):
         return list(self.peerInfoDict.keys())
 
     def getPeerInfo(self, peerName):
-        return self.peerInfoDict[peerName].infoObj
+        """Returns SnSysInfo got by direct link, relayed by nexus, or kept after idle close,
+           returns None if peer is not reachable"""
+        if self.peerInfoDict[peerName].infoObj is not None:
+            return self.peerInfoDict[peerName].infoObj
+        if self.peerInfoDict[peerName].relayInfoObj is not None:
+            return self.peerInfoDict[peerName].relayInfoObj
+        return self.peerInfoDict[peerName].dormantInfoObj
+
+    def getPeerRtt(self, peerName):
+        """Returns smoothed round trip time in seconds, returns None if it is not measured yet"""
+        return self.peerInfoDict[peerName].rtt
 
     def getPeerPowerState(self, peerName):
         if self.peerInfoDict[peerName].fsmState == _PeerInfoInternal.STATE_NONE:
+            if self.peerInfoDict[peerName].relayInfoObj is not None:
+                return self.POWER_STATE_RUNNING
+            if peerName in self.powerTable:
+                return self.powerTable[peerName][0]
             return self.peerInfoDict[peerName].powerStateWhenInactive
         elif self.peerInfoDict[peerName].fsmState == _PeerInfoInternal.STATE_REJECT:
             assert self.peerInfoDict[peerName].powerStateWhenInactive == self.POWER_STATE_UNKNOWN
@@ -236,7 +554,7 @@ class SnPeerManager:
                 errFunc(Exception("peer doesn't support this power operation"))
                 return
 
-            assert False
+            self._wolStart(peerName)
         elif opName == "wakeup":
             if self.getPeerPowerState(peerName) not in [self.POWER_STATE_UNKNOWN, self.POWER_STATE_SUSPEND, self.POWER_STATE_HIBERNATE, self.POWER_STATE_HYBRID_SLEEP]:
                 errFunc(Exception("the current power state of peer doesn't support this power operation"))
@@ -245,73 +563,120 @@ class SnPeerManager:
                 errFunc(Exception("peer doesn't support this power operation"))
                 return
 
-            assert False
+            self._wolStart(peerName)
         else:
-            if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
-                errFunc(Exception("the current power state of peer doesn't support this power operation"))
-                return
-
             o = SnSysPacketPowerOp()
             o.name = opName
-            self._sendObject(peerName, o)
 
+            if self.peerInfoDict[peerName].dormantInfoObj is not None or self.peerInfoDict[peerName].idleClosing:
+                self._queueOnDemand(peerName, o)
+            elif self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+                errFunc(Exception("the current power state of peer doesn't support this power operation"))
+                return
+            else:
+                self._sendObject(peerName, o)
+
+        if opName in ["poweron", "wakeup"]:
+            timeout = _WOL_TIMEOUT
+        else:
+            timeout = _POWER_OP_TIMEOUT
         self.peerInfoDict[peerName].opArgPower = (okFunc, errFunc)
+        self.peerInfoDict[peerName].opPowerName = opName
+        self.peerInfoDict[peerName].opPowerTimer = GObject.timeout_add_seconds(timeout, self.onPeerPowerOpTimeout, peerName)
 
-    ##### event callback ####
+    def doPeerPowerOperationMultiAsync(self, peerNameList, opName, completeFunc):
+        """Do power operation on all the peers in parallel, call completeFunc with a dict of
+           peer name -> error message when all of them are completed, error message is None for success"""
 
-    def onSocketConnected(self, sslSock):
-        peerName = SnUtil.getSslSocketPeerName(sslSock)
+        resultDict = dict()
+        peerNameList = list(set(peerNameList))
 
-        # need peer name
-        if peerName is None:
-            sslSock.close()
-            logging.debug("SnPeerManager.onSocketConnected: Fail, no peer name")
-            return
+        def _done(peerName, errMsg):
+            resultDict[peerName] = errMsg
+            if len(resultDict) == len(peerNameList):
+                completeFunc(resultDict)
 
-        # only peer in self-net is allowed
-        if peerName not in self.peerInfoDict:
-            sslSock.close()
-            logging.debug("SnPeerManager.onSocketConnected: Fail, foreign peer, %s" % (peerName))
+        if len(peerNameList) == 0:
+            completeFunc(resultDict)
             return
 
-        # only one connection between a pair of hosts
-        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_NONE:
+        for peerName in peerNameList:
+            if peerName not in self.peerInfoDict:
+                _done(peerName, "peer \"%s\" does not exist" % (peerName))
+                continue
+            self.doPeerPowerOperationAsync(peerName, opName,
+                                           lambda pn=peerName: _done(pn, None),
+                                           lambda e, pn=peerName: _done(pn, str(e)))
+
+    ##### event callback ####
+
+    def onSocketConnected(self, sslSock, isClient=False):
+        peerName = SnUtil.getSslSocketPeerName(sslSock)
+        if not self._checkNewSocket(peerName):
             sslSock.close()
-            logging.debug("SnPeerManager.onSocketConnected: Fail, duplicate connection")
             return
 
-        # send keep-alive packet for every second
-        assert sslSock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0
-        sslSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 1)
-        sslSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 1)
-        sslSock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 100)
-        sslSock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # tcp keep-alive uses the same dead peer timeout as SnSysPacketKeepalive
+        SnUtil.setSocketKeepalive(sslSock, self.param.configManager.getPeerKeepaliveInterval(),
+                                  self.param.configManager.getPeerKeepaliveMiss())
 
-        # record sock
-        oldFsmState = self.peerInfoDict[peerName].fsmState
-        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_INIT
-        self.peerInfoDict[peerName].powerStateWhenInactive = self.POWER_STATE_UNKNOWN
-        self.peerInfoDict[peerName].infoObj = None
-        self.peerInfoDict[peerName].sock = objsocket(objsocket.SOCKTYPE_SSL_SOCKET, sslSock, self.onSocketRecv, self.onSocketError, self._gcComplete)
-        logging.info("SnPeerManager.onSocketConnected: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
+        peerAddr = None
+        try:
+            peerAddr = sslSock.getpeername()[0]
+        except socket.error:
+            pass
+        if isinstance(sslSock, SnSslObjectSocket):
+            sockType = objsocket.SOCKTYPE_SSL_OBJECT
+        else:
+            sockType = objsocket.SOCKTYPE_SSL_SOCKET
+        self._addNewSocket(peerName, objsocket(sockType, sslSock, self.onSocketRecv, self.onSocketError, self._gcComplete), peerAddr, isClient)
 
-        # timer operation
-        self._startOrStopPeerProbeTimer()
+    def onClientSocketConnected(self, sslSock):
+        self.onSocketConnected(sslSock, True)
 
-        # send localInfo
-        self._sendObject(peerName, self.param.configManager.getVersion())
-        self._sendObject(peerName, self.param.configManager.getCfgSerializationObject())
-        self._sendObject(peerName, self.param.localManager.getLocalInfo())
+    def onWorkerSocketConnected(self, sock):
+        """tcp keep-alive is set by the I/O worker process"""
+        if not self._checkNewSocket(sock.peerName):
+            sock.close()
+            return
+        self._addNewSocket(sock.peerName, sock, sock.peerAddr, sock.isClient)
 
     def onSocketRecv(self, sock, packetObj):
+        if sock in self.channelDict:
+            self._recvChannel(self.channelDict[sock], packetObj)
+            return
+
         peerName = self._getPeerNameBySock(sock)
+        self.peerInfoDict[peerName].keepaliveMiss = 0
         if _type_check(packetObj, SnSysPacket):
-            if _type_check(packetObj.data, SnVersion):
+            if _type_check(packetObj.data, SnSysPacketKeepalive):
+                self._recvKeepalive(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketHello):
+                self._recvHello(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnVersion):
                 self._recvVerMatch(peerName, packetObj.data)
             elif _type_check(packetObj.data, SnCfgSerializationObject):
-                self._recvCfgMatch(peerName, packetObj.data)
+                # legacy peer always sends the document in the cfg-match packet
+                if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_VER_MATCH and packetObj.data.strHostsXml is not None:
+                    self._recvCfgDocument(peerName, packetObj.data)
+                else:
+                    self._recvCfgMatch(peerName, packetObj.data)
             elif _type_check(packetObj.data, SnSysInfo):
                 self._recvPeerInfo(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysInfoDelta):
+                self._recvPeerInfoDelta(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketPowerTable):
+                self._recvPowerTable(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketIdleClose):
+                self._recvIdleClose(peerName)
+            elif _type_check(packetObj.data, SnSysPacketChannelOpen):
+                self._recvChannelOpen(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketChannelOpenAck):
+                self._recvChannelOpenAck(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketRelayInfo):
+                self._recvRelayInfo(peerName, packetObj.data)
+            elif _type_check(packetObj.data, SnSysPacketRelayData):
+                self._recvRelayData(peerName, packetObj.data)
             elif _type_check(packetObj.data, SnSysPacketPowerOp):
                 logging.debug("SnPeerManager.onSocketRecv: _recvPowerOp")
                 self._recvPowerOp(peerName, packetObj.data)
@@ -326,44 +691,360 @@ class SnPeerManager:
             else:
                 self._sendReject(peerName, "invalid system packet data format")
         elif _type_check(packetObj, SnDataPacket):
+            self.peerInfoDict[peerName].lastActive = time.monotonic()
             self.param.localManager.onPeerSockRecv(peerName, packetObj.srcUserName,
                                                    packetObj.srcModuleName, packetObj.data)
         else:
             self._sendReject(peerName, "invalid packet format, %s" % (packetObj.__class__))
 
     def onSocketError(self, sock, excObj):
+        if sock in self.channelDict:
+            logging.info("SnPeerManager.onSocketError: Channel of %s closed, %s", self.channelDict[sock].peerName, str(excObj))
+            self._dropChannel(self.channelDict[sock])
+            return
+
         peerName = self._getPeerNameBySock(sock)
 
+        # peer closes the connection after our idle close request
+        if self.peerInfoDict[peerName].idleClosing:
+            self._peerToIdle(peerName)
+            return
+
         oldFsmState = self.peerInfoDict[peerName].fsmState
         newFsmState = _PeerInfoInternal.STATE_NONE
-        self._peerToShutdown(peerName)
+        if self._peerCanGrace(peerName):
+            self._peerToGrace(peerName)
+        else:
+            self._peerToShutdown(peerName)
         logging.info("SnPeerManager.onSocketError: %s, %s", str(excObj), _dbgmsg_peer_state_change(peerName, oldFsmState, newFsmState))
 
         self._startOrStopPeerProbeTimer()
 
     def onPeerProbe(self):
         for pname, pinfo in list(self.peerInfoDict.items()):
-            if pinfo.fsmState == _PeerInfoInternal.STATE_NONE:
-                self.clientEndPoint.connect(pname, self.param.configManager.getHostInfo(pname).port)
+            if pinfo.fsmState == _PeerInfoInternal.STATE_NONE and self._peerNeedConnect(pname):
+                self._connectPeer(pname)
         return True
 
-    def sendDataObject(self, peerName, srcUserName, srcModuleName, obj):
-        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+    def onRelayCountReset(self):
+        for pinfo in self.peerInfoDict.values():
+            pinfo.relayCount = 0
+        return True
+
+    def onPeerCacheSave(self):
+        self.peerCacheSaveTimer = None
+        self._savePeerCache()
+        return False
+
+    def onPeerKeepalive(self):
+        self._expireChannels()
+
+        miss = self.param.configManager.getPeerKeepaliveMiss()
+        for pname, pinfo in list(self.peerInfoDict.items()):
+            if pinfo.sock is None or pinfo.sock.is_graceful_closing():
+                continue
+
+            if pinfo.keepaliveMiss >= miss:
+                oldFsmState = pinfo.fsmState
+                newFsmState = _PeerInfoInternal.STATE_NONE
+                if self._peerCanGrace(pname):
+                    self._peerToGrace(pname)
+                else:
+                    self._peerToShutdown(pname)
+                logging.info("SnPeerManager.onPeerKeepalive: keepalive timeout, %s", _dbgmsg_peer_state_change(pname, oldFsmState, newFsmState))
+                self._startOrStopPeerProbeTimer()
+                continue
+
+            if self.onDemand and self._peerIsIdle(pname):
+                logging.info("SnPeerManager.onPeerKeepalive: Peer %s is idle, closing", pname)
+                pinfo.idleClosing = True
+                self._sendObject(pname, SnSysPacketIdleClose())
+                continue
+
+            # handshake must complete in keepalive timeout, peer without heartbeat relies on tcp keep-alive
+            if pinfo.fsmState != _PeerInfoInternal.STATE_FULL:
+                pinfo.keepaliveMiss += 1
+                continue
+            if self._peerHasCap(pname, "heartbeat"):
+                pinfo.keepaliveMiss += 1
+                self._sendKeepalive(pname)
+            if self._peerHasCap(pname, "power-table"):
+                self._sendPowerTable(pname)
+        return True
+
+    def onPeerGraceTimeout(self, peerName):
+        logging.info("SnPeerManager.onPeerGraceTimeout: Peer %s doesn't come back in grace period", peerName)
+        self.peerInfoDict[peerName].graceTimer = None
+        self._dropDormant(peerName)
+        return False
+
+    def onPeerPowerOpTimeout(self, peerName):
+        self.peerInfoDict[peerName].opPowerTimer = None
+        self._powerOpComplete(peerName, "power operation timeout")
+        return False
+
+    def onDiscoveryRecv(self, obj, addr):
+        # announce format: {"hostname": str, "port": int, "addr-list": list<str>}
+        # announce is not authenticated, the configured port is used, the address is only a hint
+        if not isinstance(obj, dict) or not isinstance(obj.get("hostname"), str):
+            return
+        peerName = obj["hostname"]
+        if peerName not in self.peerInfoDict:
+            return
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_NONE:
+            return
+        if not self._peerNeedConnect(peerName):
+            # in on-demand mode, presence of an unknown peer triggers connect
+            if not (self.onDemand and self.getPeerInfo(peerName) is None):
+                return
+
+        # forged announces can't make us connect too often
+        pinfo = self.peerInfoDict[peerName]
+        now = time.monotonic()
+        if pinfo.lastHintConnect is not None and now - pinfo.lastHintConnect < _HINT_CONNECT_INTERVAL:
             return
+        pinfo.lastHintConnect = now
+
+        # prefer the source address of the announce, the connection is authenticated by certificate anyway
+        addrList = obj.get("addr-list")
+        if not isinstance(addrList, list):
+            addrList = []
+        addrList = [x for x in addrList if isinstance(x, str)]
+        if len(addrList) == 0 or addr[0] in addrList:
+            hostaddr = addr[0]
+        else:
+            hostaddr = addrList[0]
+
+        # the connect with address hint doesn't block the regular connect by _connectPeer()
+        logging.debug("SnPeerManager.onDiscoveryRecv: Announce received, %s, %s", peerName, hostaddr)
+        self._clientConnect(peerName, self.param.configManager.getHostInfo(peerName).port, hostaddr, True)
+
+    def onBeforeSleep(self, sleepType):
+        pass
+
+    def onAfterResume(self, sleepType):
+        self._sendAnnounce()
+        self.onPeerProbe()
+
+    def onNetworkChange(self):
+        logging.debug("SnPeerManager.onNetworkChange: Network changed, re-probe peers")
+
+        # let the peers know our new address
+        self._sendAnnounce()
+
+        # connect offline peers now instead of waiting for the next probe
+        self.onPeerProbe()
+
+        # established connections may be dead, tcp user timeout kills them if the keepalive is not acknowledged
+        for pname, pinfo in list(self.peerInfoDict.items()):
+            if pinfo.sock is None or pinfo.sock.is_graceful_closing():
+                continue
+            if self._peerHasCap(pname, "heartbeat"):
+                self._sendKeepalive(pname)
+
+    def sendDataObject(self, peerName, srcUserName, srcModuleName, obj, persist=False, conflateKey=None, bulk=False):
+        """conflateKey is unique in the scope of (srcUserName, srcModuleName),
+           bulk data is sent by the bulk data channel of (srcUserName, srcModuleName) if possible"""
 
         packetObj = SnDataPacket()
         packetObj.srcUserName = srcUserName
         packetObj.srcModuleName = srcModuleName
         packetObj.data = obj
-        self.peerInfoDict[peerName].sock.send(packetObj)
+
+        # durable outbox, objects can't overtake the ones in outbox
+        pinfo = self.peerInfoDict[peerName]
+        if persist and (pinfo.fsmState != _PeerInfoInternal.STATE_FULL or pinfo.idleClosing or
+                        (pinfo.outbox is not None and pinfo.outbox.hasUnsent())):
+            if pinfo.outbox is None:
+                pinfo.outbox = _PeerOutbox(self._getOutboxFile(peerName))
+            pinfo.outbox.append(srcUserName, srcModuleName, obj, conflateKey)
+            if pinfo.dormantInfoObj is not None and not pinfo.wantConnect:
+                self._queueOnDemand(peerName, None)
+            return
+
+        # peer is dormant in on-demand mode
+        if self.peerInfoDict[peerName].dormantInfoObj is not None or self.peerInfoDict[peerName].idleClosing:
+            self._queueOnDemand(peerName, packetObj)
+            return
+
+        # direct link, bulk data is held until the channel is established, it uses the control connection if the channel fails
+        if self.peerInfoDict[peerName].fsmState == _PeerInfoInternal.STATE_FULL:
+            self.peerInfoDict[peerName].lastActive = time.monotonic()
+            sock = self.peerInfoDict[peerName].sock
+            if bulk and self._peerHasCap(peerName, "channels"):
+                ch = self._getChannel(peerName, srcUserName, srcModuleName)
+                if ch.established:
+                    ch.lastActive = time.monotonic()
+                    sock = ch.sock
+                elif not ch.failed:
+                    ch.pendingSendList.append((packetObj, conflateKey))
+                    if len(ch.pendingSendList) >= _PENDING_SEND_MAX:
+                        logging.info("SnPeerManager.sendDataObject: Too much data held for channel of %s, use control connection", peerName)
+                        self._failChannel(ch)
+                    return
+            if conflateKey is not None:
+                sock.send(packetObj, ("data", srcUserName, srcModuleName, conflateKey))
+            else:
+                sock.send(packetObj)
+            return
+
+        # relayed by nexus
+        if self.peerInfoDict[peerName].relayInfoObj is not None:
+            relayObj = SnSysPacketRelayData()
+            relayObj.dstPeerName = peerName
+            relayObj.data = packetObj
+            if conflateKey is not None:
+                self._sendObject(self.nexusName, relayObj, ("relay", peerName, srcUserName, srcModuleName, conflateKey))
+            else:
+                self._sendObject(self.nexusName, relayObj)
+            self._countRelayData(peerName)
+
+    def sendLocalInfoDelta(self, delta):
+        # peers in STATE_INIT have got or will get the SnSysInfo in hello, the delta is sent after the capability set is known
+        # peers using the legacy handshake sequence get the SnSysInfo after this delta, or never get the delta
+        for pname, pinfo in list(self.peerInfoDict.items()):
+            if pinfo.sock is None or pinfo.sock.is_graceful_closing():
+                continue
+            if pinfo.fsmState == _PeerInfoInternal.STATE_INIT:
+                pinfo.pendingDeltaList.append(delta)
+            elif self._peerHasCap(pname, "sysinfo-delta"):
+                self._sendObject(pname, delta)
 
     ##### implementation ####
 
     def _getPeerNameBySock(self, sock):
-        for pi, pv in list(self.peerInfoDict.items()):
-            if pv.sock == sock:
-                return pi
-        assert False
+        return self.sockPeerDict[sock]
+
+    def _checkNewSocket(self, peerName):
+        # need peer name
+        if peerName is None:
+            logging.debug("SnPeerManager.onSocketConnected: Fail, no peer name")
+            return False
+
+        # only peer in self-net is allowed
+        if peerName not in self.peerInfoDict:
+            logging.debug("SnPeerManager.onSocketConnected: Fail, foreign peer, %s" % (peerName))
+            return False
+
+        # only one control connection between a pair of hosts, the others are bulk data channels
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_NONE and not self._peerHasCap(peerName, "channels"):
+            logging.debug("SnPeerManager.onSocketConnected: Fail, duplicate connection")
+            return False
+
+        return True
+
+    def _addNewSocket(self, peerName, sock, peerAddr, isClient):
+        # new connection of a peer in STATE_FULL is a bulk data channel
+        if self.peerInfoDict[peerName].fsmState == _PeerInfoInternal.STATE_FULL:
+            self._addChannelSocket(peerName, sock, isClient)
+            return
+
+        # record sock
+        oldFsmState = self.peerInfoDict[peerName].fsmState
+        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_INIT
+        self.peerInfoDict[peerName].powerStateWhenInactive = self.POWER_STATE_UNKNOWN
+        self.peerInfoDict[peerName].infoObj = None
+        self.peerInfoDict[peerName].keepaliveMiss = 0
+        self.peerInfoDict[peerName].rtt = None
+        self.peerInfoDict[peerName].lastActive = time.monotonic()
+        if peerAddr is not None:
+            self.peerInfoDict[peerName].lastAddr = peerAddr
+            self.peerInfoDict[peerName].lastAddrTried = False
+        self.peerInfoDict[peerName].sock = sock
+        self.sockPeerDict[self.peerInfoDict[peerName].sock] = peerName
+        logging.info("SnPeerManager.onSocketConnected: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
+
+        # timer operation
+        self._startOrStopPeerProbeTimer()
+        self._notifyPowerStateChange(peerName)
+
+        # send version, SnSysInfo is sent after we know which handshake sequence the peer uses
+        self.peerInfoDict[peerName].pendingDeltaList = []
+        self.peerInfoDict[peerName].helloSent = False
+        self._sendObject(peerName, self.param.configManager.getVersion())
+
+    def _recvKeepalive(self, peerName, keepalive):
+        if not keepalive.isReply:
+            o = SnSysPacketKeepalive()
+            o.isReply = True
+            o.timestamp = keepalive.timestamp
+            self._sendObject(peerName, o)
+            return
+
+        # durable outbox objects sent before the keepalive are received by peer
+        pinfo = self.peerInfoDict[peerName]
+        if pinfo.outboxAckTimestamp is not None and keepalive.timestamp >= pinfo.outboxAckTimestamp:
+            pinfo.outbox.commit()
+            pinfo.outboxAckTimestamp = None
+
+        # smoothed round trip time, same algorithm as TCP (RFC 6298)
+        rtt = time.monotonic() - keepalive.timestamp
+        if self.peerInfoDict[peerName].rtt is None:
+            self.peerInfoDict[peerName].rtt = rtt
+        else:
+            self.peerInfoDict[peerName].rtt = self.peerInfoDict[peerName].rtt * 7 / 8 + rtt / 8
+
+    def _recvHello(self, peerName, hello):
+        # check state
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_INIT:
+            self._sendReject(peerName, "hello packet received in state other than state-init")
+            return
+
+        # peer sends hello without waiting for our version
+        if not self.peerInfoDict[peerName].helloSent:
+            self._sendHello(peerName)
+
+        # check packet format
+        if not _type_check(hello.version, SnVersion) or not isinstance(hello.version.version, str):
+            self._sendReject(peerName, "invalid hello packet format")
+            return
+        if not _type_check(hello.cfg, SnCfgSerializationObject) or not _type_check(hello.sysInfo, SnSysInfo):
+            self._sendReject(peerName, "invalid hello packet format")
+            return
+        if not isinstance(hello.capSet, (set, frozenset)) or not all(isinstance(x, str) for x in hello.capSet):
+            self._sendReject(peerName, "invalid hello packet format")
+            return
+        if hello.instanceId is not None and not isinstance(hello.instanceId, str):
+            self._sendReject(peerName, "invalid hello packet format")
+            return
+
+        # check matching
+        if not _version_compatible(hello.version, self.param.configManager.getVersion()):
+            self._sendReject(peerName, "peer version not match")
+            return
+        if hello.cfg != self.param.configManager.getCfgSerializationObject():
+            self._sendObject(peerName, self.param.configManager.getCfgSerializationObject(True))
+            self._sendReject(peerName, "peer configuration not match")
+            return
+
+        # check peer info
+        try:
+            errMsg = self._checkPeerInfo(hello.sysInfo)
+        except (AttributeError, TypeError, ValueError):
+            self._sendReject(peerName, "invalid hello packet format")
+            return
+        if errMsg is not None:
+            self._sendReject(peerName, errMsg)
+            return
+
+        # do operation
+        oldFsmState = self.peerInfoDict[peerName].fsmState
+        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_FULL
+        self.peerInfoDict[peerName].infoObj = hello.sysInfo
+        logging.info("SnPeerManager._recvHello: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
+
+        # negotiate capabilities
+        self.peerInfoDict[peerName].capSet = _CAP_SET & set(hello.capSet)
+        logging.info("SnPeerManager._recvHello: Peer %s capabilities: %s", peerName, " ".join(sorted(self.peerInfoDict[peerName].capSet)))
+        if self._peerHasCap(peerName, "compression"):
+            self.peerInfoDict[peerName].sock.enable_compress()
+        for delta in self.peerInfoDict[peerName].pendingDeltaList:
+            if self._peerHasCap(peerName, "sysinfo-delta"):
+                self._sendObject(peerName, delta)
+        self.peerInfoDict[peerName].pendingDeltaList = []
+
+        # do notify
+        self._peerFullNotify(peerName, hello.instanceId)
 
     def _recvVerMatch(self, peerName, peerVersion):
         # check state
@@ -372,13 +1053,26 @@ class SnPeerManager:
             return
 
         # check matching
-        if peerVersion != self.param.configManager.getVersion():
+        if not _version_compatible(peerVersion, self.param.configManager.getVersion()):
             self._sendReject(peerName, "peer version not match")
             return
 
-        # do operation
+        # peer accepts hello, it sends hello too, no state change
+        if peerVersion.helloSupported:
+            if not self.peerInfoDict[peerName].helloSent:
+                self._sendHello(peerName)
+            return
+
+        # peer uses the legacy handshake sequence, answer with the rest of the legacy sequence
+        # legacy peer compares the document
+        self._sendObject(peerName, self.param.configManager.getCfgSerializationObject(True))
+        self._sendObject(peerName, self.param.localManager.getLocalInfo().toLegacy())
+
+        # do operation, legacy peer has no capability
         oldFsmState = self.peerInfoDict[peerName].fsmState
         self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_VER_MATCH
+        self.peerInfoDict[peerName].capSet = set()
+        self.peerInfoDict[peerName].pendingDeltaList = []
         logging.info("SnPeerManager._recvVerMatch: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
 
     def _recvCfgMatch(self, peerName, peerCfgSerializationObject):
@@ -387,8 +1081,15 @@ class SnPeerManager:
             self._sendReject(peerName, "cfg-match packet received in state other than state-ver-match")
             return
 
-        # check matching
-        if peerCfgSerializationObject != self.param.configManager.getCfgSerializationObject():
+        # check matching, send the full document to peer for diagnosing before reject
+        # legacy peer has no digest, the documents are compared
+        if peerCfgSerializationObject.digest is None:
+            match = (peerCfgSerializationObject.strHostsXml == self.param.configManager.getCfgSerializationObject(True).strHostsXml)
+        else:
+            match = (peerCfgSerializationObject == self.param.configManager.getCfgSerializationObject())
+        if not match:
+            if peerCfgSerializationObject.digest is not None:
+                self._sendObject(peerName, self.param.configManager.getCfgSerializationObject(True))
             self._sendReject(peerName, "peer configuration not match")
             return
 
@@ -397,93 +1098,348 @@ class SnPeerManager:
         self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_CFG_MATCH
         logging.info("SnPeerManager._recvCfgMatch: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
 
+    def _recvCfgDocument(self, peerName, peerCfgSerializationObject):
+        # only for diagnosing, no state change
+        myStrHostsXml = self.param.configManager.getCfgSerializationObject(True).strHostsXml
+        diff = difflib.unified_diff(myStrHostsXml.split("\n"), peerCfgSerializationObject.strHostsXml.split("\n"),
+                                    "localhost", peerName, lineterm="")
+        logging.warning("SnPeerManager._recvCfgDocument: Configuration of peer %s not match:\n%s", peerName, "\n".join(diff))
+
     def _recvPeerInfo(self, peerName, peerInfo):
         # check state
         if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_CFG_MATCH:
             self._sendReject(peerName, "peer-info packet received in state other than state-cfg-match")
             return
 
+        # check peer info, it is in the format of legacy daemon
+        if not peerInfo.isLegacy():
+            self._sendReject(peerName, "invalid peer-info packet format")
+            return
+        try:
+            peerInfo = SnSysInfo.fromLegacy(peerInfo)
+        except (AttributeError, TypeError, ValueError):
+            self._sendReject(peerName, "invalid peer-info packet format")
+            return
+        errMsg = self._checkPeerInfo(peerInfo)
+        if errMsg is not None:
+            self._sendReject(peerName, errMsg)
+            return
+
+        # do operation
+        oldFsmState = self.peerInfoDict[peerName].fsmState
+        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_FULL
+        self.peerInfoDict[peerName].infoObj = peerInfo
+        logging.info("SnPeerManager._recvPeerInfo: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
+
+        # do notify, legacy peer has no instance id and can't be resumed
+        self._peerFullNotify(peerName, None)
+
+    def _recvPeerInfoDelta(self, peerName, delta):
+        # check state
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self._sendReject(peerName, "peer-info-delta packet received in state other than state-full")
+            return
+
+        # check version
+        if delta.baseVersion != self.peerInfoDict[peerName].infoObj.version:
+            self._sendReject(peerName, "peer info version not match")
+            return
+
         # check peer info
-        if len(peerInfo.userList) != len(set(peerInfo.userList)):
-            self._sendReject(peerName, "duplicate element in peer user list")
+        if not isinstance(delta.version, int) or delta.version <= delta.baseVersion:
+            self._sendReject(peerName, "invalid peer-info-delta packet format")
+            return
+        for userList in [delta.userAddList, delta.userRemoveList]:
+            if not isinstance(userList, list) or not all(isinstance(x, str) for x in userList):
+                self._sendReject(peerName, "invalid peer-info-delta packet format")
+                return
+        for moduleTupleList in [delta.moduleAddList, delta.moduleRemoveList]:
+            if not isinstance(moduleTupleList, list) or not all(_is_module_tuple(x) for x in moduleTupleList):
+                self._sendReject(peerName, "invalid peer-info-delta packet format")
+                return
+        try:
+            peerInfo = delta.apply(self.peerInfoDict[peerName].infoObj)
+            errMsg = self._checkPeerInfo(peerInfo)
+        except (AttributeError, TypeError, ValueError):
+            self._sendReject(peerName, "invalid peer-info-delta packet format")
+            return
+        if errMsg is not None:
+            self._sendReject(peerName, errMsg)
             return
 
-        if len(peerInfo.moduleList) != len(set(peerInfo.moduleList)):
-            self._sendReject(peerName, "duplicate element in peer module list")
+        # do operation
+        self.peerInfoDict[peerName].infoObj = peerInfo
+        logging.info("SnPeerManager._recvPeerInfoDelta: %s, version %d -> %d", peerName, delta.baseVersion, delta.version)
+
+        # do notify, only the difference is applied
+        self.param.localManager.onPeerChange(peerName, peerInfo)
+        self._relayPeerInfo(peerName)
+
+    def _recvIdleClose(self, peerName):
+        if not self.onDemand or self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self._sendReject(peerName, "unexpected idle-close packet received")
             return
+        logging.info("SnPeerManager._recvIdleClose: Peer %s requests idle close", peerName)
+        self._peerToIdle(peerName)
 
-        for m in peerInfo.moduleList:
-            strList = m.moduleName.split("-")
-            if len(strList) < 3:
-                self._sendReject(peerName, "invalid module name \"%s\"" % (m.moduleName))
+    def _recvChannelOpen(self, peerName, channelOpen):
+        if not self._peerHasCap(peerName, "channels"):
+            self._sendReject(peerName, "unexpected channel-open packet received")
+            return
+
+        o = SnSysPacketChannelOpenAck()
+        o.userName = channelOpen.userName
+        o.moduleName = channelOpen.moduleName
+        o.token = None
+
+        pinfo = self.peerInfoDict[peerName]
+        if len(pinfo.channelTokenDict) < _CHANNEL_MAX:
+            ch = _PeerChannel()
+            ch.peerName = peerName
+            ch.userName = channelOpen.userName
+            ch.moduleName = channelOpen.moduleName
+            ch.isInitiator = False
+            ch.token = uuid.uuid4().hex
+            ch.established = False
+            ch.failed = False
+            ch.createTime = time.monotonic()
+            pinfo.channelTokenDict[ch.token] = ch
+            o.token = ch.token
+        else:
+            logging.warning("SnPeerManager._recvChannelOpen: Too many channels for %s, refused", peerName)
+
+        self._sendObject(peerName, o)
+
+    def _recvChannelOpenAck(self, peerName, channelOpenAck):
+        if not self._peerHasCap(peerName, "channels"):
+            self._sendReject(peerName, "unexpected channel-open-ack packet received")
+            return
+
+        # the channel may be expired
+        ch = self.peerInfoDict[peerName].channelDict.get((channelOpenAck.userName, channelOpenAck.moduleName))
+        if ch is None or ch.token is not None:
+            return
+
+        # refused channel is not asked again until the peer leaves STATE_FULL
+        if channelOpenAck.token is None:
+            logging.info("SnPeerManager._recvChannelOpenAck: Channel for %s refused by %s", channelOpenAck.moduleName, peerName)
+            self._failChannel(ch)
+            return
+
+        ch.token = channelOpenAck.token
+        self._connectChannel(peerName)
+
+    def _recvChannel(self, ch, packetObj):
+        now = time.monotonic()
+
+        # established channel only carries data of its module
+        if ch.established:
+            if (not _type_check(packetObj, SnDataPacket) or packetObj.srcUserName != ch.userName
+                    or packetObj.srcModuleName != ch.moduleName):
+                logging.warning("SnPeerManager._recvChannel: Invalid packet from %s, closing channel", ch.peerName)
+                self._closeChannel(ch)
+                return
+            ch.lastActive = now
+            self.peerInfoDict[ch.peerName].lastActive = now
+            self.param.localManager.onPeerSockRecv(ch.peerName, packetObj.srcUserName,
+                                                   packetObj.srcModuleName, packetObj.data)
+            return
+
+        # first packet must be channel hello
+        if not _type_check(packetObj, SnSysPacket) or not _type_check(packetObj.data, SnSysPacketChannelHello):
+            logging.warning("SnPeerManager._recvChannel: No channel hello from %s, closing channel", ch.peerName)
+            self._dropChannel(ch)
+            return
+
+        if ch.isInitiator:
+            # acceptor echoes the token
+            if packetObj.data.token != ch.token:
+                self._dropChannel(ch)
+                return
+        else:
+            # bind the connection to the channel given by the token, the token can only be used once
+            tch = self.peerInfoDict[ch.peerName].channelTokenDict.get(packetObj.data.token)
+            if tch is None or tch.sock is not None:
+                logging.warning("SnPeerManager._recvChannel: Invalid channel token from %s, closing channel", ch.peerName)
+                self._closeChannel(ch)
+                return
+            tch.sock = ch.sock
+            self.channelDict[tch.sock] = tch
+            ch = tch
+            self._sendChannelHello(ch)
+
+        ch.established = True
+        ch.lastActive = now
+        logging.info("SnPeerManager._recvChannel: Channel of %s for %s established", ch.peerName, ch.moduleName)
+
+        # send the held data, then connect the next channel
+        if ch.isInitiator:
+            for packetObj, conflateKey in ch.pendingSendList:
+                if conflateKey is not None:
+                    ch.sock.send(packetObj, ("data", ch.userName, ch.moduleName, conflateKey))
+                else:
+                    ch.sock.send(packetObj)
+            ch.pendingSendList = []
+            self._connectChannel(ch.peerName)
+
+    def _recvRelayInfo(self, peerName, relayInfo):
+        # only nexus sends relay info to ordinary host
+        if not self.isStar or self.isNexus or peerName != self.nexusName:
+            self._sendReject(peerName, "unexpected relay-info packet received")
+            return
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self._sendReject(peerName, "relay-info packet received in state other than state-full")
+            return
+        if not isinstance(relayInfo.peerName, str):
+            self._sendReject(peerName, "invalid relay-info packet format")
+            return
+        if relayInfo.peerName not in self.peerInfoDict or relayInfo.peerName == self.nexusName:
+            return
+        if relayInfo.sysInfo is not None:
+            if not _type_check(relayInfo.sysInfo, SnSysInfo):
+                self._sendReject(peerName, "invalid relay-info packet format")
+                return
+            try:
+                errMsg = self._checkPeerInfo(relayInfo.sysInfo)
+            except (AttributeError, TypeError, ValueError):
+                self._sendReject(peerName, "invalid relay-info packet format")
                 return
+            if errMsg is not None:
+                logging.warning("SnPeerManager._recvRelayInfo: Invalid relay info for %s, %s", relayInfo.peerName, errMsg)
+                return
+
+        self.peerInfoDict[relayInfo.peerName].relayInfoObj = relayInfo.sysInfo
+        logging.info("SnPeerManager._recvRelayInfo: Peer %s is %s through nexus", relayInfo.peerName,
+                     "reachable" if relayInfo.sysInfo is not None else "unreachable")
+
+        # do notify, direct link overrides relay info
+        if self.peerInfoDict[relayInfo.peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self.param.localManager.onPeerChange(relayInfo.peerName, relayInfo.sysInfo)
+        self._notifyPowerStateChange(relayInfo.peerName)
+
+    def _recvRelayData(self, peerName, relayData):
+        if not self.isStar:
+            self._sendReject(peerName, "unexpected relay-data packet received")
+            return
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self._sendReject(peerName, "relay-data packet received in state other than state-full")
+            return
+
+        if self.isNexus:
+            # forward, source is the authenticated sender
+            dstPeerName = relayData.dstPeerName
+            if dstPeerName not in self.peerInfoDict or not self._peerHasCap(dstPeerName, "relay"):
+                logging.debug("SnPeerManager._recvRelayData: Drop packet from %s to unreachable peer %s", peerName, dstPeerName)
+                return
+            relayData.srcPeerName = peerName
+            self._sendObject(dstPeerName, relayData)
+        else:
+            if peerName != self.nexusName:
+                self._sendReject(peerName, "unexpected relay-data packet received")
+                return
+            srcPeerName = relayData.srcPeerName
+            if srcPeerName not in self.peerInfoDict or self.getPeerInfo(srcPeerName) is None:
+                logging.debug("SnPeerManager._recvRelayData: Drop packet from unknown peer %s", srcPeerName)
+                return
+            packetObj = relayData.data
+            self.param.localManager.onPeerSockRecv(srcPeerName, packetObj.srcUserName,
+                                                   packetObj.srcModuleName, packetObj.data)
+
+    def _checkPeerInfo(self, peerInfo):
+        """Returns error message, None if peer info is valid"""
+
+        if not isinstance(peerInfo.version, int):
+            return "invalid peer info version"
+
+        if not isinstance(peerInfo.userList, list) or not all(isinstance(x, str) for x in peerInfo.userList):
+            return "invalid peer user list"
+        if len(peerInfo.userList) != len(set(peerInfo.userList)):
+            return "duplicate element in peer user list"
+
+        if not isinstance(peerInfo.moduleList, list) or not all(isinstance(x, str) for x in peerInfo.moduleList):
+            return "invalid peer module list"
+        if len(peerInfo.moduleList) != len(set(peerInfo.moduleList)):
+            return "duplicate element in peer module list"
+
+        if not isinstance(peerInfo.moduleUserBitmap, list) or len(peerInfo.moduleUserBitmap) != len(peerInfo.moduleList):
+            return "invalid peer module user bitmap"
+
+        # each module name is checked once, no matter how many users it has
+        allUserBitmap = (1 << len(peerInfo.userList)) - 1
+        for moduleName, bitmap in zip(peerInfo.moduleList, peerInfo.moduleUserBitmap):
+            strList = moduleName.split("-")
+            if len(strList) < 3:
+                return "invalid module name \"%s\"" % (moduleName)
 
             moduleScope = strList[0]
             if moduleScope not in ["sys", "usr"]:
-                self._sendReject(peerName, "invalid module scope for module name \"%s\"" % (m.moduleName))
-                return
+                return "invalid module scope for module name \"%s\"" % (moduleName)
 
             moduleType = strList[1]
             if moduleType not in ["server", "client", "peer"]:
-                self._sendReject(peerName, "invalid module type for module name \"%s\"" % (m.moduleName))
-                return
+                return "invalid module type for module name \"%s\"" % (moduleName)
 
             moduleId = "-".join(strList[2:])
             if len(moduleId) > 32:
-                self._sendReject(peerName, "module id is too long for module name \"%s\"" % (m.moduleName))
-                return
+                return "module id is too long for module name \"%s\"" % (moduleName)
             if re.match("[A-Za-z0-9_]+", moduleId) is None:
-                self._sendReject(peerName, "invalid module id for module name \"%s\"" % (m.moduleName))
-                return
-
-        # do operation
-        oldFsmState = self.peerInfoDict[peerName].fsmState
-        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_FULL
-        self.peerInfoDict[peerName].infoObj = peerInfo
-        logging.info("SnPeerManager._recvPeerInfo: %s", _dbgmsg_peer_state_change(peerName, oldFsmState, self.peerInfoDict[peerName].fsmState))
+                return "invalid module id for module name \"%s\"" % (moduleName)
 
-        # do notify
-        self.param.localManager.onPeerChange(peerName, peerInfo)
-
-    def _recvPowerCap(self, peerName, powerCapObj):
-        
+            if not isinstance(bitmap, int) or bitmap & ~allUserBitmap != 0:
+                return "invalid user bitmap for module name \"%s\"" % (moduleName)
+            if moduleScope == "sys" and bitmap != 0:
+                return "invalid user bitmap for module name \"%s\"" % (moduleName)
 
+        return None
 
     def _recvPowerOp(self, peerName, powerOp):
-        if powerOp.name not in ["poweroff", "reboot", "suspend", "hibernate", "hybrid-sleep"]:
+        if powerOp.name not in _LOGIND_METHOD_DICT:
             self._sendReject(peerName, "invalid power operation name \"%s\"" % (powerOp.name))
             return
 
+        # check if the operation is allowed, the operation itself is done after the packets are sent
         try:
             dbusObj = dbus.SystemBus().get_object('org.freedesktop.login1', '/org/freedesktop/login1')
-            if powerOp.name == "poweroff":
-                dbusObj.PowerOff(False, dbus_interface='org.freedesktop.login1.Manager')
-            elif powerOp.name == "reboot":
-                dbusObj.Reboot(False, dbus_interface='org.freedesktop.login1.Manager')
-            elif powerOp.name == "suspend":
-                dbusObj.Suspend(False, dbus_interface='org.freedesktop.login1.Manager')
-            elif powerOp.name == "hibernate":
-                dbusObj.Hibernate(False, dbus_interface='org.freedesktop.login1.Manager')
-            elif powerOp.name == "hybrid-sleep":
-                dbusObj.HybridSleep(False, dbus_interface='org.freedesktop.login1.Manager')
-            else:
-                assert False
+            ret = getattr(dbusObj, _LOGIND_METHOD_DICT[powerOp.name][0])(dbus_interface='org.freedesktop.login1.Manager')
+            if ret != "yes":
+                raise Exception("power operation %s is not allowed, %s" % (powerOp.name, ret))
         except Exception as e:
             o = SnSysPacketPowerOpAck()
-            o.error_message = e.message
+            o.error_message = str(e)
             self._sendObject(peerName, o)
+            return
+
+        # tell all the peers our power state before we go offline
+        o = SnSysPacketPowerStateWhenInactive()
+        o.name = {
+            "poweroff": "poweroff",
+            "reboot": "rebooting",
+            "suspend": "suspend",
+            "hibernate": "hibernate",
+            "hybrid-sleep": "hybrid-sleep",
+        }[powerOp.name]
+        for pname, pinfo in self.peerInfoDict.items():
+            if pinfo.fsmState == _PeerInfoInternal.STATE_FULL:
+                self._sendObject(pname, o)
+
+        self._sendObject(peerName, SnSysPacketPowerOpAck())
+
+        # we go offline after the packets are sent out
+        SnUtil.timeoutInvoke(_POWER_OP_DELAY, self._doPowerOp, powerOp.name)
+
+    def _doPowerOp(self, opName):
+        try:
+            dbusObj = dbus.SystemBus().get_object('org.freedesktop.login1', '/org/freedesktop/login1')
+            getattr(dbusObj, _LOGIND_METHOD_DICT[opName][1])(False, dbus_interface='org.freedesktop.login1.Manager')
+        except Exception as e:
+            logging.error("SnPeerManager._doPowerOp: Power operation %s failed, %s", opName, str(e))
 
     def _recvPowerOpAck(self, peerName, powerOpAck):
-        opArgPower = self.peerInfoDict[peerName].opArgPower
-        if opArgPower is None:
-            self._sendReject(peerName, "invalid power operation acknowledgement received")
+        # acknowledgement may come after timeout
+        if self.peerInfoDict[peerName].opArgPower is None:
+            logging.info("SnPeerManager._recvPowerOpAck: Peer %s, no pending power operation", peerName)
             return
-
-        self.peerInfoDict[peerName].opArgPower = None
-        if powerOpAck.error_message is None:
-            opArgPower[0]()
-        else:
-            opArgPower[1](Exception(powerOpAck.error_message))
+        self._powerOpComplete(peerName, powerOpAck.error_message)
 
     def _recvPowerStateWhenInactive(self, peerName, powerStateWhenInactive):
         if powerStateWhenInactive.name == "poweroff":
@@ -499,6 +1455,82 @@ class SnPeerManager:
         else:
             self._sendReject(peerName, "invalid power state name \"%s\"" % (powerStateWhenInactive.name))
 
+    def _recvPowerTable(self, peerName, powerTable):
+        if self.peerInfoDict[peerName].fsmState != _PeerInfoInternal.STATE_FULL:
+            self._sendReject(peerName, "power state table received in state other than state-full")
+            return
+
+        # check all the entries before applying any of them
+        if not isinstance(powerTable.entryList, list):
+            self._sendReject(peerName, "invalid power state table")
+            return
+        hostNameList = list(self.peerInfoDict.keys()) + [socket.gethostname()]
+        for entry in powerTable.entryList:
+            if not isinstance(entry, tuple) or len(entry) != 4:
+                self._sendReject(peerName, "invalid entry in power state table")
+                return
+            hostName, powerState, timestamp, observerName = entry
+            if not isinstance(hostName, str) or hostName not in hostNameList:
+                self._sendReject(peerName, "invalid host name \"%s\" in power state table" % (hostName))
+                return
+            if not isinstance(observerName, str) or observerName not in hostNameList:
+                self._sendReject(peerName, "invalid observer name \"%s\" in power state table" % (observerName))
+                return
+            if not isinstance(powerState, int) or powerState < self.POWER_STATE_UNKNOWN or powerState > self.POWER_STATE_RUNNING:
+                self._sendReject(peerName, "invalid power state for host \"%s\" in power state table" % (hostName))
+                return
+            if not isinstance(timestamp, (int, float)):
+                self._sendReject(peerName, "invalid timestamp for host \"%s\" in power state table" % (hostName))
+                return
+
+        for hostName, powerState, timestamp, observerName in powerTable.entryList:
+            # keep the entry with the higher version
+            entry = self.powerTable.get(hostName)
+            if entry is not None and (timestamp, observerName) <= (entry[1], entry[2]):
+                continue
+            self.powerTableSeq += 1
+            self.powerTable[hostName] = (powerState, timestamp, observerName, self.powerTableSeq)
+            if hostName in self.peerInfoDict:
+                self._notifyPowerStateChange(hostName)
+
+            # we know better about ourself and the peers we are connected to
+            if hostName == socket.gethostname():
+                self._observePowerState(hostName, self.POWER_STATE_RUNNING)
+            elif self.peerInfoDict[hostName].fsmState == _PeerInfoInternal.STATE_FULL:
+                self._observePowerState(hostName, self.POWER_STATE_RUNNING)
+
+    def _powerOpComplete(self, peerName, errMsg):
+        pinfo = self.peerInfoDict[peerName]
+        opArgPower = pinfo.opArgPower
+        if pinfo.opPowerTimer is not None:
+            GLib.source_remove(pinfo.opPowerTimer)
+            pinfo.opPowerTimer = None
+        if pinfo.opPowerName in ["poweron", "wakeup"]:
+            self._wolStop(peerName)
+        pinfo.opArgPower = None
+        pinfo.opPowerName = None
+
+        if errMsg is None:
+            opArgPower[0]()
+        else:
+            opArgPower[1](Exception(errMsg))
+
+    def _wolStart(self, peerName):
+        hostInfo = self.param.configManager.getHostInfo(peerName)
+        self.wol.add(peerName, hostInfo.macAddr, hostInfo.broadcastAddr)
+
+        # connect to the peer when it is up, in any topology and connect mode
+        self.peerInfoDict[peerName].wantConnect = True
+        self._startOrStopPeerProbeTimer()
+
+    def _wolStop(self, peerName):
+        self.wol.remove(peerName)
+
+        pinfo = self.peerInfoDict[peerName]
+        if pinfo.dormantInfoObj is None and len(pinfo.pendingSendList) == 0:
+            pinfo.wantConnect = False
+            self._startOrStopPeerProbeTimer()
+
     def _recvReject(self, peerName, rejectMessage):
         logging.error("receive reject, %s, %s", peerName, rejectMessage)
 
@@ -509,10 +1541,476 @@ class SnPeerManager:
 
         self._startOrStopPeerProbeTimer()
 
-    def _sendObject(self, peerName, obj):
+    def _sendObject(self, peerName, obj, conflateKey=None):
         packetObj = SnSysPacket()
         packetObj.data = obj
-        self.peerInfoDict[peerName].sock.send(packetObj)
+        self.peerInfoDict[peerName].sock.send(packetObj, conflateKey)
+
+    def _sendAnnounce(self):
+        try:
+            addrList = SnUtil.getLocalIpv4AddressList()
+        except Exception as e:
+            logging.debug("SnPeerManager._sendAnnounce: Failed to get address list, %s", str(e))
+            addrList = []
+        self.discoverySock.send({
+            "hostname": socket.gethostname(),
+            "port": self.param.configManager.getHostInfo("localhost").port,
+            "addr-list": addrList,
+        })
+
+    def _sendHello(self, peerName):
+        # deltas queued before are included in the SnSysInfo of hello
+        self.peerInfoDict[peerName].pendingDeltaList = []
+        self.peerInfoDict[peerName].helloSent = True
+
+        hello = SnSysPacketHello()
+        hello.version = self.param.configManager.getVersion()
+        hello.capSet = set(_CAP_SET)
+        hello.cfg = self.param.configManager.getCfgSerializationObject()
+        hello.sysInfo = self.param.localManager.getLocalInfo()
+        hello.instanceId = self.instanceId
+        self._sendObject(peerName, hello)
+
+    def _sendKeepalive(self, peerName):
+        """Returns the timestamp in the keepalive packet"""
+        o = SnSysPacketKeepalive()
+        o.isReply = False
+        o.timestamp = time.monotonic()
+        self._sendObject(peerName, o)
+        return o.timestamp
+
+    def _sendPowerTable(self, peerName):
+        pinfo = self.peerInfoDict[peerName]
+        if pinfo.powerTableSentSeq >= self.powerTableSeq:
+            return
+
+        o = SnSysPacketPowerTable()
+        o.entryList = []
+        for hostName, entry in self.powerTable.items():
+            if entry[3] > pinfo.powerTableSentSeq:
+                o.entryList.append((hostName, entry[0], entry[1], entry[2]))
+        self._sendObject(peerName, o)
+        pinfo.powerTableSentSeq = self.powerTableSeq
+
+    def _observePowerState(self, hostName, powerState):
+        """Record our own observation of the power state of a host in the power state table"""
+
+        entry = self.powerTable.get(hostName)
+        if entry is not None and entry[0] == powerState:
+            return
+
+        # the new version must be higher than the old one even if the clocks are not synchronized
+        timestamp = time.time()
+        if entry is not None and timestamp <= entry[1]:
+            timestamp = entry[1] + 0.001
+
+        self.powerTableSeq += 1
+        self.powerTable[hostName] = (powerState, timestamp, socket.gethostname(), self.powerTableSeq)
+        if hostName in self.peerInfoDict:
+            self._notifyPowerStateChange(hostName)
+
+    def _notifyPowerStateChange(self, peerName):
+        """D-Bus signal is emitted later if the power state is really changed"""
+        if self.param.dbusMainObject is not None:
+            self.param.dbusMainObject.onPeerPowerStateChange(peerName)
+
+    def _getOutboxFile(self, peerName):
+        return os.path.join(self.param.outboxDir, "%s.db" % (peerName))
+
+    def _loadOutbox(self, peerName):
+        fn = self._getOutboxFile(peerName)
+        if not os.path.exists(fn):
+            return
+        try:
+            self.peerInfoDict[peerName].outbox = _PeerOutbox(fn)
+        except Exception as e:
+            logging.warning("SnPeerManager._loadOutbox: Invalid outbox file for peer %s, %s", peerName, str(e))
+            for fn2 in [fn, fn + ".new"]:
+                if os.path.exists(fn2):
+                    os.unlink(fn2)
+
+    def _connectPeer(self, peerName):
+        """The last working address is tried once, then the host name is resolved"""
+        pinfo = self.peerInfoDict[peerName]
+        hostaddr = None
+        if pinfo.lastAddr is not None and not pinfo.lastAddrTried:
+            hostaddr = pinfo.lastAddr
+            pinfo.lastAddrTried = True
+        self._clientConnect(peerName, self.param.configManager.getHostInfo(peerName).port, hostaddr)
+
+    def _clientConnect(self, peerName, port, hostaddr, hint=False):
+        if self.ioWorkerPool is not None:
+            self.ioWorkerPool.connect(peerName, port, hostaddr, hint)
+        else:
+            self.clientEndPoint.connect(peerName, port, hostaddr, hint)
+
+    def _loadPeerCache(self):
+        try:
+            self.peerCache = objdb(self.param.peerCacheFile)
+        except Exception as e:
+            logging.warning("SnPeerManager._loadPeerCache: Invalid peer cache file, %s", str(e))
+            for fn in [self.param.peerCacheFile, self.param.peerCacheFile + ".new"]:
+                if os.path.exists(fn):
+                    os.unlink(fn)
+            self.peerCache = objdb(self.param.peerCacheFile)
+
+        cache = self.peerCache.get_object()
+        if cache is None:
+            return
+        if not self._checkPeerCache(cache):
+            logging.warning("SnPeerManager._loadPeerCache: Invalid peer cache content, discarded")
+            return
+
+        hostNameList = list(self.peerInfoDict.keys()) + [socket.gethostname()]
+        for peerName, entry in cache["peer-dict"].items():
+            if peerName in self.peerInfoDict:
+                self.peerInfoDict[peerName].lastAddr = entry["addr"]
+        for hostName, entry in cache["power-table"].items():
+            if hostName in hostNameList and entry[2] in hostNameList:
+                self.powerTableSeq += 1
+                self.powerTable[hostName] = (entry[0], entry[1], entry[2], self.powerTableSeq)
+
+    def _savePeerCache(self):
+        cache = {
+            "peer-dict": dict(),
+            "power-table": dict(),
+        }
+        for peerName, pinfo in self.peerInfoDict.items():
+            if pinfo.lastAddr is not None:
+                cache["peer-dict"][peerName] = {
+                    "addr": pinfo.lastAddr,
+                }
+        for hostName, entry in self.powerTable.items():
+            cache["power-table"][hostName] = (entry[0], entry[1], entry[2])
+
+        try:
+            self.peerCache.set_object(cache)
+            self.peerCache.persist()
+        except Exception as e:
+            logging.warning("SnPeerManager._savePeerCache: Failed, %s", str(e))
+
+    def _savePeerCacheLater(self):
+        now = time.monotonic()
+        if self.peerCacheSaveTimer is None:
+            self.peerCacheSaveFirstTime = now
+        elif now - self.peerCacheSaveFirstTime + _PEER_CACHE_SAVE_DELAY > _PEER_CACHE_SAVE_MAX_DELAY:
+            return
+        else:
+            GLib.source_remove(self.peerCacheSaveTimer)
+        self.peerCacheSaveTimer = GObject.timeout_add_seconds(_PEER_CACHE_SAVE_DELAY, self.onPeerCacheSave)
+
+    def _checkPeerCache(self, cache):
+        """Returns False if the structure of the cache object is invalid"""
+
+        if not isinstance(cache, dict):
+            return False
+        if not isinstance(cache.get("peer-dict"), dict) or not isinstance(cache.get("power-table"), dict):
+            return False
+        for peerName, entry in cache["peer-dict"].items():
+            if not isinstance(peerName, str) or not isinstance(entry, dict) or not isinstance(entry.get("addr"), str):
+                return False
+        for hostName, entry in cache["power-table"].items():
+            if not isinstance(hostName, str) or not isinstance(entry, tuple) or len(entry) != 3:
+                return False
+            if not isinstance(entry[0], int) or entry[0] < self.POWER_STATE_UNKNOWN or entry[0] > self.POWER_STATE_RUNNING:
+                return False
+            if not isinstance(entry[1], (int, float)) or not isinstance(entry[2], str):
+                return False
+        return True
+
+    def _peerNeedConnect(self, peerName):
+        """In star topology, ordinary host only connects to nexus and the peers that have heavy flows.
+           In on-demand mode, only connects to the peers that something has to be sent to."""
+        if self.peerInfoDict[peerName].wantConnect:
+            return True
+        if self.onDemand:
+            return False
+        if not self.isStar or self.isNexus:
+            return True
+        return peerName == self.nexusName or self.peerInfoDict[peerName].wantDirect
+
+    def _peerHasCap(self, peerName, capName):
+        """Capability set of the connection is known in STATE_FULL"""
+        pinfo = self.peerInfoDict[peerName]
+        return pinfo.fsmState == _PeerInfoInternal.STATE_FULL and capName in pinfo.capSet
+
+    def _peerIsIdle(self, peerName):
+        pinfo = self.peerInfoDict[peerName]
+        if not self._peerHasCap(peerName, "idle-close") or pinfo.idleClosing:
+            return False
+        if pinfo.opArgPower is not None or len(pinfo.pendingSendList) > 0:
+            return False
+        return time.monotonic() - pinfo.lastActive > self.param.configManager.getPeerIdleTimeout()
+
+    def _queueOnDemand(self, peerName, packetObj):
+        """packetObj is SnDataPacket or SnSysPacket data, sent after the peer is connected again,
+           packetObj is None if only connecting is needed"""
+
+        # power operation is not limited, there's at most one for a peer
+        pinfo = self.peerInfoDict[peerName]
+        if not _type_check(packetObj, SnSysPacketPowerOp) and len(pinfo.pendingSendList) >= _PENDING_SEND_MAX:
+            # peer doesn't come back, forget it
+            logging.info("SnPeerManager._queueOnDemand: Peer %s doesn't come back, dropping dormant info", peerName)
+            self._dropDormant(peerName)
+            return
+
+        if packetObj is not None:
+            pinfo.pendingSendList.append(packetObj)
+        if not pinfo.wantConnect:
+            pinfo.wantConnect = True
+            if pinfo.fsmState == _PeerInfoInternal.STATE_NONE:
+                self._connectPeer(peerName)
+            self._startOrStopPeerProbeTimer()
+
+    def _peerFullNotify(self, peerName, instanceId):
+        """Called when peer goes into STATE_FULL, resumes the dormant peer if it is not changed"""
+
+        pinfo = self.peerInfoDict[peerName]
+        resume = (pinfo.dormantInfoObj is not None and pinfo.dormantInfoObj == pinfo.infoObj
+                  and instanceId is not None and instanceId == pinfo.instanceId
+                  and self._peerHasCap(peerName, "resumption"))
+        pinfo.instanceId = instanceId
+
+        # power state table
+        pinfo.powerTableSentSeq = 0
+        self._observePowerState(peerName, self.POWER_STATE_RUNNING)
+
+        self._savePeerCacheLater()
+
+        # leave dormant state
+        dormantInfoObj = pinfo.dormantInfoObj
+        pendingSendList = pinfo.pendingSendList
+        if pinfo.graceTimer is not None:
+            GLib.source_remove(pinfo.graceTimer)
+            pinfo.graceTimer = None
+        pinfo.dormantInfoObj = None
+        pinfo.pendingSendList = []
+        pinfo.wantConnect = False
+        pinfo.lastActive = time.monotonic()
+        self._startOrStopPeerProbeTimer()
+
+        # do notify, module objects of a changed or restarted peer are created again
+        if resume:
+            logging.info("SnPeerManager._peerFullNotify: Peer %s resumed", peerName)
+        else:
+            if dormantInfoObj is not None:
+                self.param.localManager.onPeerChange(peerName, None)
+            self.param.localManager.onPeerChange(peerName, pinfo.infoObj)
+        self._relayPeerInfo(peerName)
+
+        # peer is waken up
+        if pinfo.opArgPower is not None and pinfo.opPowerName in ["poweron", "wakeup"]:
+            self._powerOpComplete(peerName, None)
+
+        # send the queued packets, data packets are for the old module objects
+        for packetObj in pendingSendList:
+            if _type_check(packetObj, SnDataPacket):
+                if not resume:
+                    continue
+                pinfo.sock.send(packetObj)
+            else:
+                self._sendObject(peerName, packetObj)
+
+        # send the durable outbox, objects are removed from outbox after peer receives them
+        # the echo of the keepalive sent after them tells it, legacy peer doesn't echo
+        if pinfo.outbox is not None:
+            for srcUserName, srcModuleName, obj in pinfo.outbox.takeAll():
+                if not self.param.localManager.hasPeerModule(pinfo.infoObj, srcUserName, srcModuleName):
+                    logging.info("SnPeerManager._peerFullNotify: Peer %s has no module for %s, drop outbox data", peerName, srcModuleName)
+                    continue
+                packetObj = SnDataPacket()
+                packetObj.srcUserName = srcUserName
+                packetObj.srcModuleName = srcModuleName
+                packetObj.data = obj
+                pinfo.sock.send(packetObj)
+            if self._peerHasCap(peerName, "heartbeat"):
+                pinfo.outboxAckTimestamp = self._sendKeepalive(peerName)
+            else:
+                pinfo.outbox.commit()
+
+    def _dropDormant(self, peerName):
+        """Forget the dormant peer, its module objects are removed"""
+
+        pinfo = self.peerInfoDict[peerName]
+        if pinfo.graceTimer is not None:
+            GLib.source_remove(pinfo.graceTimer)
+            pinfo.graceTimer = None
+        pinfo.dormantInfoObj = None
+        pendingSendList = pinfo.pendingSendList
+        pinfo.pendingSendList = []
+        pinfo.wantConnect = False
+
+        # the queued power operation fails now, instead of timeout
+        if any(_type_check(x, SnSysPacketPowerOp) for x in pendingSendList):
+            self._powerOpComplete(peerName, "peer is not reachable")
+
+        if pinfo.fsmState != _PeerInfoInternal.STATE_FULL:
+            self._observePowerState(peerName, pinfo.powerStateWhenInactive)
+            self.param.localManager.onPeerChange(peerName, self.getPeerInfo(peerName))
+            self._relayPeerInfo(peerName)
+            if self.isStar and peerName == self.nexusName:
+                self._clearRelayInfo()
+        self._startOrStopPeerProbeTimer()
+
+    def _getChannel(self, peerName, userName, moduleName):
+        """Returns the channel of the module, channel is requested if it doesn't exist"""
+
+        pinfo = self.peerInfoDict[peerName]
+        if (userName, moduleName) not in pinfo.channelDict:
+            ch = _PeerChannel()
+            ch.peerName = peerName
+            ch.userName = userName
+            ch.moduleName = moduleName
+            ch.isInitiator = True
+            ch.established = False
+            ch.failed = False
+            ch.pendingSendList = []
+            ch.createTime = time.monotonic()
+            pinfo.channelDict[(userName, moduleName)] = ch
+
+            o = SnSysPacketChannelOpen()
+            o.userName = userName
+            o.moduleName = moduleName
+            self._sendObject(peerName, o)
+        return pinfo.channelDict[(userName, moduleName)]
+
+    def _connectChannel(self, peerName):
+        """Channels are connected one by one, peer client does only one connect to a peer at a time"""
+        pinfo = self.peerInfoDict[peerName]
+        if any(ch.token is not None and ch.sock is None and not ch.failed for ch in pinfo.channelDict.values()):
+            self._clientConnect(peerName, self.param.configManager.getHostInfo(peerName).port, pinfo.lastAddr)
+
+    def _addChannelSocket(self, peerName, sock, isClient):
+        pinfo = self.peerInfoDict[peerName]
+        if isClient:
+            chList = [ch for ch in pinfo.channelDict.values() if ch.token is not None and ch.sock is None and not ch.failed]
+            if len(chList) == 0:
+                logging.debug("SnPeerManager._addChannelSocket: Fail, no channel for the connection to %s", peerName)
+                sock.close()
+                return
+            ch = chList[0]
+        else:
+            # bound to a channel by the channel hello
+            ch = _PeerChannel()
+            ch.peerName = peerName
+            ch.isInitiator = False
+            ch.established = False
+            ch.failed = False
+            ch.createTime = time.monotonic()
+
+        ch.sock = sock
+        self.channelDict[sock] = ch
+        if self._peerHasCap(peerName, "compression"):
+            sock.enable_compress()
+        if isClient:
+            self._sendChannelHello(ch)
+
+    def _sendChannelHello(self, ch):
+        packetObj = SnSysPacket()
+        packetObj.data = SnSysPacketChannelHello()
+        packetObj.data.token = ch.token
+        ch.sock.send(packetObj)
+
+    def _closeChannel(self, ch):
+        if ch.sock is not None:
+            del self.channelDict[ch.sock]
+            ch.sock.close()
+            ch.sock = None
+
+        pinfo = self.peerInfoDict[ch.peerName]
+        if ch.isInitiator:
+            if pinfo.channelDict.get((ch.userName, ch.moduleName)) is ch:
+                del pinfo.channelDict[(ch.userName, ch.moduleName)]
+        else:
+            if ch.token is not None and pinfo.channelTokenDict.get(ch.token) is ch:
+                del pinfo.channelTokenDict[ch.token]
+
+    def _failChannel(self, ch):
+        """Held data and the later bulk data of the channel go to the control connection"""
+
+        if ch.sock is not None:
+            del self.channelDict[ch.sock]
+            ch.sock.close()
+            ch.sock = None
+        ch.failed = True
+
+        for packetObj, conflateKey in ch.pendingSendList:
+            if conflateKey is not None:
+                self.peerInfoDict[ch.peerName].sock.send(packetObj, ("data", ch.userName, ch.moduleName, conflateKey))
+            else:
+                self.peerInfoDict[ch.peerName].sock.send(packetObj)
+        ch.pendingSendList = []
+
+    def _dropChannel(self, ch):
+        """Our channel that is not established fails, the others are closed"""
+        if ch.isInitiator and not ch.established:
+            self._failChannel(ch)
+        else:
+            self._closeChannel(ch)
+
+    def _closeAllChannels(self, peerName):
+        pinfo = self.peerInfoDict[peerName]
+        chList = [ch for ch in self.channelDict.values() if ch.peerName == peerName]
+        chList += [ch for ch in pinfo.channelDict.values() if ch not in chList]
+        chList += [ch for ch in pinfo.channelTokenDict.values() if ch not in chList]
+        for ch in chList:
+            self._closeChannel(ch)
+
+    def _expireChannels(self):
+        now = time.monotonic()
+        chList = list(set(self.channelDict.values()))
+        for pinfo in self.peerInfoDict.values():
+            chList += [ch for ch in pinfo.channelDict.values() if ch not in chList]
+            chList += [ch for ch in pinfo.channelTokenDict.values() if ch not in chList]
+        for ch in chList:
+            if not ch.established and not ch.failed and now - ch.createTime > _CHANNEL_OPEN_TIMEOUT:
+                logging.info("SnPeerManager._expireChannels: Channel of %s is not established, closing", ch.peerName)
+                self._dropChannel(ch)
+            elif ch.established and ch.isInitiator and now - ch.lastActive > _CHANNEL_IDLE_TIMEOUT:
+                logging.info("SnPeerManager._expireChannels: Channel of %s is idle, closing", ch.peerName)
+                self._closeChannel(ch)
+
+    def _countRelayData(self, peerName):
+        pinfo = self.peerInfoDict[peerName]
+        pinfo.relayCount += 1
+
+        threshold = self.param.configManager.getDirectLinkThreshold()
+        if threshold > 0 and pinfo.relayCount > threshold and not pinfo.wantDirect:
+            logging.info("SnPeerManager._countRelayData: Heavy flow to %s, setting up direct link", peerName)
+            pinfo.wantDirect = True
+            self._connectPeer(peerName)
+            self._startOrStopPeerProbeTimer()
+
+    def _relayPeerInfo(self, peerName):
+        """Nexus tells the other peers about the change of peer"""
+        if not self.isStar or not self.isNexus:
+            return
+
+        o = SnSysPacketRelayInfo()
+        o.peerName = peerName
+        o.sysInfo = self.peerInfoDict[peerName].infoObj
+        for pname, pinfo in self.peerInfoDict.items():
+            if pname != peerName and self._peerHasCap(pname, "relay"):
+                self._sendObject(pname, o)
+
+        # new peer gets the info of all the other peers
+        if o.sysInfo is not None and self._peerHasCap(peerName, "relay"):
+            for pname, pinfo in self.peerInfoDict.items():
+                if pname != peerName and pinfo.fsmState == _PeerInfoInternal.STATE_FULL:
+                    o2 = SnSysPacketRelayInfo()
+                    o2.peerName = pname
+                    o2.sysInfo = pinfo.infoObj
+                    self._sendObject(peerName, o2)
+
+    def _clearRelayInfo(self):
+        """Called when ordinary host loses the link to nexus"""
+        for pname, pinfo in self.peerInfoDict.items():
+            if pinfo.relayInfoObj is None:
+                continue
+            pinfo.relayInfoObj = None
+            if pinfo.fsmState != _PeerInfoInternal.STATE_FULL:
+                self.param.localManager.onPeerChange(pname, None)
+            self._notifyPowerStateChange(pname)
 
     def _sendReject(self, peerName, rejectMessage):
         logging.error("send reject, closing gracefully, %s, %s", peerName, rejectMessage)
@@ -536,37 +2034,106 @@ class SnPeerManager:
 
         self._startOrStopPeerProbeTimer()
 
+    def _peerToIdle(self, peerName):
+        oldState = self.peerInfoDict[peerName].fsmState
+        assert oldState == _PeerInfoInternal.STATE_FULL
+
+        # remove socket, keep peer info as dormant info, no notify since module objects are kept
+        self._closeAllChannels(peerName)
+        del self.sockPeerDict[self.peerInfoDict[peerName].sock]
+        self.peerInfoDict[peerName].sock.close()
+        self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_NONE
+        self.peerInfoDict[peerName].dormantInfoObj = self.peerInfoDict[peerName].infoObj
+        self.peerInfoDict[peerName].infoObj = None
+        self.peerInfoDict[peerName].sock = None
+        self.peerInfoDict[peerName].rtt = None
+        self.peerInfoDict[peerName].idleClosing = False
+        logging.info("SnPeerManager._peerToIdle: %s", _dbgmsg_peer_state_change(peerName, oldState, _PeerInfoInternal.STATE_NONE))
+
+        self._relayPeerInfo(peerName)
+        self._startOrStopPeerProbeTimer()
+
+        # something is queued while closing, durable data may be appended to outbox while closing
+        pinfo = self.peerInfoDict[peerName]
+        if len(pinfo.pendingSendList) > 0:
+            self._connectPeer(peerName)
+        elif pinfo.outbox is not None and not pinfo.outbox.isEmpty():
+            self._queueOnDemand(peerName, None)
+
+    def _peerCanGrace(self, peerName):
+        """Only the peer that is lost unexpectedly gets a grace period"""
+        pinfo = self.peerInfoDict[peerName]
+        if self.param.configManager.getPeerReconnectGrace() == 0:
+            return False
+        if not self._peerHasCap(peerName, "resumption"):
+            return False
+        return pinfo.opArgPower is None and pinfo.powerStateWhenInactive == self.POWER_STATE_UNKNOWN
+
+    def _peerToGrace(self, peerName):
+        self._peerToIdle(peerName)
+
+        # reconnect immediately in any topology and connect mode
+        pinfo = self.peerInfoDict[peerName]
+        pinfo.wantConnect = True
+        pinfo.graceTimer = GObject.timeout_add_seconds(self.param.configManager.getPeerReconnectGrace(),
+                                                       self.onPeerGraceTimeout, peerName)
+        if len(pinfo.pendingSendList) == 0 and (pinfo.outbox is None or pinfo.outbox.isEmpty()):
+            self._connectPeer(peerName)
+        self._startOrStopPeerProbeTimer()
+
     def _peerToShutdown(self, peerName):
         oldState = self.peerInfoDict[peerName].fsmState
 
         # remove peer, don't modify powerStateWhenInactive
+        self._closeAllChannels(peerName)
+        del self.sockPeerDict[self.peerInfoDict[peerName].sock]
         self.peerInfoDict[peerName].sock.close()
         self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_NONE
         self.peerInfoDict[peerName].infoObj = None
         self.peerInfoDict[peerName].sock = None
-        self.peerInfoDict[peerName].opArgPower = None
+        if self.peerInfoDict[peerName].opArgPower is not None:
+            self._powerOpComplete(peerName, "connection lost")
+        self.peerInfoDict[peerName].rtt = None
+        self.peerInfoDict[peerName].wantDirect = False
+        self.peerInfoDict[peerName].idleClosing = False
+        self._notifyPowerStateChange(peerName)
 
-        # do notify
+        # do notify, peer may be still reachable through nexus
         if oldState == _PeerInfoInternal.STATE_FULL:
-            self.param.localManager.onPeerChange(peerName, None)
+            self._observePowerState(peerName, self.peerInfoDict[peerName].powerStateWhenInactive)
+            self.param.localManager.onPeerChange(peerName, self.getPeerInfo(peerName))
+            self._relayPeerInfo(peerName)
+            if self.isStar and peerName == self.nexusName:
+                self._clearRelayInfo()
 
     def _peerToReject(self, peerName):
         oldState = self.peerInfoDict[peerName].fsmState
 
         # remove peer
+        self._closeAllChannels(peerName)
+        del self.sockPeerDict[self.peerInfoDict[peerName].sock]
         self.peerInfoDict[peerName].sock.close()
         self.peerInfoDict[peerName].powerStateWhenInactive = self.POWER_STATE_UNKNOWN
         self.peerInfoDict[peerName].fsmState = _PeerInfoInternal.STATE_REJECT
         self.peerInfoDict[peerName].infoObj = None
         self.peerInfoDict[peerName].sock = None
-        self.peerInfoDict[peerName].opArgPower = None
+        if self.peerInfoDict[peerName].opArgPower is not None:
+            self._powerOpComplete(peerName, "connection lost")
+        self.peerInfoDict[peerName].rtt = None
+        self.peerInfoDict[peerName].wantDirect = False
+        self.peerInfoDict[peerName].idleClosing = False
+        self._notifyPowerStateChange(peerName)
 
-        # do notify
+        # do notify, peer may be still reachable through nexus
         if oldState == _PeerInfoInternal.STATE_FULL:
-            self.param.localManager.onPeerChange(peerName, None)
+            self._observePowerState(peerName, self.peerInfoDict[peerName].powerStateWhenInactive)
+            self.param.localManager.onPeerChange(peerName, self.getPeerInfo(peerName))
+            self._relayPeerInfo(peerName)
+            if self.isStar and peerName == self.nexusName:
+                self._clearRelayInfo()
 
     def _startOrStopPeerProbeTimer(self):
-        if any(x for x in list(self.peerInfoDict.values()) if x.fsmState == _PeerInfoInternal.STATE_NONE):
+        if any(x for x in list(self.peerInfoDict.keys()) if self.peerInfoDict[x].fsmState == _PeerInfoInternal.STATE_NONE and self._peerNeedConnect(x)):
             if self.peerProbeTimer is None:
                 logging.debug("SnPeerManager._startOrStopPeerProbeTimer: Peer probe timer starts")
                 interval = self.param.configManager.getPeerProbeInterval()
@@ -595,6 +2162,216 @@ class _PeerInfoInternal:
     infoObj = None                            # obj, SnSysInfo
     sock = None                                # obj, peer socket
     opArgPower = None                        # (okFunc, errFunc)
+    opPowerName = None                       # str, name of the pending power operation, can be None
+    opPowerTimer = None                      # int, GLib source id of the power operation timer, can be None
+    keepaliveMiss = None                     # int
+    rtt = None                               # float, smoothed round trip time in seconds, can be None
+    relayInfoObj = None                      # obj, SnSysInfo relayed by nexus, can be None
+    relayCount = None                        # int, data packets relayed by nexus in current minute
+    wantDirect = None                        # bool, direct link is needed in star topology
+    wantConnect = None                       # bool, connect is needed in on-demand mode
+    idleClosing = None                       # bool, SnSysPacketIdleClose is sent
+    dormantInfoObj = None                    # obj, SnSysInfo kept after idle close, can be None
+    pendingSendList = None                   # list<obj>, sent after the dormant peer is connected
+    lastActive = None                        # float, time.monotonic() of the last data packet
+    powerTableSentSeq = None                 # int, power state table entries up to this seq are sent
+    instanceId = None                        # str, daemon instance id of the last connection, can be None
+    graceTimer = None                        # int, GLib source id of the reconnect grace timer, can be None
+    lastAddr = None                          # str, last working address, can be None
+    lastAddrTried = None                     # bool, lastAddr is tried in the current connect round
+    lastHintConnect = None                   # float, time.monotonic() of the last connect with the address in announce, can be None
+    capSet = None                            # set<str>, negotiated capabilities of the last connection, can be None
+    pendingDeltaList = None                  # list<obj>, SnSysInfoDelta sent after hello is received
+    helloSent = None                         # bool, SnSysPacketHello is sent in current connection
+    outbox = None                            # obj, _PeerOutbox, can be None
+    outboxAckTimestamp = None                # float, timestamp of the keepalive sent after the outbox, can be None
+    channelDict = None                       # dict<(str, str), _PeerChannel>, channels initiated by us
+    channelTokenDict = None                  # dict<str, _PeerChannel>, channels accepted by us, indexed by token
+
+
+class _PeerChannel:
+    peerName = None                          # str
+    userName = None                          # str, can be None
+    moduleName = None                        # str, source module name of the data
+    isInitiator = None                       # bool, channel is requested and connected by us
+    token = None                             # str, given by acceptor, can be None
+    sock = None                              # obj, channel socket, can be None
+    established = None                       # bool
+    failed = None                            # bool, our channel is refused or not established in time
+    pendingSendList = None                   # list<(SnDataPacket, conflateKey)>, bulk data held until our channel is established
+    createTime = None                        # float, time.monotonic()
+    lastActive = None                        # float, time.monotonic() of the last data packet
+
+
+class _PeerOutbox:
+
+    """Durable data objects for a peer, saved in an append-only log file. Every
+       change appends a record, the file is rewritten when most of the records
+       are obsolete. Sent objects are kept until commit() is called, they are
+       sent again in the next connection if the connection is lost before"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.itemDict = collections.OrderedDict()    # seq -> [timestamp, srcUserName, srcModuleName, obj, conflateKey]
+        self.keyDict = dict()                        # (srcUserName, srcModuleName) -> list<seq>
+        self.conflateKeyDict = dict()                # (srcUserName, srcModuleName, conflateKey) -> seq
+        self.seq = 0
+        self.sentSeq = 0                             # objects with seq <= sentSeq are sent in current connection
+        self.recordNum = 0
+        self.logFile = None
+
+        # a leftover temporary file is from an interrupted rewrite, the log file is intact
+        if os.path.exists(self.filename + ".new"):
+            os.unlink(self.filename + ".new")
+
+        # read records, a partial record at the end is from an interrupted append
+        if os.path.exists(self.filename):
+            with open(self.filename, "rb") as f:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except EOFError:
+                        break
+                    except pickle.UnpicklingError:
+                        logging.warning("_PeerOutbox.__init__: Partial record at the end of %s dropped", self.filename)
+                        break
+                    self._applyRecord(record)
+        self._rewrite()
+
+    def dispose(self):
+        self.logFile.close()
+        self.logFile = None
+
+    def isEmpty(self):
+        return len(self.itemDict) == 0
+
+    def hasUnsent(self):
+        return len(self.itemDict) > 0 and next(reversed(self.itemDict)) > self.sentSeq
+
+    def append(self, srcUserName, srcModuleName, obj, conflateKey=None):
+        # newer object replaces the older one with the same conflate key, unless the older one is sent
+        if conflateKey is not None:
+            seq = self.conflateKeyDict.get((srcUserName, srcModuleName, conflateKey))
+            if seq is not None and seq > self.sentSeq:
+                self._writeRecord(("replace", seq, time.time(), obj))
+                return
+
+        # drop the oldest one for the same (user, module)
+        seqList = self.keyDict.get((srcUserName, srcModuleName), [])
+        if len(seqList) >= _OUTBOX_MAX:
+            logging.info("_PeerOutbox.append: Outbox is full for %s, drop the oldest data", srcModuleName)
+            self._writeRecord(("remove", [seqList[0]]))
+
+        self._writeRecord(("add", self.seq + 1, time.time(), srcUserName, srcModuleName, obj, conflateKey))
+
+    def takeAll(self):
+        """Returns list of (srcUserName, srcModuleName, obj) that are not expired, they are
+           marked as sent and returned again if takeAll() is called before commit()"""
+
+        now = time.time()
+        expireList = [seq for seq, x in self.itemDict.items() if now - x[0] >= _OUTBOX_MAX_AGE]
+        if len(expireList) > 0:
+            logging.info("_PeerOutbox.takeAll: %d expired data dropped", len(expireList))
+            self._writeRecord(("remove", expireList))
+
+        self.sentSeq = self.seq
+        return [(x[1], x[2], x[3]) for x in self.itemDict.values()]
+
+    def commit(self):
+        """Objects returned by the last takeAll() are received by peer, remove them"""
+
+        removeList = [seq for seq in self.itemDict if seq <= self.sentSeq]
+        if len(removeList) > 0:
+            self._writeRecord(("remove", removeList))
+        self.sentSeq = 0
+
+    def _writeRecord(self, record):
+        self._applyRecord(record)
+        if self.recordNum > _OUTBOX_REWRITE_RECORD_NUM and self.recordNum > len(self.itemDict) * 2:
+            self._rewrite()
+        else:
+            pickle.dump(record, self.logFile)
+            self.logFile.flush()
+
+    def _applyRecord(self, record):
+        if record[0] == "add":
+            dummy, seq, timestamp, srcUserName, srcModuleName, obj, conflateKey = record
+            self.itemDict[seq] = [timestamp, srcUserName, srcModuleName, obj, conflateKey]
+            self.keyDict.setdefault((srcUserName, srcModuleName), []).append(seq)
+            if conflateKey is not None:
+                self.conflateKeyDict[(srcUserName, srcModuleName, conflateKey)] = seq
+            self.seq = max(self.seq, seq)
+        elif record[0] == "replace":
+            dummy, seq, timestamp, obj = record
+            self.itemDict[seq][0] = timestamp
+            self.itemDict[seq][3] = obj
+        elif record[0] == "remove":
+            for seq in record[1]:
+                timestamp, srcUserName, srcModuleName, obj, conflateKey = self.itemDict.pop(seq)
+                self.keyDict[(srcUserName, srcModuleName)].remove(seq)
+                if len(self.keyDict[(srcUserName, srcModuleName)]) == 0:
+                    del self.keyDict[(srcUserName, srcModuleName)]
+                if self.conflateKeyDict.get((srcUserName, srcModuleName, conflateKey)) == seq:
+                    del self.conflateKeyDict[(srcUserName, srcModuleName, conflateKey)]
+        else:
+            raise ValueError("invalid outbox record type \"%s\"" % (record[0]))
+        self.recordNum += 1
+
+    def _rewrite(self):
+        if self.logFile is not None:
+            self.logFile.close()
+        with open(self.filename + ".new", "wb") as f:
+            for seq, x in self.itemDict.items():
+                pickle.dump(("add", seq, x[0], x[1], x[2], x[3], x[4]), f)
+        os.rename(self.filename + ".new", self.filename)
+        self.recordNum = len(self.itemDict)
+        self.logFile = open(self.filename, "ab")
+
+
+_CAP_SET = frozenset(["heartbeat", "sysinfo-delta", "power-table", "idle-close", "resumption", "relay", "compression", "channels"])
+
+_PENDING_SEND_MAX = 1000
+
+_OUTBOX_MAX = 1000
+
+_OUTBOX_MAX_AGE = 7 * 24 * 3600
+
+_OUTBOX_REWRITE_RECORD_NUM = 1000
+
+_POWER_OP_TIMEOUT = 30
+
+_POWER_OP_DELAY = 1
+
+_PEER_CACHE_SAVE_DELAY = 10
+
+_HINT_CONNECT_INTERVAL = 10
+
+_PEER_CACHE_SAVE_MAX_DELAY = 60
+
+_LOGIND_METHOD_DICT = {                 # power operation name -> (check method, operation method)
+    "poweroff": ("CanPowerOff", "PowerOff"),
+    "reboot": ("CanReboot", "Reboot"),
+    "suspend": ("CanSuspend", "Suspend"),
+    "hibernate": ("CanHibernate", "Hibernate"),
+    "hybrid-sleep": ("CanHybridSleep", "HybridSleep"),
+}
+
+_WOL_TIMEOUT = 180                      # selfnetctl waits longer than it, see _POWER_OP_DBUS_TIMEOUT in sn_subcmd
+
+_CHANNEL_MAX = 16
+
+_CHANNEL_OPEN_TIMEOUT = 30
+
+_CHANNEL_IDLE_TIMEOUT = 300
+
+
+def _version_compatible(version1, version2):
+    return version1.version.split(".")[0] == version2.version.split(".")[0]
+
+
+def _is_module_tuple(obj):
+    """(moduleName, userName), userName is None for sys module"""
+    return isinstance(obj, tuple) and len(obj) == 2 and isinstance(obj[0], str) and (obj[1] is None or isinstance(obj[1], str))
 
 
 def _dbgmsg_peer_state_change(peerName, oldPeerState, peerState):
@@ -83,8 +83,15 @@ class SnModuleInstance:
             os.mkdir(self.tmpDir)
         return self.tmpDir
 
-    def sendObject(self, obj):
-        self.coreObj._sendObject(self.peerName, self.userName, self.moduleName, obj)
+    def sendObject(self, obj, persist=False, conflateKey=None, bulk=False):
+        """If persist is True, obj is saved on disk when the peer is not connected,
+           and is sent when the peer is connected again, even after daemon restart.
+           If conflateKey is not None, obj replaces the not yet sent object with the
+           same conflateKey, use it for state snapshots where only the newest one matters.
+           If bulk is True, obj is sent by a dedicated connection of this module, which
+           is set up on first use, so large transfers don't delay the other traffic.
+           Bulk objects may be reordered with the other objects."""
+        self.coreObj._sendObject(self.peerName, self.userName, self.moduleName, obj, persist, conflateKey, bulk)
 
     def setWorkState(self, workState):
         assert workState in [SnModuleInstance.WORK_STATE_IDLE, SnModuleInstance.WORK_STATE_WORKING]
@@ -13,6 +13,7 @@ class SnParam:
         self.dataDir = "/usr/share/selfnetd"
         self.moduleDir = os.path.join(self.libDir, "modules")
         self.runDir = "/run/selfnetd"
+        self.varDir = "/var/lib/selfnetd"
         self.logDir = "/var/log/selfnetd"
 
         self.certFile = os.path.join(self.cfgDir, "my-cert.pem")
@@ -28,6 +29,9 @@ class SnParam:
         self.socketFile = os.path.join(self.runDir, "selfnetd.socket")
         self.logFile = os.path.join(self.logDir, "selfnetd.log")
         self.workerProcFile = os.path.join(self.libexecDir, "worker-proc.py")
+        self.peerIoWorkerFile = os.path.join(self.libexecDir, "peer-io-worker.py")
+        self.peerCacheFile = os.path.join(self.varDir, "peer-cache.db")
+        self.outboxDir = os.path.join(self.varDir, "outbox")
 
         self.discoveryIp = "224.0.0.251"
         self.discoveryPort = 2109
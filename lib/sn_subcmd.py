@@ -6,8 +6,18 @@ import dbus
 import random
 import zipfile
 import socket
-from OpenSSL import crypto
+import datetime
+import concurrent.futures
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from sn_util import SnUtil
+from sn_manager_config import SnConfigManager
 
 
 class SnSubCmdMain:
@@ -15,54 +25,64 @@ class SnSubCmdMain:
     def __init__(self, param):
         self.param = param
 
-    def generateCaCert(self):
+    def generateCaCert(self, keyType="rsa"):
         # generate certificate and private key
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 1024)
-
-        cert = crypto.X509()
-        cert.get_subject().CN = "selfnet"
-        cert.set_serial_number(random.randint(0, 65535))
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(36500 * 24 * 3600)
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(k)
-        cert.sign(k, 'sha1')
+        k = _genKey(keyType)
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "selfnet")])
+        cert = _buildCert(subject, k.public_key(), subject, k)
 
         # save certificate and private key
         self._dumpCertAndKey(cert, k, self.param.caCertFile, self.param.caPrivkeyFile)
 
-    def generateMyCert(self):
+    def generateMyCert(self, keyType="rsa"):
         # get CA certificate and private key
         caCert, caKey = self._loadCertAndKey(self.param.caCertFile, self.param.caPrivkeyFile)
 
         # generate certificate and private key
-        cert, k = self._genCertAndKey(caCert, caKey, socket.gethostname())
+        cert, k = self._genCertAndKey(caCert, caKey, socket.gethostname(), keyType)
 
         # save certificate and private key
         certFile = os.path.join(self.param.cfgDir, os.path.basename(self.param.certFile))
         privkeyFile = os.path.join(self.param.cfgDir, os.path.basename(self.param.privkeyFile))
         self._dumpCertAndKey(cert, k, certFile, privkeyFile)
 
-    def generateCert(self, hostname, outDir):
+    def generateCert(self, hostnameList, outDir, keyType="rsa", allHosts=False, jobNum=None):
         if outDir is None:
             outDir = "."
 
-        # get CA certificate and private key
+        hostnameList = list(hostnameList)
+        if allHosts:
+            for hostname in SnConfigManager.readHostNameList(self.param.hostsFile):
+                if hostname not in hostnameList:
+                    hostnameList.append(hostname)
+        if len(hostnameList) == 0:
+            raise Exception("no host specified")
+
+        # get CA certificate and private key, only once for all the hosts
         caCert, caKey = self._loadCertAndKey(self.param.caCertFile, self.param.caPrivkeyFile)
 
-        # generate certificate and private key
-        cert, k = self._genCertAndKey(caCert, caKey, hostname)
-
-        # save CA certificate, certificate and private key to a zip file for distributing
-        certFileInfo = zipfile.ZipInfo(os.path.basename(self.param.certFile))
-        certFileInfo.external_attr = 0o644 << 16
-        privkeyFileInfo = zipfile.ZipInfo(os.path.basename(self.param.privkeyFile))
-        privkeyFileInfo.external_attr = 0o600 << 16
-        with zipfile.ZipFile(os.path.join(outDir, "selfnet-distribute_%s.zip" % (hostname)), "w") as zipf:
-            zipf.write(self.param.caCertFile, os.path.basename(self.param.caCertFile))
-            zipf.writestr(certFileInfo, crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
-            zipf.writestr(privkeyFileInfo, crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
+        # generate private keys in parallel, key generation is the expensive part
+        if len(hostnameList) == 1:
+            keyPemList = [_genKeyPem(keyType)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(jobNum) as executor:
+                keyPemList = list(executor.map(_genKeyPem, [keyType] * len(hostnameList)))
+
+        for hostname, keyPem in zip(hostnameList, keyPemList):
+            # generate certificate
+            k = serialization.load_pem_private_key(keyPem, None, default_backend())
+            subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+            cert = _buildCert(subject, k.public_key(), caCert.subject, caKey)
+
+            # save CA certificate, certificate and private key to a zip file for distributing
+            certFileInfo = zipfile.ZipInfo(os.path.basename(self.param.certFile))
+            certFileInfo.external_attr = 0o644 << 16
+            privkeyFileInfo = zipfile.ZipInfo(os.path.basename(self.param.privkeyFile))
+            privkeyFileInfo.external_attr = 0o600 << 16
+            with zipfile.ZipFile(os.path.join(outDir, "selfnet-distribute_%s.zip" % (hostname)), "w") as zipf:
+                zipf.write(self.param.caCertFile, os.path.basename(self.param.caCertFile))
+                zipf.writestr(certFileInfo, _certToPem(cert))
+                zipf.writestr(privkeyFileInfo, keyPem)
 
     def listPeers(self):
         dbusObj = dbus.SystemBus().get_object('org.fpemud.SelfNet', '/org/fpemud/SelfNet')
@@ -76,14 +96,17 @@ class SnSubCmdMain:
             print("\tPowerState: %s" % (peerPowerState))
             print("")
 
-    def peerPowerOperation(self, peerName, opName):
+    def peerPowerOperation(self, peerNameList, opName):
         dbusObj = dbus.SystemBus().get_object('org.fpemud.SelfNet', '/org/fpemud/SelfNet')
-        peerId = dbusObj.GetPeer(peerName, dbus_interface='org.fpemud.SelfNet')
-        if peerId == -1:
-            raise Exception("peer \"%s\" does not exist" % (peerName))
+        resultDict = dbusObj.DoPowerOperationMulti(opName, peerNameList, dbus_interface='org.fpemud.SelfNet', timeout=_POWER_OP_DBUS_TIMEOUT)
 
-        peerObj = dbus.SystemBus().get_object('org.fpemud.SelfNet', '/org/fpemud/SelfNet/Peers/%d' % (peerId))
-        peerObj.DoPowerOperation(opName, dbus_interface='org.fpemud.SelfNet.Peer')
+        failCount = 0
+        for peerName in peerNameList:
+            if resultDict[peerName] != "":
+                print("%s: %s" % (peerName, resultDict[peerName]))
+                failCount += 1
+        if failCount > 0:
+            raise Exception("power operation failed on %d peer(s)" % (failCount))
 
     def listModules(self):
         dbusObj = dbus.SystemBus().get_object('org.fpemud.SelfNet', '/org/fpemud/SelfNet')
@@ -102,39 +125,75 @@ class SnSubCmdMain:
 
     def _loadCertAndKey(self, certFile, keyFile):
         cert = None
-        with open(certFile, "rt") as f:
+        with open(certFile, "rb") as f:
             buf = f.read()
-            cert = crypto.load_certificate(crypto.FILETYPE_PEM, buf)
+            cert = x509.load_pem_x509_certificate(buf, default_backend())
 
         key = None
-        with open(keyFile, "rt") as f:
+        with open(keyFile, "rb") as f:
             buf = f.read()
-            key = crypto.load_privatekey(crypto.FILETYPE_PEM, buf)
+            key = serialization.load_pem_private_key(buf, None, default_backend())
 
         return (cert, key)
 
-    def _genCertAndKey(self, caCert, caKey, cn):
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 1024)
-
-        cert = crypto.X509()
-        cert.get_subject().CN = cn
-        cert.set_serial_number(random.randint(0, 65535))
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(36500 * 24 * 3600)
-        cert.set_issuer(caCert.get_subject())
-        cert.set_pubkey(k)
-        cert.sign(caKey, 'sha1')
-
+    def _genCertAndKey(self, caCert, caKey, cn, keyType):
+        k = _genKey(keyType)
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)])
+        cert = _buildCert(subject, k.public_key(), caCert.subject, caKey)
         return (cert, k)
 
     def _dumpCertAndKey(self, cert, key, certFile, keyFile):
-        with open(certFile, "wt") as f:
-            buf = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
-            f.write(buf)
+        with open(certFile, "wb") as f:
+            f.write(_certToPem(cert))
             os.fchmod(f.fileno(), 0o644)
 
-        with open(keyFile, "wt") as f:
-            buf = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
-            f.write(buf)
+        with open(keyFile, "wb") as f:
+            f.write(_keyToPem(key))
             os.fchmod(f.fileno(), 0o600)
+
+
+def _genKey(keyType):
+    if keyType == "rsa":
+        return rsa.generate_private_key(65537, 2048, default_backend())
+    elif keyType == "ecdsa":
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+    elif keyType == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    else:
+        assert False
+
+
+def _genKeyPem(keyType):
+    """Runs in worker process, key object can not be pickled, so returns PEM"""
+    return _keyToPem(_genKey(keyType))
+
+
+def _buildCert(subject, pubkey, issuer, issuerKey):
+    # Ed25519 signature has no separate digest
+    if isinstance(issuerKey, ed25519.Ed25519PrivateKey):
+        digest = None
+    else:
+        digest = hashes.SHA256()
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(subject)
+    builder = builder.issuer_name(issuer)
+    builder = builder.public_key(pubkey)
+    builder = builder.serial_number(random.randint(0, 65535))
+    builder = builder.not_valid_before(now)
+    builder = builder.not_valid_after(now + datetime.timedelta(days=36500))
+    return builder.sign(issuerKey, digest, default_backend())
+
+
+def _certToPem(cert):
+    return cert.public_bytes(serialization.Encoding.PEM)
+
+
+def _keyToPem(key):
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+
+
+# the daemon fails a power operation by itself after at most _WOL_TIMEOUT (180 seconds) in sn_manager_peer,
+# we wait longer so that the result is always got
+_POWER_OP_DBUS_TIMEOUT = 180 + 60
@@ -2,12 +2,17 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import json
 import logging
 import shutil
 import subprocess
 import pwd
 import socket
+import struct
+import zlib
 import re
+import traceback
+import dbus
 from gi.repository import GLib
 from gi.repository import GObject
 
@@ -343,6 +348,17 @@ class SnUtil:
 
     @staticmethod
     def getSslSocketPeerName(sslSock):
+        if hasattr(sslSock, "getpeercert"):
+            # ssl.SSLObject based socket
+            cert = sslSock.getpeercert()
+            if not cert:
+                return None
+            for rdn in cert.get("subject", ()):
+                for key, value in rdn:
+                    if key == "commonName":
+                        return value
+            return None
+
         cert = sslSock.get_peer_certificate()
         if cert is None:
             return None
@@ -351,6 +367,21 @@ class SnUtil:
             return None
         return subject.CN
 
+    @staticmethod
+    def setSocketKeepalive(sock, interval, miss):
+        """tcp keep-alive and unacknowledged data use the same dead peer timeout"""
+        assert sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE) == 0
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, miss)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, interval * miss * 1000)
+
+    @staticmethod
+    def getShardIndex(name, shardNum):
+        """Returns the same index for the same name in every process, unlike hash()"""
+        return zlib.crc32(name.encode("utf-8")) % shardNum
+
     @staticmethod
     def getPidBySocket(socketInfo):
         """need to be run by root. socketInfo is like 0.0.0.0:80"""
@@ -412,6 +443,53 @@ class SnUtil:
             buf += buf2
         return buf
 
+    @staticmethod
+    def getLocalIpv4AddressList():
+        """Returns the non-loopback IPv4 addresses of all the interfaces"""
+
+        ret = []
+        out = SnUtil.shell("/bin/ip -4 -o addr show", "stdout").decode("utf-8")
+        for m in re.finditer("\\s+inet\\s+([0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+)/", out):
+            if not m.group(1).startswith("127."):
+                ret.append(m.group(1))
+        return ret
+
+    @staticmethod
+    def parseRtnetlinkEvents(buf):
+        """Returns list of "link-up", "new-addr", "default-route" for the interesting
+           rtnetlink messages in buf, other messages are ignored"""
+
+        ret = []
+        offset = 0
+        while offset + 16 <= len(buf):
+            msgLen, msgType, msgFlags, msgSeq, msgPid = struct.unpack_from("=IHHII", buf, offset)
+            if msgLen < 16 or offset + msgLen > len(buf):
+                break
+            payloadOffset = offset + 16
+
+            if msgType == 16 and msgLen >= 16 + 16:                       # RTM_NEWLINK, struct ifinfomsg
+                ifiFamily, ifiType, ifiIndex, ifiFlags, ifiChange = struct.unpack_from("=BxHiII", buf, payloadOffset)
+                if ifiFlags & 0x1 and ifiFlags & 0x40:                      # IFF_UP and IFF_RUNNING
+                    ret.append("link-up")
+            elif msgType == 20:                                             # RTM_NEWADDR
+                ret.append("new-addr")
+            elif msgType in [24, 25] and msgLen >= 16 + 12:                 # RTM_NEWROUTE, RTM_DELROUTE, struct rtmsg
+                rtmFamily, rtmDstLen = struct.unpack_from("=BB", buf, payloadOffset)
+                if rtmDstLen == 0:
+                    ret.append("default-route")
+
+            offset += (msgLen + 3) & ~3                                     # NLMSG_ALIGN
+        return ret
+
+    @staticmethod
+    def getWolMagicPacket(macAddr):
+        """macAddr is in format "xx:xx:xx:xx:xx:xx" or "xx-xx-xx-xx-xx-xx", raises exception for invalid format"""
+
+        if re.fullmatch("[0-9a-fA-F]{2}([:-][0-9a-fA-F]{2}){5}", macAddr) is None:
+            raise Exception("invalid MAC address \"%s\"" % (macAddr))
+        mac = bytes.fromhex(macAddr.replace(":", "").replace("-", ""))
+        return b'\xff' * 6 + mac * 16
+
 
 # this socket add watch into GLib default mainloop
 # this socket requires logging module be prepared
@@ -633,6 +711,9 @@ class ReliableUdpObjSocket:
 
 class MulticastObjSocket:
 
+    """Objects are sent as JSON instead of pickle, anyone in the LAN can send to
+       the multicast group. recvFunc(obj, addr) is called for received objects."""
+
     BUFFER_SIZE = 4096
 
     def __init__(self, multicastIp, multicastPort, recvFunc):
@@ -643,25 +724,27 @@ class MulticastObjSocket:
         self.recvFunc = recvFunc
 
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, struct.pack('b', 1))
+        self.socket.setblocking(False)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 0)
         self.socket.bind((self.ip, self.port))
-        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack('4sL', socket.inet_aton((self.ip, self.port)), socket.INADDR_ANY))
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, struct.pack("4sl", socket.inet_aton(self.ip), socket.INADDR_ANY))
 
-# sock.setsockopt(socket.SOL_IP, socket.IP_MULTICAST_IF, socket.inet_aton(host))
-#   sock.setsockopt(socket.SOL_IP, socket.IP_ADD_MEMBERSHIP, 
-#                    socket.inet_aton(MCAST_GRP) + socket.inet_aton(host))
-# https://pypi.org/project/py-multicast/
-
-        self.recvSourceId = GLib.io_add_watch(self.sock, GLib.IO_IN | self.flagError, self._onRecv)
+        self.recvSourceId = GLib.io_add_watch(self.socket, GLib.IO_IN | self.flagError, self._onRecv)
 
     def close(self):
-        assert self.sock is not None
+        assert self.socket is not None
         GLib.source_remove(self.recvSourceId)
         self.socket.close()
-        self.sock = None
+        self.socket = None
 
     def send(self, data):
-        self.socket.sendto(pickle.dumps(data), (self.ip, self.port)) 
+        try:
+            self.socket.sendto(json.dumps(data).encode("utf-8"), (self.ip, self.port))
+        except socket.error as e:
+            # network may be not ready
+            logging.debug("MulticastObjSocket.send: %s" % (str(e)))
 
     def _onRecv(self, source, cb_condition):
         if self.socket is None:
@@ -673,25 +756,185 @@ class MulticastObjSocket:
 
         try:
             data, addr = self.socket.recvfrom(self.BUFFER_SIZE)
-            self.recvFunc(pickle.loads(data))
+        except (BlockingIOError, InterruptedError):
+            return True
+
+        try:
+            obj = json.loads(data.decode("utf-8"))
+        except ValueError:
+            logging.debug("MulticastObjSocket._onRecv: Invalid data from %s" % (addr[0]))
             return True
+
+        try:
+            self.recvFunc(obj, addr)
         except:
             logging.error(traceback.format_exc())
-            return False
+        return True
 
 
 class SnSleepNotifier:
 
+    """Watches the PrepareForSleep signal of logind. The signal doesn't tell the
+       sleep type, so sleepType in the callbacks is always SLEEP_TYPE_UNKNOWN."""
+
     SLEEP_TYPE_SUSPEND = 0
     SLEEP_TYPE_HIBERNATE = 1
     SLEEP_TYPE_HYBRID_SLEEP = 2
+    SLEEP_TYPE_UNKNOWN = 3
 
     def __init__(self, cbBeforeSleep, cbAfterResume):
         self.cbBeforeSleep = cbBeforeSleep
         self.cbAfterResume = cbAfterResume
+        self.signalMatch = None
+
+        # logind may be not available
+        try:
+            self.signalMatch = dbus.SystemBus().add_signal_receiver(self._onPrepareForSleep,
+                                                                    signal_name="PrepareForSleep",
+                                                                    dbus_interface="org.freedesktop.login1.Manager",
+                                                                    bus_name="org.freedesktop.login1",
+                                                                    path="/org/freedesktop/login1")
+        except dbus.exceptions.DBusException as e:
+            logging.warning("SnSleepNotifier.__init__: Failed to watch sleep events, %s" % (str(e)))
+
+    def dispose(self):
+        if self.signalMatch is not None:
+            self.signalMatch.remove()
+            self.signalMatch = None
+
+    def _onPrepareForSleep(self, start):
+        try:
+            if start:
+                self.cbBeforeSleep(self.SLEEP_TYPE_UNKNOWN)
+            else:
+                self.cbAfterResume(self.SLEEP_TYPE_UNKNOWN)
+        except:
+            logging.error(traceback.format_exc())
+
+
+class SnNetlinkWatcher:
+
+    """Watches rtnetlink for link up, new address and default route change.
+       A burst of events results in one changeFunc() call."""
+
+    RTMGRP_LINK = 0x1
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTMGRP_IPV4_ROUTE = 0x40
+    RTMGRP_IPV6_IFADDR = 0x100
+    RTMGRP_IPV6_ROUTE = 0x400
+
+    COALESCE_TIMEOUT = 200                  # ms
+
+    def __init__(self, changeFunc):
+        self.flagError = GLib.IO_PRI | GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL
+        self.changeFunc = changeFunc
+
+        groups = self.RTMGRP_LINK | self.RTMGRP_IPV4_IFADDR | self.RTMGRP_IPV4_ROUTE | self.RTMGRP_IPV6_IFADDR | self.RTMGRP_IPV6_ROUTE
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.setblocking(False)
+        self.sock.bind((0, groups))
+
+        self.recvSourceId = GLib.io_add_watch(self.sock, GLib.IO_IN | self.flagError, self._onRecv)
+        self.timeoutSourceId = None
 
     def dispose(self):
-        pass
+        if self.timeoutSourceId is not None:
+            GLib.source_remove(self.timeoutSourceId)
+            self.timeoutSourceId = None
+        if self.recvSourceId is not None:
+            GLib.source_remove(self.recvSourceId)
+            self.recvSourceId = None
+        self.sock.close()
+
+    def _onRecv(self, source, cb_condition):
+        if cb_condition & self.flagError:
+            logging.error("SnNetlinkWatcher._onRecv, %s" % (SnUtil.cbConditionToStr(cb_condition)))
+            self.recvSourceId = None
+            return False
+
+        eventList = []
+        while True:
+            try:
+                buf = self.sock.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # ENOBUFS, kernel dropped messages, treat it as a change
+                logging.debug("SnNetlinkWatcher._onRecv: %s" % (str(e)))
+                eventList.append("overrun")
+                break
+            eventList += SnUtil.parseRtnetlinkEvents(buf)
+
+        if len(eventList) > 0 and self.timeoutSourceId is None:
+            self.timeoutSourceId = GLib.timeout_add(self.COALESCE_TIMEOUT, self._onTimeout)
+        return True
+
+    def _onTimeout(self):
+        self.timeoutSourceId = None
+        self.changeFunc()
+        return False
+
+
+class SnWakeOnLan:
+
+    """Sends Wake-on-LAN magic packets through a non-blocking broadcast socket.
+       Packets for all the targets added in one mainloop iteration are sent in
+       one batch, and are re-sent in each retry interval until the target is removed."""
+
+    PORT = 9
+    RETRY_INTERVAL = 5                      # second
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+
+        self.targetDict = dict()            # name -> (packet, broadcastAddr)
+        self.batchSourceId = None
+        self.timerSourceId = None
+
+    def dispose(self):
+        if self.batchSourceId is not None:
+            GLib.source_remove(self.batchSourceId)
+            self.batchSourceId = None
+        if self.timerSourceId is not None:
+            GLib.source_remove(self.timerSourceId)
+            self.timerSourceId = None
+        self.sock.close()
+
+    def add(self, name, macAddr, broadcastAddr):
+        self.targetDict[name] = (SnUtil.getWolMagicPacket(macAddr), broadcastAddr)
+        if self.batchSourceId is None:
+            self.batchSourceId = GLib.idle_add(self._onBatch)
+
+    def remove(self, name):
+        if name in self.targetDict:
+            del self.targetDict[name]
+
+    def _onBatch(self):
+        self.batchSourceId = None
+        self._send()
+        if self.timerSourceId is None:
+            self.timerSourceId = GObject.timeout_add_seconds(self.RETRY_INTERVAL, self._onTimer)
+        return False
+
+    def _onTimer(self):
+        if len(self.targetDict) == 0:
+            self.timerSourceId = None
+            return False
+        self._send()
+        return True
+
+    def _send(self):
+        for name, (packet, broadcastAddr) in self.targetDict.items():
+            try:
+                self.sock.sendto(packet, (broadcastAddr, self.PORT))
+            except (BlockingIOError, InterruptedError):
+                # socket buffer is full, re-sent in the next retry interval
+                pass
+            except socket.error as e:
+                # network may be not ready
+                logging.debug("SnWakeOnLan._send: %s, %s" % (name, str(e)))
 
 
 class SgwApiClient:
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import json
+import pickle
+import socket
+import logging
+import traceback
+from gi.repository import GLib
+
+sys.path.append('/usr/lib/selfnetd')
+from objsocket import objsocket
+from sn_util import SnUtil
+from sn_conn_peer import SnPeerServer
+from sn_conn_peer import SnPeerClient
+from sn_conn_peer import SnSslObjectSocket
+from sn_conn_peer import SnPeerIoWorkerMessage
+
+
+"""
+Messages exchanged with main process are SnPeerIoWorkerMessage frames, DATA is
+forwarded as is, it is not unpickled in the worker process.
+"""
+
+
+class PeerIoWorker:
+
+    def __init__(self, param, mainloop):
+        self.param = param
+        self.mainloop = mainloop
+        self.connIdNext = 0
+        self.sockDict = dict()              # connId -> objsocket
+        self.sockIdDict = dict()            # objsocket -> connId
+
+        pipeSock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=param["pipeFd"])
+        pipeSock.setblocking(False)
+        self.mainPipe = objsocket(objsocket.SOCKTYPE_SOCKET, pipeSock,
+                                  self.onMainPipeRecv, self.onMainPipeError, self._mainPipeGcComplete, raw=True)
+
+        self.serverEndPoint = SnPeerServer(param["certFile"], param["privkeyFile"], param["caCertFile"], self.onSocketConnected,
+                                           param["handshakeThreadNum"], param["sslBackend"])
+        self.serverEndPoint.start(param["port"], True)
+        self.clientEndPoint = SnPeerClient(param["certFile"], param["privkeyFile"], param["caCertFile"], self.onClientSocketConnected,
+                                           param["handshakeThreadNum"], param["sslBackend"])
+
+    def dispose(self):
+        self.clientEndPoint.dispose()
+        self.serverEndPoint.dispose()
+        for sock in self.sockDict.values():
+            sock.close()
+        self.sockDict.clear()
+        self.sockIdDict.clear()
+
+    def onMainPipeRecv(self, pipe, frame):
+        msgType, connId, payload = SnPeerIoWorkerMessage.unpack(frame)
+
+        if msgType == SnPeerIoWorkerMessage.CONNECT:
+            hostname, port, hostaddr, hint = pickle.loads(payload)
+            self.clientEndPoint.connect(hostname, port, hostaddr, hint)
+            return
+
+        sock = self.sockDict.get(connId)
+        if sock is None:
+            return
+
+        if msgType == SnPeerIoWorkerMessage.SEND:
+            if not sock.is_graceful_closing():
+                sock.send(payload)
+        elif msgType == SnPeerIoWorkerMessage.SEND_CONFLATE:
+            if not sock.is_graceful_closing():
+                key, data = SnPeerIoWorkerMessage.unpackConflate(payload)
+                sock.send(data, key)
+        elif msgType == SnPeerIoWorkerMessage.COMPRESS:
+            sock.enable_compress()
+        elif msgType == SnPeerIoWorkerMessage.GRACEFUL_CLOSE:
+            if not sock.is_graceful_closing():
+                sock.graceful_close()
+        elif msgType == SnPeerIoWorkerMessage.CLOSE:
+            self._removeSock(sock)
+            sock.close()
+        else:
+            assert False
+
+    def onMainPipeError(self, pipe, excObj):
+        # main process exits
+        logging.info("PeerIoWorker.onMainPipeError: %s", str(excObj))
+        self.mainPipe.close()
+        self.mainloop.quit()
+
+    def onSocketConnected(self, sslSock, isClient=False):
+        peerName = SnUtil.getSslSocketPeerName(sslSock)
+        if peerName is None:
+            sslSock.close()
+            logging.debug("PeerIoWorker.onSocketConnected: Fail, no peer name")
+            return
+
+        peerAddr = None
+        try:
+            peerAddr = sslSock.getpeername()[0]
+        except socket.error:
+            pass
+
+        SnUtil.setSocketKeepalive(sslSock, self.param["keepaliveInterval"], self.param["keepaliveMiss"])
+        if isinstance(sslSock, SnSslObjectSocket):
+            sockType = objsocket.SOCKTYPE_SSL_OBJECT
+        else:
+            sockType = objsocket.SOCKTYPE_SSL_SOCKET
+        sock = objsocket(sockType, sslSock, self.onSocketRecv, self.onSocketError, self._gcComplete, raw=True)
+
+        connId = self.connIdNext
+        self.connIdNext += 1
+        self.sockDict[connId] = sock
+        self.sockIdDict[sock] = connId
+        logging.debug("PeerIoWorker.onSocketConnected: %s, connection %d", peerName, connId)
+
+        self.mainPipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.CONNECTED, connId, pickle.dumps((peerName, peerAddr, isClient))))
+
+    def onClientSocketConnected(self, sslSock):
+        self.onSocketConnected(sslSock, True)
+
+    def onSocketRecv(self, sock, data):
+        self.mainPipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.RECV, self.sockIdDict[sock], data))
+
+    def onSocketError(self, sock, excObj):
+        connId = self._removeSock(sock)
+        sock.close()
+        self.mainPipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.ERROR, connId, str(excObj).encode("utf-8")))
+
+    def _gcComplete(self, sock):
+        connId = self._removeSock(sock)
+        sock.close()
+        self.mainPipe.send(SnPeerIoWorkerMessage.pack(SnPeerIoWorkerMessage.GC_COMPLETE, connId))
+
+    def _mainPipeGcComplete(self, pipe):
+        """We don't do graceful close on main pipe"""
+        assert False
+
+    def _removeSock(self, sock):
+        connId = self.sockIdDict[sock]
+        del self.sockIdDict[sock]
+        del self.sockDict[connId]
+        return connId
+
+
+################################################################################
+
+
+assert len(sys.argv) == 2
+param = json.loads(sys.argv[1])
+
+logging.getLogger().addHandler(logging.FileHandler(os.path.join(param["logDir"], "peer-io-worker-%d.log" % (param["index"]))))
+logging.getLogger().setLevel(SnUtil.getLoggingLevel(param["logLevel"]))
+
+# do work
+logging.info("selfnetd-peer-io-worker: Mainloop begins")
+mainloop = GLib.MainLoop()
+workerObj = None
+try:
+    workerObj = PeerIoWorker(param, mainloop)
+    mainloop.run()
+except Exception as e:
+    logging.error(traceback.format_exc())
+    sys.exit(1)
+finally:
+    if workerObj is not None:
+        workerObj.dispose()
+    logging.info("selfnetd-peer-io-worker: Mainloop exits")
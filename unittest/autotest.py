@@ -10,12 +10,29 @@ curDir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(curDir, "../lib"))
 
 import testsuit_sn_util
+import testsuit_sn_manager_local
+import testsuit_sn_manager_peer
+import testsuit_objsocket
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(testsuit_sn_util.Test_getUidGidMinMaxInfo())
     suite.addTest(testsuit_sn_util.Test_getNormalUserList())
+    suite.addTest(testsuit_sn_util.Test_parseRtnetlinkEvents())
+    suite.addTest(testsuit_sn_util.Test_getWolMagicPacket())
+    suite.addTest(testsuit_sn_util.Test_getShardIndex())
+    suite.addTest(testsuit_sn_manager_local.Test_SnSysInfo_encoding())
+    suite.addTest(testsuit_sn_manager_local.Test_SnSysInfo_legacy())
+    suite.addTest(testsuit_sn_manager_local.Test_SnSysInfoDelta_apply())
+    suite.addTest(testsuit_sn_manager_local.Test_SnSysInfoDelta_applyInvalid())
+    suite.addTest(testsuit_sn_manager_peer.Test_PeerOutbox_append())
+    suite.addTest(testsuit_sn_manager_peer.Test_PeerOutbox_conflate())
+    suite.addTest(testsuit_sn_manager_peer.Test_PeerOutbox_full())
+    suite.addTest(testsuit_sn_manager_peer.Test_PeerOutbox_reload())
+    suite.addTest(testsuit_objsocket.Test_objsocket_conflate())
+    suite.addTest(testsuit_objsocket.Test_objsocket_compress())
+    suite.addTest(testsuit_objsocket.Test_objsocket_compressFormat())
     return suite
 
 if __name__ == "__main__":
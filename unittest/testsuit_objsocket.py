@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import zlib
+import struct
+import pickle
+import socket
+import unittest
+from gi.repository import GLib
+from objsocket import objsocket
+
+
+class Test_objsocket_conflate(unittest.TestCase):
+
+    def setUp(self):
+        self.mainloop = GLib.MainLoop()
+        self.recvList = []
+        s1, s2 = socket.socketpair()
+        s1.setblocking(False)
+        s2.setblocking(False)
+        self.sock1 = objsocket(objsocket.SOCKTYPE_SOCKET, s1, self._onRecv, self._onError, self._onGcComplete)
+        self.sock2 = objsocket(objsocket.SOCKTYPE_SOCKET, s2, self._onRecv, self._onError, self._onGcComplete)
+
+    def tearDown(self):
+        self.sock1.close()
+        self.sock2.close()
+
+    def runTest(self):
+        # objects with the same conflate key replace the not yet sent one in place
+        self.sock1.send("a", "key1")
+        self.sock1.send(1)
+        self.sock1.send("b", "key1")
+        self.sock1.send("c", "key2")
+        self.sock1.send("d", "key1")
+        self.sock1.send("end")
+        _runMainLoop(self.mainloop)
+        self.assertEqual(self.recvList, ["d", 1, "c", "end"])
+
+        # sent object is not replaced
+        self.recvList = []
+        self.sock1.send("e", "key1")
+        self.sock1.send("end")
+        _runMainLoop(self.mainloop)
+        self.assertEqual(self.recvList, ["e", "end"])
+
+    def _onRecv(self, sock, obj):
+        self.recvList.append(obj)
+        if obj == "end":
+            self.mainloop.quit()
+
+    def _onError(self, sock, excObj):
+        # the socket is broken, the checks after the main loop fail
+        self.mainloop.quit()
+
+    def _onGcComplete(self, sock):
+        assert False
+
+
+class Test_objsocket_compress(unittest.TestCase):
+
+    def setUp(self):
+        self.mainloop = GLib.MainLoop()
+        self.recvList = []
+        s1, s2 = socket.socketpair()
+        s1.setblocking(False)
+        s2.setblocking(False)
+        self.sock1 = objsocket(objsocket.SOCKTYPE_SOCKET, s1, self._onRecv, self._onError, self._onGcComplete)
+        self.sock2 = objsocket(objsocket.SOCKTYPE_SOCKET, s2, self._onRecv, self._onError, self._onGcComplete)
+
+    def tearDown(self):
+        self.sock1.close()
+        self.sock2.close()
+
+    def runTest(self):
+        bigObj = b'x' * 100000
+        self.sock1.enable_compress()
+        self.sock1.send(bigObj)
+        self.sock1.send("end")
+        _runMainLoop(self.mainloop)
+        self.assertEqual(self.recvList, [bigObj, "end"])
+
+        # compressed packets are always accepted in receiving
+        self.recvList = []
+        self.sock2.send(bigObj)
+        self.sock2.send("end")
+        _runMainLoop(self.mainloop)
+        self.assertEqual(self.recvList, [bigObj, "end"])
+
+    def _onRecv(self, sock, obj):
+        self.recvList.append(obj)
+        if obj == "end":
+            self.mainloop.quit()
+
+    def _onError(self, sock, excObj):
+        # the socket is broken, the checks after the main loop fail
+        self.mainloop.quit()
+
+    def _onGcComplete(self, sock):
+        assert False
+
+
+class Test_objsocket_compressFormat(unittest.TestCase):
+
+    def setUp(self):
+        self.mainloop = GLib.MainLoop()
+        self.recvBuffer = b''
+        self.packetList = []
+        s1, self.s2 = socket.socketpair()
+        s1.setblocking(False)
+        self.s2.setblocking(False)
+        self.sock1 = objsocket(objsocket.SOCKTYPE_SOCKET, s1, None, self._onError, self._onGcComplete)
+        self.recvSourceId = GLib.io_add_watch(self.s2, GLib.IO_IN, self._onRecv)
+
+    def tearDown(self):
+        GLib.source_remove(self.recvSourceId)
+        self.sock1.close()
+        self.s2.close()
+
+    def runTest(self):
+        # large object is compressed, small object is not
+        bigObj = b'x' * 100000
+        self.sock1.enable_compress()
+        self.sock1.send(bigObj)
+        self.sock1.send("s")
+        _runMainLoop(self.mainloop)
+
+        self.assertEqual(len(self.packetList), 2)
+        self.assertTrue(self.packetList[0][0])
+        self.assertLess(len(self.packetList[0][1]), len(bigObj))
+        self.assertEqual(pickle.loads(zlib.decompress(self.packetList[0][1])), bigObj)
+        self.assertFalse(self.packetList[1][0])
+        self.assertEqual(pickle.loads(self.packetList[1][1]), "s")
+
+    def _onRecv(self, source, cb_condition):
+        self.recvBuffer += self.s2.recv(65536)
+        while len(self.recvBuffer) >= 4:
+            dataLen = struct.unpack("!I", self.recvBuffer[:4])[0]
+            compressed = (dataLen & 0x80000000) != 0
+            dataLen &= ~0x80000000
+            if len(self.recvBuffer) < 4 + dataLen:
+                break
+            self.packetList.append((compressed, self.recvBuffer[4:4 + dataLen]))
+            self.recvBuffer = self.recvBuffer[4 + dataLen:]
+        if len(self.packetList) == 2:
+            self.mainloop.quit()
+        return True
+
+    def _onError(self, sock, excObj):
+        # the socket is broken, the checks after the main loop fail
+        self.mainloop.quit()
+
+    def _onGcComplete(self, sock):
+        assert False
+
+
+def _runMainLoop(mainloop):
+    """Quits after 10 seconds if the objects are never received"""
+
+    timeoutList = []
+
+    def _onTimeout():
+        timeoutList.append(True)
+        mainloop.quit()
+        return False
+
+    timeoutId = GLib.timeout_add_seconds(10, _onTimeout)
+    mainloop.run()
+    if len(timeoutList) == 0:
+        GLib.source_remove(timeoutId)
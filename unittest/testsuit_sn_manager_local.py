@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import unittest
+from sn_manager_local import SnSysInfo
+from sn_manager_local import SnSysInfoDelta
+
+
+def _getDelta(baseVersion, userAddList, userRemoveList, moduleAddList, moduleRemoveList):
+    ret = SnSysInfoDelta()
+    ret.baseVersion = baseVersion
+    ret.version = baseVersion + 1
+    ret.userAddList = userAddList
+    ret.userRemoveList = userRemoveList
+    ret.moduleAddList = moduleAddList
+    ret.moduleRemoveList = moduleRemoveList
+    return ret
+
+
+def _getSysInfo():
+    moduleTupleList = [
+        ("sys-server-a", None),
+        ("usr-peer-b", "u1"),
+        ("usr-peer-b", "u2"),
+        ("usr-client-c", "u2"),
+    ]
+    return SnSysInfo.fromModuleTupleList(1, ["u1", "u2"], moduleTupleList)
+
+
+class Test_SnSysInfo_encoding(unittest.TestCase):
+
+    def runTest(self):
+        sysInfo = _getSysInfo()
+        self.assertEqual(sysInfo.version, 1)
+        self.assertEqual(sysInfo.userList, ["u1", "u2"])
+        self.assertEqual(sysInfo.moduleList, ["sys-server-a", "usr-peer-b", "usr-client-c"])
+        self.assertEqual(sysInfo.moduleUserBitmap, [0, 0x3, 0x2])
+
+        self.assertEqual(sysInfo.getModuleTupleList(), [("sys-server-a", None), ("usr-peer-b", "u1"),
+                                                        ("usr-peer-b", "u2"), ("usr-client-c", "u2")])
+
+        self.assertTrue(sysInfo.hasModule(None, "sys-server-a"))
+        self.assertTrue(sysInfo.hasModule("u1", "usr-peer-b"))
+        self.assertTrue(sysInfo.hasModule("u2", "usr-client-c"))
+        self.assertFalse(sysInfo.hasModule("u1", "usr-client-c"))
+        self.assertFalse(sysInfo.hasModule("u3", "usr-peer-b"))
+        self.assertFalse(sysInfo.hasModule("u1", "usr-peer-d"))
+
+
+class Test_SnSysInfo_legacy(unittest.TestCase):
+
+    def runTest(self):
+        sysInfo = _getSysInfo()
+        self.assertFalse(sysInfo.isLegacy())
+
+        legacyInfo = sysInfo.toLegacy()
+        self.assertTrue(legacyInfo.isLegacy())
+        self.assertEqual([x.userName for x in legacyInfo.userList], ["u1", "u2"])
+        self.assertEqual([(x.moduleName, x.userName) for x in legacyInfo.moduleList], sysInfo.getModuleTupleList())
+
+        newInfo = SnSysInfo.fromLegacy(legacyInfo)
+        self.assertEqual(newInfo.version, 0)
+        self.assertEqual(newInfo, sysInfo)
+
+
+class Test_SnSysInfoDelta_apply(unittest.TestCase):
+
+    def runTest(self):
+        sysInfo = _getSysInfo()
+        delta = _getDelta(1, ["u3"], [], [("usr-peer-b", "u3"), ("sys-client-d", None)], [("usr-client-c", "u2")])
+        newInfo = delta.apply(sysInfo)
+        self.assertEqual(newInfo.version, 2)
+        self.assertEqual(newInfo.userList, ["u1", "u2", "u3"])
+        self.assertEqual(newInfo.getModuleTupleList(), [("sys-server-a", None), ("usr-peer-b", "u1"), ("usr-peer-b", "u2"),
+                                                        ("usr-peer-b", "u3"), ("sys-client-d", None)])
+
+        # sysInfo is not modified
+        self.assertEqual(sysInfo, _getSysInfo())
+        self.assertEqual(sysInfo.version, 1)
+
+        # remove user with its modules
+        delta = _getDelta(1, [], ["u1"], [], [("usr-peer-b", "u1")])
+        newInfo = delta.apply(sysInfo)
+        self.assertEqual(newInfo.userList, ["u2"])
+        self.assertEqual(newInfo.getModuleTupleList(), [("sys-server-a", None), ("usr-peer-b", "u2"), ("usr-client-c", "u2")])
+
+
+class Test_SnSysInfoDelta_applyInvalid(unittest.TestCase):
+
+    def runTest(self):
+        sysInfo = _getSysInfo()
+
+        # version not match
+        delta = _getDelta(2, ["u3"], [], [], [])
+        self.assertRaises(ValueError, delta.apply, sysInfo)
+
+        # user is removed, but its module is not
+        delta = _getDelta(1, [], ["u1"], [], [])
+        self.assertRaises(ValueError, delta.apply, sysInfo)
+
+        # module is added for a user that does not exist
+        delta = _getDelta(1, [], [], [("usr-peer-b", "u3")], [])
+        self.assertRaises(ValueError, delta.apply, sysInfo)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import shutil
+import pickle
+import tempfile
+import unittest
+import sn_manager_peer
+
+
+class Test_PeerOutbox_append(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.outbox = sn_manager_peer._PeerOutbox(os.path.join(self.tmpDir, "peer.db"))
+
+    def tearDown(self):
+        self.outbox.dispose()
+        shutil.rmtree(self.tmpDir)
+
+    def runTest(self):
+        self.assertTrue(self.outbox.isEmpty())
+        self.assertFalse(self.outbox.hasUnsent())
+
+        self.outbox.append("u1", "usr-peer-a", 1)
+        self.outbox.append(None, "sys-peer-b", 2)
+        self.outbox.append("u1", "usr-peer-a", 3)
+        self.assertFalse(self.outbox.isEmpty())
+        self.assertTrue(self.outbox.hasUnsent())
+        self.assertEqual(self.outbox.takeAll(), [("u1", "usr-peer-a", 1), (None, "sys-peer-b", 2), ("u1", "usr-peer-a", 3)])
+        self.assertFalse(self.outbox.hasUnsent())
+
+        # sent objects are returned again before commit
+        self.outbox.append("u1", "usr-peer-a", 4)
+        self.assertTrue(self.outbox.hasUnsent())
+        self.assertEqual(self.outbox.takeAll(), [("u1", "usr-peer-a", 1), (None, "sys-peer-b", 2), ("u1", "usr-peer-a", 3),
+                                                 ("u1", "usr-peer-a", 4)])
+
+        self.outbox.commit()
+        self.assertTrue(self.outbox.isEmpty())
+        self.assertEqual(self.outbox.takeAll(), [])
+
+
+class Test_PeerOutbox_conflate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.outbox = sn_manager_peer._PeerOutbox(os.path.join(self.tmpDir, "peer.db"))
+
+    def tearDown(self):
+        self.outbox.dispose()
+        shutil.rmtree(self.tmpDir)
+
+    def runTest(self):
+        # newer object replaces the older one in place
+        self.outbox.append("u1", "usr-peer-a", 1, "state")
+        self.outbox.append("u1", "usr-peer-a", 2)
+        self.outbox.append("u1", "usr-peer-a", 3, "state")
+        self.outbox.append("u2", "usr-peer-a", 4, "state")
+        self.assertEqual(self.outbox.takeAll(), [("u1", "usr-peer-a", 3), ("u1", "usr-peer-a", 2), ("u2", "usr-peer-a", 4)])
+
+        # sent object is not replaced
+        self.outbox.append("u1", "usr-peer-a", 5, "state")
+        self.outbox.append("u1", "usr-peer-a", 6, "state")
+        self.assertEqual(self.outbox.takeAll(), [("u1", "usr-peer-a", 3), ("u1", "usr-peer-a", 2), ("u2", "usr-peer-a", 4),
+                                                 ("u1", "usr-peer-a", 6)])
+
+
+class Test_PeerOutbox_full(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.outbox = sn_manager_peer._PeerOutbox(os.path.join(self.tmpDir, "peer.db"))
+
+    def tearDown(self):
+        self.outbox.dispose()
+        shutil.rmtree(self.tmpDir)
+
+    def runTest(self):
+        # the oldest one of the same module is dropped
+        for i in range(0, sn_manager_peer._OUTBOX_MAX + 1):
+            self.outbox.append("u1", "usr-peer-a", i)
+        self.outbox.append("u1", "usr-peer-b", -1)
+        objList = self.outbox.takeAll()
+        self.assertEqual(len(objList), sn_manager_peer._OUTBOX_MAX + 1)
+        self.assertEqual(objList[0], ("u1", "usr-peer-a", 1))
+        self.assertEqual(objList[-1], ("u1", "usr-peer-b", -1))
+
+
+class Test_PeerOutbox_reload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpDir, "peer.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def runTest(self):
+        outbox = sn_manager_peer._PeerOutbox(self.filename)
+        outbox.append("u1", "usr-peer-a", 1, "state")
+        outbox.append("u1", "usr-peer-a", 2)
+        outbox.append("u1", "usr-peer-a", 3, "state")
+        outbox.dispose()
+
+        # conflation is kept after reload, not committed objects are not sent
+        outbox = sn_manager_peer._PeerOutbox(self.filename)
+        self.assertTrue(outbox.hasUnsent())
+        self.assertEqual(outbox.takeAll(), [("u1", "usr-peer-a", 3), ("u1", "usr-peer-a", 2)])
+        outbox.append("u1", "usr-peer-a", 4)
+        outbox.commit()
+        outbox.dispose()
+
+        # objects appended after takeAll() are kept after commit
+        outbox = sn_manager_peer._PeerOutbox(self.filename)
+        self.assertEqual(outbox.takeAll(), [("u1", "usr-peer-a", 4)])
+        outbox.dispose()
+
+        # partial record at the end and leftover temporary file are dropped
+        with open(self.filename, "ab") as f:
+            f.write(pickle.dumps(("add", 100, 0, "u1", "usr-peer-a", 5, None))[:10])
+        with open(self.filename + ".new", "wb") as f:
+            f.write(b'garbage')
+        outbox = sn_manager_peer._PeerOutbox(self.filename)
+        self.assertFalse(os.path.exists(self.filename + ".new"))
+        self.assertEqual(outbox.takeAll(), [("u1", "usr-peer-a", 4)])
+        outbox.dispose()
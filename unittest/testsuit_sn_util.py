@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
+import struct
 import unittest
 from sn_util import SnUtil
 
@@ -14,4 +15,38 @@ class Test_getUidGidMinMaxInfo(unittest.TestCase):
 class Test_getNormalUserList(unittest.TestCase):
 
     def runTest(self):
-        SnUtil.getNormalUserList()
\ No newline at end of file
+        SnUtil.getNormalUserList()
+
+
+class Test_parseRtnetlinkEvents(unittest.TestCase):
+
+    def runTest(self):
+        # RTM_NEWLINK, IFF_UP | IFF_RUNNING
+        buf = struct.pack("=IHHII", 32, 16, 0, 0, 0) + struct.pack("=BxHiII", 0, 1, 2, 0x41, 0)
+        # RTM_NEWLINK, IFF_UP only
+        buf += struct.pack("=IHHII", 32, 16, 0, 0, 0) + struct.pack("=BxHiII", 0, 1, 2, 0x1, 0)
+        # RTM_NEWADDR
+        buf += struct.pack("=IHHII", 24, 20, 0, 0, 0) + bytes(8)
+        # RTM_NEWROUTE, default route and non-default route
+        buf += struct.pack("=IHHII", 28, 24, 0, 0, 0) + struct.pack("=BB", 2, 0) + bytes(10)
+        buf += struct.pack("=IHHII", 28, 24, 0, 0, 0) + struct.pack("=BB", 2, 24) + bytes(10)
+        self.assertEqual(SnUtil.parseRtnetlinkEvents(buf), ["link-up", "new-addr", "default-route"])
+
+
+class Test_getWolMagicPacket(unittest.TestCase):
+
+    def runTest(self):
+        mac = bytes([0x00, 0x1a, 0x2b, 0x3c, 0x4d, 0x5e])
+        self.assertEqual(SnUtil.getWolMagicPacket("00:1a:2b:3c:4d:5e"), b'\xff' * 6 + mac * 16)
+        self.assertEqual(SnUtil.getWolMagicPacket("00-1A-2B-3C-4D-5E"), b'\xff' * 6 + mac * 16)
+        self.assertRaises(Exception, SnUtil.getWolMagicPacket, "00:1a:2b:3c:4d")
+        self.assertRaises(Exception, SnUtil.getWolMagicPacket, "00:1a:2b:3c:4d:5g")
+
+
+class Test_getShardIndex(unittest.TestCase):
+
+    def runTest(self):
+        self.assertEqual(SnUtil.getShardIndex("host1", 4), SnUtil.getShardIndex("host1", 4))
+        self.assertEqual(SnUtil.getShardIndex("host1", 1), 0)
+        for i in range(0, 100):
+            self.assertTrue(0 <= SnUtil.getShardIndex("host%d" % (i), 3) < 3)